@@ -1,7 +1,7 @@
 import codecs
 import os
 
-from visualizer.models import Corpus, Document, DocumentTopic
+from visualizer.models import Corpus
 
 def run():
     corpus = Corpus.objects.get(name=u"Turkish")
@@ -14,9 +14,9 @@ def run():
     topic_file = os.path.join(os.getenv("HOME"), "zr_datasets/turkish/audio_topics.txt")
     topic_lines = codecs.open(topic_file, encoding="utf-8").readlines()
 
+    document_topic_labels = []
     for topic_line in topic_lines[1:]:
         (filename, label) = topic_line.strip().split('\t')
         audio_identifier = os.path.splitext(filename)[0]
-        document = Document.objects.get(audio_identifier=audio_identifier)
-        (document_topic, _) = DocumentTopic.objects.get_or_create(corpus=corpus, label=label)
-        document_topic.documents.add(document)
+        document_topic_labels.append((audio_identifier, label))
+    corpus.add_document_topics(document_topic_labels)
@@ -46,7 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'django.middleware.gzip.GZipMiddleware',
+    'visualizer.middleware.GZipMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,6 +89,34 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+#
+# Cached files (wordcloud JSON responses, audio clips) are stored in
+# CACHE_DIR, so they are shared by all server processes and survive
+# server restarts.
+
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_DIR, 'django'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+# Maximum total size of the cached WAV files for Term audio clips
+TERM_CLIP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Maximum total size of the WAV files converted from non-WAV (e.g. FLAC,
+# SPHERE) Document audio files
+DOCUMENT_AUDIO_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
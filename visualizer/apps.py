@@ -1,7 +1,12 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class VisualizerConfig(AppConfig):
     name = 'visualizer'
+
+    def ready(self):
+        from visualizer.search import create_search_index_triggers
+        post_migrate.connect(create_search_index_triggers, sender=self)
@@ -0,0 +1,330 @@
+"""Functions for reading information about audio files, and for extracting audio clips
+"""
+from array import array
+import io
+import multiprocessing
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+
+import pysox
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def concatenate_clips(clips, rate, channels, precision):
+    """Return the contents of a WAV file containing the concatenated audio clips
+
+    Each clip is an (audio_path, start_offset, duration) tuple, where the
+    offset and duration are measured in hundredths of a second.  Clips
+    are copied directly from the source files when possible, and
+    extracted using SoX otherwise.
+    """
+    wav_data = slice_wav_clips(clips, rate, channels, precision)
+    if wav_data is None:
+        wav_data = sox_concatenate_clips(clips, rate, channels, precision)
+    return wav_data
+
+
+def duration_in_hundredths(signal_info, audio_rate, audio_channels):
+    """Return the duration of an audio file in hundredths of a second
+
+    The 'length' field of the signal info is the total number of
+    samples in the file, summed across all channels.
+    """
+    length_in_seconds = signal_info['length'] / float(audio_rate * audio_channels)
+    return int(length_in_seconds * 100)
+
+
+def probe_signal_info(audio_path):
+    """Return a dict with the 'rate', 'channels', 'precision' and 'length' of an audio file
+
+    Returns None if the file does not exist.  The header of PCM WAV
+    files is parsed directly; all other files are read using SoX.
+    """
+    if not os.path.isfile(audio_path):
+        return None
+    wav_layout = read_wav_layout(audio_path)
+    if wav_layout:
+        return {
+            'rate': wav_layout['rate'],
+            'channels': wav_layout['channels'],
+            'precision': wav_layout['precision'],
+            'length': wav_layout['data_size'] // wav_layout['block_align'] * wav_layout['channels'],
+        }
+    signal_info = pysox.CSoxStream(audio_path).get_signal().get_signalinfo()
+    return {
+        'rate': signal_info['rate'],
+        'channels': signal_info['channels'],
+        'precision': signal_info['precision'],
+        'length': signal_info['length'],
+    }
+
+
+def probe_signal_infos(audio_paths, workers=1):
+    """Return a list with the signal info (or None) for each path in audio_paths
+
+    When workers > 1, the files are probed in parallel by a pool of
+    worker processes.  Reading audio headers is dominated by I/O
+    latency, which can be large for audio files on network storage.
+    """
+    if workers <= 1 or len(audio_paths) <= 1:
+        return [probe_signal_info(audio_path) for audio_path in audio_paths]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(probe_signal_info, audio_paths, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_wav_peaks(audio_path, samples_per_peak_levels):
+    """Return the waveform envelope of an uncompressed WAV file at several zoom levels
+
+    For each samples_per_peak value, returns an array of 16-bit integers
+    with the minimum and maximum sample values (across all channels) of
+    each consecutive block of samples_per_peak frames:
+      [min_0, max_0, min_1, max_1, ...]
+    The samples_per_peak_levels must be in increasing order, and must
+    all be multiples of the first (finest) level.
+    """
+    wav_layout = read_wav_layout(audio_path)
+    if not wav_layout:
+        raise ValueError('"%s" is not an uncompressed WAV file' % audio_path)
+    (typecode, scale) = _sample_typecode_and_scale(wav_layout)
+    block_align = wav_layout['block_align']
+    bytes_per_sample = block_align // wav_layout['channels']
+
+    # The finest level is computed from the sample data, which is read
+    # in chunks containing a whole number of peaks
+    values_per_peak = samples_per_peak_levels[0] * wav_layout['channels']
+    chunk_size = samples_per_peak_levels[0] * block_align * 1024
+    finest_peaks = array(str('h'))
+    with open(audio_path, 'rb') as f:
+        f.seek(wav_layout['data_offset'])
+        remaining = wav_layout['data_size'] - wav_layout['data_size'] % block_align
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            data = data[:len(data) - len(data) % bytes_per_sample]
+            if bytes_per_sample == 3:
+                # Keep the two most significant bytes of each 24-bit sample
+                data = bytearray(data)
+                data16 = bytearray(len(data) // 3 * 2)
+                data16[0::2] = data[1::3]
+                data16[1::2] = data[2::3]
+                data = bytes(data16)
+            samples = array(str(typecode), data)
+            if sys.byteorder == 'big' and samples.itemsize > 1:
+                samples.byteswap()
+            for i in range(0, len(samples), values_per_peak):
+                peak_samples = samples[i:i + values_per_peak]
+                finest_peaks.append(scale(min(peak_samples)))
+                finest_peaks.append(scale(max(peak_samples)))
+
+    # The coarser levels are computed by combining the peaks of the finest level
+    peaks_for_levels = [finest_peaks]
+    finest_minimums = finest_peaks[0::2]
+    finest_maximums = finest_peaks[1::2]
+    for samples_per_peak in samples_per_peak_levels[1:]:
+        peaks_per_peak = samples_per_peak // samples_per_peak_levels[0]
+        peaks = array(str('h'))
+        for i in range(0, len(finest_minimums), peaks_per_peak):
+            peaks.append(min(finest_minimums[i:i + peaks_per_peak]))
+            peaks.append(max(finest_maximums[i:i + peaks_per_peak]))
+        peaks_for_levels.append(peaks)
+    return peaks_for_levels
+
+
+def read_wav_layout(audio_path):
+    """Return a dict describing the format and sample data location of a RIFF/WAV file
+
+    Returns None if the file is not a WAV file with uncompressed
+    (integer PCM or IEEE float) samples.  The dict contains the keys:
+      'format_tag', 'rate', 'channels', 'precision', 'block_align', 'data_offset', 'data_size'
+    where 'data_offset' and 'data_size' are measured in bytes.
+    """
+    with open(audio_path, 'rb') as f:
+        riff_header = f.read(12)
+        if len(riff_header) < 12 or riff_header[0:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+            return None
+
+        wav_layout = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            (chunk_id, chunk_size) = struct.unpack(str('<4sI'), chunk_header)
+
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    return None
+                (format_tag, channels, rate, _, block_align, bits_per_sample) = \
+                    struct.unpack(str('<HHIIHH'), fmt[0:16])
+                precision = bits_per_sample
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    # The first two bytes of the SubFormat GUID are the format tag
+                    (valid_bits_per_sample,) = struct.unpack(str('<H'), fmt[18:20])
+                    (format_tag,) = struct.unpack(str('<H'), fmt[24:26])
+                    if valid_bits_per_sample:
+                        precision = valid_bits_per_sample
+                if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT) or \
+                   channels == 0 or block_align == 0:
+                    return None
+                wav_layout = {
+                    'format_tag': format_tag,
+                    'rate': rate,
+                    'channels': channels,
+                    'precision': precision,
+                    'block_align': block_align,
+                }
+            elif chunk_id == b'data':
+                if not wav_layout:
+                    # The 'fmt ' chunk is required to come before the 'data' chunk
+                    return None
+                wav_layout['data_offset'] = f.tell()
+                # Some programs that write WAV files to a stream leave the
+                # size of the 'data' chunk set to a placeholder value
+                file_size = os.fstat(f.fileno()).st_size
+                wav_layout['data_size'] = min(chunk_size, file_size - wav_layout['data_offset'])
+                return wav_layout
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+
+            # Chunks are padded to an even number of bytes
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+
+def slice_wav_clips(clips, rate, channels, precision):
+    """Return the contents of a WAV file containing the concatenated audio clips
+
+    The sample data for each clip is read directly from the source WAV
+    file, without decoding the rest of the file.  Returns None if any of
+    the source files is not an integer PCM WAV file with the requested
+    rate, channels and precision.
+    """
+    wav_layout_for_path = {}
+    for (audio_path, _, _) in clips:
+        if audio_path not in wav_layout_for_path:
+            try:
+                wav_layout = read_wav_layout(audio_path)
+            except IOError:
+                return None
+            if not wav_layout or \
+               wav_layout['format_tag'] != WAVE_FORMAT_PCM or \
+               wav_layout['rate'] != rate or \
+               wav_layout['channels'] != channels or \
+               wav_layout['precision'] != precision or \
+               wav_layout['block_align'] * 8 != channels * precision:
+                return None
+            wav_layout_for_path[audio_path] = wav_layout
+
+    block_align = channels * precision // 8
+    sample_data = io.BytesIO()
+    for (audio_path, start_offset, duration) in clips:
+        wav_layout = wav_layout_for_path[audio_path]
+        # Round to the nearest frame, the same way the SoX 'trim' effect does
+        start_frame = int(start_offset * rate / 100.0 + 0.5)
+        total_frames = int(duration * rate / 100.0 + 0.5)
+        start_byte = min(start_frame * block_align, wav_layout['data_size'])
+        total_bytes = min(total_frames * block_align, wav_layout['data_size'] - start_byte)
+        with open(audio_path, 'rb') as f:
+            f.seek(wav_layout['data_offset'] + start_byte)
+            sample_data.write(f.read(total_bytes))
+
+    return wav_header(rate, channels, precision, sample_data.tell()) + sample_data.getvalue()
+
+
+def sox_concatenate_clips(clips, rate, channels, precision):
+    """Return the contents of a WAV file containing the concatenated audio clips, extracted using SoX
+    """
+    sox_signal_info = pysox.CSignalInfo(rate, channels, precision)
+
+    # Create a temporary directory
+    tmp_directory = tempfile.mkdtemp()
+    tmp_filename = os.path.join(tmp_directory, 'combined_clips.wav')
+
+    try:
+        # The first argument to CSoxStream must be a filename with a '.wav' extension.
+        #
+        # If the output file does not have a '.wav' extension, pysox will raise
+        # an "IOError: No such file" exception.
+        outfile = pysox.CSoxStream(tmp_filename, 'w', sox_signal_info)
+
+        for (audio_path, start_offset, duration) in clips:
+            START_OFFSET = bytes("%f" % (start_offset / 100.0))
+            DURATION = bytes("%f" % (duration / 100.0))
+            infile = pysox.CSoxStream(audio_path)
+            chain = pysox.CEffectsChain(infile, outfile)
+            chain.add_effect(pysox.CEffect('trim', [START_OFFSET, DURATION]))
+            chain.flow_effects()
+            infile.close()
+
+        outfile.close()
+
+        # Read in audio data from temporary file
+        with open(tmp_filename, 'rb') as f:
+            return f.read()
+    finally:
+        # Clean up temporary files
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def transcode_to_wav(audio_path, wav_path):
+    """Convert an audio file to a WAV file using SoX
+
+    The wav_path must have a '.wav' extension.
+    """
+    infile = pysox.CSoxStream(audio_path)
+    outfile = pysox.CSoxStream(wav_path, 'w', infile.get_signal())
+    chain = pysox.CEffectsChain(infile, outfile)
+    chain.flow_effects()
+    infile.close()
+    outfile.close()
+
+
+def wav_header(rate, channels, precision, data_size):
+    """Return a 44 byte header for an integer PCM WAV file with data_size bytes of sample data
+    """
+    block_align = channels * precision // 8
+    return struct.pack(str('<4sI4s4sIHHIIHH4sI'),
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, WAVE_FORMAT_PCM, channels, rate, rate * block_align, block_align, precision,
+                       b'data', data_size)
+
+
+def _sample_typecode_and_scale(wav_layout):
+    """Return the array typecode for the samples of a WAV file, and a function that scales a sample to 16 bits
+
+    24-bit samples must be converted to 16-bit samples before being
+    stored in an array.
+    """
+    bytes_per_sample = wav_layout['block_align'] // wav_layout['channels']
+    if wav_layout['format_tag'] == WAVE_FORMAT_IEEE_FLOAT:
+        if bytes_per_sample == 4:
+            return ('f', _scale_float_sample)
+        elif bytes_per_sample == 8:
+            return ('d', _scale_float_sample)
+    elif bytes_per_sample == 1:
+        # 8-bit WAV samples are unsigned
+        return ('B', lambda sample: (sample - 128) * 256)
+    elif bytes_per_sample in (2, 3):
+        return ('h', lambda sample: sample)
+    elif bytes_per_sample == 4:
+        return ('i', lambda sample: sample >> 16)
+    raise ValueError('Unsupported WAV sample size of %d bytes' % bytes_per_sample)
+
+
+def _scale_float_sample(sample):
+    return int(max(-1.0, min(sample, 32767 / 32768.0)) * 32768)
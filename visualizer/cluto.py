@@ -0,0 +1,73 @@
+"""Streaming readers for the document clustering files generated by CLUTO
+"""
+from __future__ import unicode_literals
+
+import io
+import re
+
+
+CLUSTER_RE = re.compile(r'Cluster\s+(\d+)')
+FEATURES_RE = re.compile(r'^\s*(Descriptive|Discriminating):(.*)$')
+FEATURE_SCORE_RE = re.compile(r'col(\d+)\s+(\d+\.?\d*)')
+
+
+def read_cluster_features(fname):
+    """Yield a (cluster_index, category, zr_term_index, score) tuple for each non-zero score in a .nfeatures.log file
+
+    The cluster info file is generated by CLUTO, and is a little more complicated
+    than a CSV or TSV file.  Here's the relevant section of the file:
+      --------------------------------------------------------------------------------
+      6-way clustering solution - Descriptive & Discriminating Features...
+      --------------------------------------------------------------------------------
+      Cluster   0, Size:    60, ISim: 0.028, ESim: 0.003
+            Descriptive:  col00275  1.8%, col01183  1.4%, col01187  0.5%, col00356  0.4%, col07504  0.3%
+         Discriminating:  col00275  1.1%, col01183  0.9%, col02735  0.3%, col01187  0.3%, col00356  0.2%
+
+      Cluster   1, Size:    60, ISim: 0.027, ESim: 0.003
+            Descriptive:  col05233  1.8%, col02138  0.8%, col10646  0.6%, col02139  0.6%, col05340  0.4%
+         Discriminating:  col05233  1.2%, col02138  0.5%, col10646  0.4%, col02139  0.4%, col00162  0.3%
+      ...
+      --------------------------------------------------------------------------------
+    The category is either 'Descriptive' or 'Discriminating'.
+    """
+    cluster_index = None
+    for line in _read_lines(fname):
+        features_match = FEATURES_RE.match(line)
+        if features_match and cluster_index is not None:
+            category = features_match.group(1)
+            # Sample score line: '  col05233  1.8%, col02138  0.8%, col10646  0.6%, col02139  0.6%, col05340  0.4%  '
+            for score_string in features_match.group(2).split(','):
+                score_match = FEATURE_SCORE_RE.search(score_string)
+                if score_match:
+                    # zr_term_index is 0-indexed, but 'colXXXX' is 1-indexed
+                    zr_term_index = int(score_match.group(1)) - 1
+                    score = float(score_match.group(2))
+                    if score != 0:
+                        yield (cluster_index, category, zr_term_index, score)
+            continue
+
+        cluster_match = CLUSTER_RE.search(line)
+        if cluster_match:
+            cluster_index = int(cluster_match.group(1))
+
+
+def read_cluster_outputs(fname):
+    """Yield an (audio_identifier, cluster_index) tuple for each line of a cluster.outputs file
+
+    The topic file is a space-separated file WITHOUT a header line, with the format:
+      sw02815_A 0
+      sw02092_A 5
+    """
+    for line in _read_lines(fname):
+        if line.strip():
+            (audio_identifier, cluster_index) = line.split()
+            yield (audio_identifier, int(cluster_index))
+
+
+def _read_lines(fname, encoding='utf-8'):
+    f = io.open(fname, 'r', encoding=encoding)
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()
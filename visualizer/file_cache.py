@@ -0,0 +1,123 @@
+"""A size-bounded, least-recently-used cache of files in a directory
+"""
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+class FileCache(object):
+    """Cache of files stored in a directory, with least-recently-used eviction
+
+    Each cached file is named using a hash of its key.  The modification
+    time of a file is updated whenever the file is read from the cache,
+    and the least recently used files are deleted whenever the total
+    size of the cached files exceeds max_bytes.
+
+    Files are written to a temporary file and then renamed, so multiple
+    server processes can safely share the same cache directory.
+
+    Listing the directory is slow when it holds many files, so the cache
+    keeps a running total of the size of the cached files, and only
+    scans the directory when the total exceeds max_bytes, or when
+    SCAN_INTERVAL seconds have passed since the last scan (to count
+    files added by other processes).
+    """
+    SCAN_INTERVAL = 60
+
+    def __init__(self, directory, max_bytes, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        # Size of the cached files when the directory was last scanned, plus the files added since
+        self._total_bytes = None
+        self._last_scan_time = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the path of the cached file for key, or None if the key is not cached
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + self.suffix)
+
+    def put(self, key, data):
+        """Store data in the cache, and return the path of the cached file
+        """
+        (fd, tmp_path) = self.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self.put_file(key, tmp_path)
+
+    def put_file(self, key, src_path):
+        """Move the file src_path into the cache, and return the path of the cached file
+
+        src_path should be on the same filesystem as the cache directory,
+        e.g. a path returned by mkstemp().
+        """
+        path = self.path_for(key)
+        size = os.path.getsize(src_path)
+        try:
+            replaced_size = os.path.getsize(path)
+        except OSError:
+            replaced_size = 0
+        os.rename(src_path, path)
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size - replaced_size
+            scan = self._total_bytes is None or self._total_bytes > self.max_bytes or \
+                time.time() - self._last_scan_time > self.SCAN_INTERVAL
+        if scan:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Delete the least recently used files until the cache is no larger than max_bytes
+        """
+        entries = []
+        total_bytes = 0
+        for filename in os.listdir(self.directory):
+            if filename.startswith('tmp'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat_result.st_mtime, stat_result.st_size, path))
+            total_bytes += stat_result.st_size
+
+        entries.sort()
+        for (_, size, path) in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+        with self._lock:
+            self._total_bytes = total_bytes
+            self._last_scan_time = time.time()
+
+    def mkstemp(self):
+        """Create a temporary file in the cache directory, and return (fd, path)
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process may have created the directory
+                if not os.path.isdir(self.directory):
+                    raise
+        return tempfile.mkstemp(prefix='tmp', suffix=self.suffix, dir=self.directory)
@@ -1,9 +1,78 @@
-import codecs
+import gzip
+import io
+import multiprocessing
 import os
-import sys
+import shutil
+import tempfile
+import time
 
 from django.core.management.base import BaseCommand, CommandError
-from visualizer.models import Corpus
+from django.db import connection
+from visualizer.models import AudioFragment, Corpus, Document
+
+
+# Number of CTM lines that are formatted before being written to the file
+LINES_PER_WRITE = 10000
+
+
+def _audio_fragments(corpus_id, labeled, first_document_id=None, last_document_id=None):
+    """Return an iterator over the AudioFragments of a Corpus, ordered by Document and start_offset
+
+    Each AudioFragment is a (document_id, start_offset, duration,
+    term_label, zr_term_index) tuple, read using a single query that is
+    joined to the Term table.
+    """
+    audio_fragments = AudioFragment.objects.filter(corpus_id=corpus_id)
+    if first_document_id is not None:
+        audio_fragments = audio_fragments.filter(document_id__gte=first_document_id,
+                                                 document_id__lte=last_document_id)
+    if labeled:
+        audio_fragments = audio_fragments.exclude(term__label='')
+    return audio_fragments.order_by('document_id', 'start_offset') \
+        .values_list('document_id', 'start_offset', 'duration', 'term__label', 'term__zr_term_index') \
+        .iterator()
+
+
+def _export_document_range(args):
+    """Write the CTM lines for a range of Document IDs to a file, in a worker process
+    """
+    (corpus_id, first_document_id, last_document_id, labeled, ctm_file_path, compress) = args
+    audio_identifier_for_document_id = dict(
+        Document.objects.filter(corpus_id=corpus_id, id__range=(first_document_id, last_document_id))
+        .values_list('id', 'audio_identifier'))
+    with _open_ctm_file(ctm_file_path, compress) as ctm_file:
+        return _write_ctm_lines(
+            ctm_file,
+            _audio_fragments(corpus_id, labeled, first_document_id, last_document_id),
+            audio_identifier_for_document_id)
+
+
+def _open_ctm_file(ctm_file_path, compress):
+    if compress:
+        return gzip.open(ctm_file_path, 'wb')
+    return io.open(ctm_file_path, 'wb', buffering=1024 * 1024)
+
+
+def _write_ctm_lines(ctm_file, audio_fragments, audio_identifier_for_document_id):
+    """Write a CTM line for each AudioFragment to a (binary) file, and return the number of lines written
+    """
+    total_lines = 0
+    lines = []
+    for (document_id, start_offset, duration, term_label, zr_term_index) in audio_fragments:
+        if not term_label:
+            term_label = 'T%.4d' % zr_term_index
+        lines.append('%s A %.2f %.2f %s\n' % (audio_identifier_for_document_id[document_id],
+                                              start_offset / 100.0,
+                                              duration / 100.0,
+                                              term_label))
+        if len(lines) == LINES_PER_WRITE:
+            ctm_file.write(''.join(lines).encode('utf-8'))
+            total_lines += len(lines)
+            lines = []
+    ctm_file.write(''.join(lines).encode('utf-8'))
+    total_lines += len(lines)
+    return total_lines
+
 
 class Command(BaseCommand):
     help = 'Export CTM file for an audio corpus'
@@ -13,26 +82,60 @@ class Command(BaseCommand):
         parser.add_argument('ctm_file_path', help='Filename for CTM file')
         parser.add_argument('--labeled', help='Only export terms that have been labeled',
                             action='store_true')
-    
+        parser.add_argument('--gzip', help='Compress the CTM file using gzip',
+                            action='store_true')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to use, each exporting a range of Documents')
+
     def handle(self, *args, **options):
         try:
             corpus = Corpus.objects.get(name=options['corpus_name'])
         except Corpus.DoesNotExist:
-            sys.stderr.write('ERROR: Unable to find corpus named "%s"\n' % options['corpus_name'])
-            return
-
-        ctm_file = codecs.open(options['ctm_file_path'], 'w', encoding='utf-8')
-        for document in corpus.document_set.all()[0:10]:
-            print document.audio_identifier
-            for audio_fragment in document.audiofragment_set.order_by('start_offset'):
-                if not options['labeled'] or audio_fragment.term.label:
-                    if audio_fragment.term.label:
-                        label = audio_fragment.term.label
-                    else:
-                        label = 'T%.4d' % audio_fragment.term.zr_term_index
-                        
-                    ctm_file.write('%s A %.2f %.2f %s\n' % (document.audio_identifier,
-                                                            audio_fragment.start_offset / 100.0,
-                                                            audio_fragment.duration / 100.0,
-                                                            label))
-        ctm_file.close()
+            raise CommandError('Unable to find corpus named "%s"' % options['corpus_name'])
+
+        start_time = time.time()
+
+        document_ids = list(corpus.document_set.order_by('id').values_list('id', flat=True))
+        workers = min(max(options['workers'], 1), len(document_ids))
+        if workers <= 1:
+            audio_identifier_for_document_id = dict(corpus.document_set.values_list('id', 'audio_identifier'))
+            with _open_ctm_file(options['ctm_file_path'], options['gzip']) as ctm_file:
+                total_lines = _write_ctm_lines(ctm_file,
+                                               _audio_fragments(corpus.id, options['labeled']),
+                                               audio_identifier_for_document_id)
+        else:
+            total_lines = self.export_in_parallel(corpus, document_ids, workers, options)
+
+        elapsed_time = time.time() - start_time
+        self.stdout.write('Exported %d audio fragments in %.1f seconds' % (total_lines, elapsed_time))
+
+    def export_in_parallel(self, corpus, document_ids, workers, options):
+        """Export ranges of Documents to separate files using a process pool, then concatenate the files
+
+        Concatenated gzip files are a valid gzip file.
+        """
+        documents_per_worker = (len(document_ids) + workers - 1) // workers
+        tmp_directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(options['ctm_file_path'])))
+        try:
+            jobs = []
+            for (i, first) in enumerate(range(0, len(document_ids), documents_per_worker)):
+                last = min(first + documents_per_worker, len(document_ids)) - 1
+                jobs.append((corpus.id, document_ids[first], document_ids[last], options['labeled'],
+                             os.path.join(tmp_directory, 'part%d.ctm' % i), options['gzip']))
+
+            # Each worker process must open its own database connection
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                total_lines = sum(pool.map(_export_document_range, jobs))
+            finally:
+                pool.close()
+                pool.join()
+
+            with open(options['ctm_file_path'], 'wb') as ctm_file:
+                for job in jobs:
+                    with open(job[4], 'rb') as part_file:
+                        shutil.copyfileobj(part_file, ctm_file, 1024 * 1024)
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        return total_lines
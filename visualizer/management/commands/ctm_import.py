@@ -1,4 +1,5 @@
 import os
+import time
 
 from django.core.management.base import BaseCommand, CommandError
 from visualizer.models import Corpus
@@ -14,16 +15,27 @@ class Command(BaseCommand):
         parser.add_argument('--protect_corpus',
                             help='Restrict access to corpus to authenticated users',
                             action='store_true')
+        parser.add_argument('--probe-workers', type=int, default=1,
+                            help='Number of processes to use when reading audio file headers')
     
     def handle(self, *args, **options):
         if not os.path.isfile(options['ctm_file_path']):
             raise CommandError('Cannot find CTM file "%s"' % options['ctm_file_path'])
 
+        start_time = time.time()
+
         corpus = Corpus()
         corpus.create_from_ctm_file(
             corpus_name=options['corpus_name'],
             ctm_file_path=options['ctm_file_path'],
             audio_directory=options['audio_directory'],
             audio_extension=options['audio_extension'],
-            protect_corpus=options['protect_corpus'])
-        corpus.save()
+            protect_corpus=options['protect_corpus'],
+            probe_workers=options['probe_workers'])
+        # The Corpus was saved while it was being created, and its cache_version was bumped since
+        corpus.refresh_from_db()
+
+        elapsed_time = time.time() - start_time
+        total_rows = corpus.document_set.count() + corpus.total_terms() + corpus.total_audio_fragments()
+        self.stdout.write('Imported %d rows in %.1f seconds (%.0f rows/sec)' % \
+                          (total_rows, elapsed_time, total_rows / max(elapsed_time, 0.001)))
@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from visualizer import cluto
+from visualizer.models import Corpus
+
+
+class Command(BaseCommand):
+    help = 'Import document topics for an audio corpus from the output of the CLUTO clustering toolkit'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus_name', help='Name of audio corpus')
+        parser.add_argument('cluster_outputs_path',
+                            help='Filename for cluster.outputs file, with an audio identifier and cluster index per line')
+        parser.add_argument('--nfeatures', dest='nfeatures_path',
+                            help='Filename for cluster.nfeatures.log file, with the descriptive and ' +
+                            'discriminating terms of each cluster')
+        parser.add_argument('--topic-label', dest='topic_labels', action='append', default=[],
+                            help='Label for a cluster.  Specify once per cluster, in cluster index order.  ' +
+                            'Clusters without a label are named "topicN"')
+
+    def handle(self, *args, **options):
+        try:
+            corpus = Corpus.objects.get(name=options['corpus_name'])
+        except Corpus.DoesNotExist:
+            raise CommandError('Unable to find corpus named "%s"' % options['corpus_name'])
+
+        topic_labels = options['topic_labels']
+
+        def topic_label(cluster_index):
+            if cluster_index < len(topic_labels):
+                return topic_labels[cluster_index]
+            return 'topic%d' % cluster_index
+
+        start_time = time.time()
+
+        document_topic_labels = ((audio_identifier, topic_label(cluster_index))
+                                 for (audio_identifier, cluster_index)
+                                 in cluto.read_cluster_outputs(options['cluster_outputs_path']))
+        document_topic_term_infos = ()
+        if options['nfeatures_path']:
+            document_topic_term_infos = ((topic_label(cluster_index), category, zr_term_index, score)
+                                         for (cluster_index, category, zr_term_index, score)
+                                         in cluto.read_cluster_features(options['nfeatures_path']))
+
+        try:
+            stats = corpus.add_document_topics(document_topic_labels, document_topic_term_infos)
+        except (IOError, ValueError) as e:
+            raise CommandError('Unable to import topics: %s' % e)
+
+        elapsed_time = time.time() - start_time
+        self.stdout.write('Added %d document topics, %d document assignments and %d term scores in %.1f seconds' % \
+                          (stats['document_topics'], stats['document_topic_documents'],
+                           stats['document_topic_term_infos'], elapsed_time))
+        if stats['unknown_documents'] or stats['unknown_terms']:
+            self.stdout.write('Skipped %d unknown audio identifiers and %d unknown terms' % \
+                              (stats['unknown_documents'], stats['unknown_terms']))
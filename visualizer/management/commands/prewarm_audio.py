@@ -0,0 +1,56 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from visualizer.models import Corpus, Document
+
+
+def _transcode_audio(audio_path):
+    try:
+        Document.transcode_audio(audio_path)
+        return (audio_path, None)
+    except Exception as e:
+        return (audio_path, str(e))
+
+
+class Command(BaseCommand):
+    help = 'Convert the non-WAV audio files for a corpus to WAV files in the document audio cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus_name', help='Name of audio corpus')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='Number of processes to use when converting audio files')
+
+    def handle(self, *args, **options):
+        try:
+            corpus = Corpus.objects.get(name=options['corpus_name'])
+        except Corpus.DoesNotExist:
+            raise CommandError('Cannot find corpus "%s"' % options['corpus_name'])
+
+        audio_paths = [document.audio_path
+                       for document in corpus.document_set.only('audio_path').order_by('document_index')
+                       if not document.is_wav()]
+        if not audio_paths:
+            self.stdout.write('Corpus "%s" has no non-WAV audio files' % corpus.name)
+            return
+
+        start_time = time.time()
+
+        # The worker processes don't use the database, and must not
+        # share the parent process's database connection
+        connection.close()
+        pool = multiprocessing.Pool(max(options['workers'], 1))
+        try:
+            total_errors = 0
+            for (audio_path, error) in pool.imap_unordered(_transcode_audio, audio_paths):
+                if error:
+                    total_errors += 1
+                    self.stderr.write('Unable to convert "%s": %s' % (audio_path, error))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed_time = time.time() - start_time
+        self.stdout.write('Converted %d audio files in %.1f seconds (%d errors)' % \
+                          (len(audio_paths), elapsed_time, total_errors))
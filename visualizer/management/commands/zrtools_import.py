@@ -1,8 +1,8 @@
 import os
+import time
 
 from django.core.management.base import BaseCommand, CommandError
-import pysox
-from visualizer.models import Corpus
+from visualizer.models import AudioSignalInfo, Corpus
 
 class Command(BaseCommand):
     help = 'Import ZRTools output for an audio corpus'
@@ -19,6 +19,11 @@ class Command(BaseCommand):
         parser.add_argument('--protect_corpus',
                             help='Restrict access to corpus to authenticated users',
                             action='store_true')
+        parser.add_argument('--update',
+                            help='Update an existing corpus, keeping Term labels, instead of creating a new corpus',
+                            action='store_true')
+        parser.add_argument('--probe-workers', type=int, default=1,
+                            help='Number of processes to use when reading audio file headers')
     
     def handle(self, *args, **options):
         audiofragments_path = os.path.join(options['corpus_path'], 'matches/master_graph.nodes')
@@ -43,11 +48,29 @@ class Command(BaseCommand):
                                (first_audio_filename, filenames_path))
 
         try:
-            audio = pysox.CSoxStream(first_audio_filename)
+            signal_info = AudioSignalInfo.lookup([first_audio_filename])[0]
         except IOError as e:
             raise CommandError('Unable to read audio data from file "%s": %s' % \
                                (first_audio_filename, e))
-        signal_info = audio.get_signal().get_signalinfo()
+
+        start_time = time.time()
+
+        if options['update']:
+            try:
+                corpus = Corpus.objects.get(name=options['corpus_name'])
+            except Corpus.DoesNotExist:
+                raise CommandError('Unable to find corpus named "%s"' % options['corpus_name'])
+            stats = corpus.update_from_zr_output(
+                audiofragments=audiofragments_path,
+                clusters=clusters_path,
+                filenames=filenames_path,
+                audio_directory=options['audio_directory'],
+                audio_extension=options['audio_extension'],
+                probe_workers=options['probe_workers'])
+            for key in sorted(stats):
+                self.stdout.write('%s: %d' % (key, stats[key]))
+            self.stdout.write('Updated corpus in %.1f seconds' % (time.time() - start_time))
+            return
 
         corpus = Corpus()
         corpus.create_from_zr_output(
@@ -60,5 +83,12 @@ class Command(BaseCommand):
             audio_precision=signal_info['precision'],
             audio_directory=options['audio_directory'],
             audio_extension=options['audio_extension'],
-            protect_corpus=options['protect_corpus'])
-        corpus.save()
+            protect_corpus=options['protect_corpus'],
+            probe_workers=options['probe_workers'])
+        # The Corpus was saved while it was being created, and its cache_version was bumped since
+        corpus.refresh_from_db()
+
+        elapsed_time = time.time() - start_time
+        total_rows = corpus.document_set.count() + corpus.total_terms() + corpus.total_audio_fragments()
+        self.stdout.write('Imported %d rows in %.1f seconds (%.0f rows/sec)' % \
+                          (total_rows, elapsed_time, total_rows / max(elapsed_time, 0.001)))
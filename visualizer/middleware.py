@@ -0,0 +1,16 @@
+"""Middleware for the VaporEngine visualizer
+"""
+from django.middleware.gzip import GZipMiddleware as DjangoGZipMiddleware
+
+
+class GZipMiddleware(DjangoGZipMiddleware):
+    """Django's GZipMiddleware, except that responses with a true gzip_exempt attribute are not compressed
+
+    Views set response.gzip_exempt for byte range responses, whose
+    Content-Length and Content-Range headers refer to the uncompressed
+    bytes, and for responses that are already compressed.
+    """
+    def process_response(self, request, response):
+        if getattr(response, 'gzip_exempt', False):
+            return response
+        return super(GZipMiddleware, self).process_response(request, response)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioSignalInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('rate', models.IntegerField()),
+                ('channels', models.IntegerField()),
+                ('precision', models.IntegerField()),
+                ('length', models.BigIntegerField()),
+            ],
+        ),
+    ]
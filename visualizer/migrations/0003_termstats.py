@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import json
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def populate_term_stats(apps, schema_editor):
+    AudioFragment = apps.get_model('visualizer', 'AudioFragment')
+    Corpus = apps.get_model('visualizer', 'Corpus')
+    TermStats = apps.get_model('visualizer', 'TermStats')
+
+    for corpus in Corpus.objects.all():
+        audio_fragment_ids_for_term_id = collections.defaultdict(list)
+        for (term_id, audio_fragment_id) in AudioFragment.objects.filter(term__corpus=corpus) \
+                .order_by('id').values_list('term_id', 'id').iterator():
+            audio_fragment_ids_for_term_id[term_id].append(audio_fragment_id)
+
+        term_counts = corpus.term_set.annotate(Count('audiofragment'), Count('audiofragment__document', distinct=True)) \
+                                     .values_list('id', 'audiofragment__count', 'audiofragment__document__count')
+        TermStats.objects.bulk_create([
+            TermStats(corpus=corpus, term_id=term_id,
+                      total_audio_fragments=total_audio_fragments,
+                      total_documents=total_documents,
+                      audio_fragment_ids=json.dumps(audio_fragment_ids_for_term_id[term_id]))
+            for (term_id, total_audio_fragments, total_documents) in term_counts
+        ], batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0002_audiosignalinfo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_audio_fragments', models.IntegerField()),
+                ('total_documents', models.IntegerField()),
+                ('audio_fragment_ids', models.TextField()),
+                ('corpus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Corpus')),
+                ('term', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Term')),
+            ],
+        ),
+        migrations.RunPython(populate_term_stats, migrations.RunPython.noop),
+    ]
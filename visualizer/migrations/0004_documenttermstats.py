@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import math
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+import django.db.models.deletion
+
+
+def populate_document_term_stats(apps, schema_editor):
+    AudioFragment = apps.get_model('visualizer', 'AudioFragment')
+    Corpus = apps.get_model('visualizer', 'Corpus')
+    DocumentTermStats = apps.get_model('visualizer', 'DocumentTermStats')
+    TermStats = apps.get_model('visualizer', 'TermStats')
+
+    for corpus in Corpus.objects.all():
+        total_documents = corpus.document_set.count()
+        # The IDF only depends on the number of Documents with the Term, so
+        # the TermStats are updated with one query per distinct number
+        term_stats = TermStats.objects.filter(corpus=corpus)
+        for total_documents_for_term in term_stats.order_by().values_list('total_documents', flat=True).distinct():
+            term_stats.filter(total_documents=total_documents_for_term) \
+                .update(idf=math.log(total_documents / (1.0 + total_documents_for_term)))
+
+        document_term_counts = AudioFragment.objects.filter(term__corpus=corpus).values('document_id', 'term_id') \
+            .annotate(Count('id'), Min('start_offset')).values_list('document_id', 'term_id', 'id__count', 'start_offset__min')
+        DocumentTermStats.objects.bulk_create([
+            DocumentTermStats(document_id=document_id, term_id=term_id,
+                              total_audio_fragments_in_document=total_audio_fragments_in_document,
+                              first_start_offset=first_start_offset)
+            for (document_id, term_id, total_audio_fragments_in_document, first_start_offset) in document_term_counts
+        ], batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0003_termstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='termstats',
+            name='idf',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.CreateModel(
+            name='DocumentTermStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_audio_fragments_in_document', models.IntegerField()),
+                ('first_start_offset', models.IntegerField()),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Document')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Term')),
+            ],
+        ),
+        migrations.RunPython(populate_document_term_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0004_documenttermstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='corpus',
+            name='cache_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
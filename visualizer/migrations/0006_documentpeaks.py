@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0005_corpus_cache_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentPeaks',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rate', models.IntegerField()),
+                ('samples_per_peak', models.IntegerField()),
+                ('peaks', models.BinaryField()),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Document')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='documentpeaks',
+            unique_together=set([('document', 'samples_per_peak')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0006_documentpeaks'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='audiofragment',
+            index_together=set([('term', 'document', 'start_offset'), ('term', 'duration'), ('term', 'score')]),
+        ),
+    ]
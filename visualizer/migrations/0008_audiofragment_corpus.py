@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_audio_fragment_corpus(apps, schema_editor):
+    AudioFragment = apps.get_model('visualizer', 'AudioFragment')
+    Corpus = apps.get_model('visualizer', 'Corpus')
+
+    for corpus in Corpus.objects.all():
+        AudioFragment.objects.filter(document__corpus=corpus).update(corpus=corpus)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0007_audiofragment_term_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofragment',
+            name='corpus',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='visualizer.Corpus'),
+        ),
+        migrations.RunPython(populate_audio_fragment_corpus, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='audiofragment',
+            name='corpus',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visualizer.Corpus'),
+        ),
+        migrations.AlterIndexTogether(
+            name='audiofragment',
+            index_together=set([('term', 'document', 'start_offset'), ('term', 'duration'), ('term', 'score'),
+                                ('document', 'start_offset'), ('document', 'term'), ('corpus', 'term')]),
+        ),
+    ]
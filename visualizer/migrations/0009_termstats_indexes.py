@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0008_audiofragment_corpus'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='termstats',
+            index_together=set([('corpus', 'total_documents'), ('corpus', 'total_audio_fragments')]),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# The FTS5 index table, indexed table and indexed field for each searchable model
+SEARCH_INDEX_TABLES = [
+    ('visualizer_document_search', 'visualizer_document', 'audio_identifier'),
+    ('visualizer_term_search', 'visualizer_term', 'label'),
+]
+
+
+def fts5_tokenizer(cursor):
+    """Return the best available FTS5 tokenizer, or None if SQLite was built without FTS5
+    """
+    for tokenizer in ('trigram', 'unicode61'):
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.visualizer_fts5_check USING fts5(x, tokenize='%s')" % tokenizer)
+            cursor.execute("DROP TABLE temp.visualizer_fts5_check")
+            return tokenizer
+        except Exception:
+            pass
+    return None
+
+
+def create_search_index(apps, schema_editor):
+    """Create FTS5 index tables for Term labels and Document audio identifiers
+
+    The index tables are 'external content' tables that store only the
+    index, and are kept in sync with the indexed tables by triggers.
+    Migrations that rebuild the indexed tables (which SQLite does for
+    most ALTER TABLE operations) drop the triggers, so the triggers are
+    recreated after every migrate by visualizer.search.create_search_index_triggers().
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    cursor = schema_editor.connection.cursor()
+    tokenizer = fts5_tokenizer(cursor)
+    if tokenizer is None:
+        return
+
+    for (search_table, table, field) in SEARCH_INDEX_TABLES:
+        names = {'search_table': search_table, 'table': table, 'field': field, 'tokenizer': tokenizer}
+        cursor.execute("""
+            CREATE VIRTUAL TABLE %(search_table)s
+            USING fts5(%(field)s, content='%(table)s', content_rowid='id', tokenize='%(tokenizer)s')
+        """ % names)
+        cursor.execute("""
+            CREATE TRIGGER %(search_table)s_insert AFTER INSERT ON %(table)s BEGIN
+              INSERT INTO %(search_table)s(rowid, %(field)s) VALUES (new.id, new.%(field)s);
+            END
+        """ % names)
+        cursor.execute("""
+            CREATE TRIGGER %(search_table)s_delete AFTER DELETE ON %(table)s BEGIN
+              INSERT INTO %(search_table)s(%(search_table)s, rowid, %(field)s) VALUES ('delete', old.id, old.%(field)s);
+            END
+        """ % names)
+        cursor.execute("""
+            CREATE TRIGGER %(search_table)s_update AFTER UPDATE OF %(field)s ON %(table)s BEGIN
+              INSERT INTO %(search_table)s(%(search_table)s, rowid, %(field)s) VALUES ('delete', old.id, old.%(field)s);
+              INSERT INTO %(search_table)s(rowid, %(field)s) VALUES (new.id, new.%(field)s);
+            END
+        """ % names)
+        # Index the existing rows
+        cursor.execute("INSERT INTO %(search_table)s(%(search_table)s) VALUES ('rebuild')" % names)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    cursor = schema_editor.connection.cursor()
+    for (search_table, _, _) in SEARCH_INDEX_TABLES:
+        for trigger in ('insert', 'delete', 'update'):
+            cursor.execute("DROP TRIGGER IF EXISTS %s_%s" % (search_table, trigger))
+        cursor.execute("DROP TABLE IF EXISTS %s" % search_table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0009_termstats_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0011_corpus_cache_version_not_editable'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='term',
+            index_together=set([('corpus', 'label', 'zr_term_index')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0012_term_label_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='audiofragment',
+            name='corpus',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='visualizer.Corpus'),
+        ),
+        migrations.AlterField(
+            model_name='audiofragment',
+            name='document',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='visualizer.Document'),
+        ),
+        migrations.AlterField(
+            model_name='audiofragment',
+            name='term',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='visualizer.Term'),
+        ),
+    ]
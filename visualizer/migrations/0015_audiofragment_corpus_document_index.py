@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visualizer', '0014_audiofragment_term_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='audiofragment',
+            index_together=set([('term', 'id'), ('term', 'document', 'start_offset'), ('term', 'duration'),
+                                ('term', 'score'), ('document', 'start_offset'), ('document', 'term'),
+                                ('corpus', 'document', 'start_offset')]),
+        ),
+    ]
@@ -1,21 +1,51 @@
 from __future__ import unicode_literals
 
-import io
+from array import array
+import collections
+import hashlib
+import json
 import logging
+import math
 import os
 import os.path
+import sys
+import threading
 
-from django.db import connection, models
-from django.db.models import Sum
-import pysox
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Count, F, Max, Min, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from visualizer import audio, zrtools
+from visualizer.file_cache import FileCache
+
+
+# WAV versions of non-WAV Document audio files
+document_audio_cache = FileCache(os.path.join(settings.CACHE_DIR, 'document_audio'),
+                                 settings.DOCUMENT_AUDIO_CACHE_MAX_BYTES, suffix='.wav')
+
+# Keys of the background jobs that are running in this server process
+_background_jobs = set()
+_background_jobs_lock = threading.Lock()
+
+# Number of seconds that the failure of a background job is remembered.
+# Until then, requests that need the result of the job fail instead of
+# waiting for it, and after that the job is started again.
+BACKGROUND_JOB_FAILURE_TIMEOUT = 5 * 60
 
 
 class AudioFragment(models.Model):
     """An AudioFragment is a segment of an audio Document that may be (but
     is not necessarily) associated with a Term
     """
-    document = models.ForeignKey('Document')
-    term = models.ForeignKey('Term')
+    # The foreign keys are not indexed on their own, because each of them
+    # is the first column of one of the index_together indexes below
+    document = models.ForeignKey('Document', db_index=False)
+    term = models.ForeignKey('Term', db_index=False)
+    # Denormalized copy of document.corpus, so that the AudioFragments
+    # for a Corpus can be read without joining the Document table
+    corpus = models.ForeignKey('Corpus', db_index=False)
 
     # Index generated by ZRTools for this audio fragment  (Old name for this variable was 'zr_pt_id')
     zr_fragment_index = models.IntegerField(db_index=True)
@@ -27,6 +57,100 @@ class AudioFragment(models.Model):
 
     score = models.FloatField()
 
+    class Meta:
+        index_together = [
+            # Reading the AudioFragments of a Term in different orders,
+            # including ID order (the default)
+            ('term', 'id'),
+            ('term', 'document', 'start_offset'),
+            ('term', 'duration'),
+            ('term', 'score'),
+            # Reading the AudioFragments or Terms of a Document
+            ('document', 'start_offset'),
+            ('document', 'term'),
+            # Reading the AudioFragments of a Corpus in Document order, for the CTM export
+            ('corpus', 'document', 'start_offset'),
+        ]
+
+class AudioSignalInfo(models.Model):
+    """Cached signal info for an audio file
+
+    Reading the header of an audio file can be slow, particularly for
+    audio files on network storage.  Signal info is cached using the
+    absolute path, size and modification time of the file as the key,
+    so re-importing a corpus does not need to re-read the headers of
+    audio files that have not changed.
+    """
+    path = models.TextField(unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+
+    rate = models.IntegerField()
+    channels = models.IntegerField()
+    precision = models.IntegerField()
+    # Total number of samples in the file, summed across all channels
+    length = models.BigIntegerField()
+
+    @staticmethod
+    def lookup(audio_paths, probe_workers=1):
+        """Return a list with the signal info (or None) for each path in audio_paths
+
+        The headers of audio files that are not in the cache, or that
+        have changed since they were cached, are read using
+        audio.probe_signal_infos() and added to the cache.
+        """
+        absolute_paths = [os.path.abspath(audio_path) for audio_path in audio_paths]
+
+        stat_for_path = {}
+        for absolute_path in absolute_paths:
+            try:
+                stat_result = os.stat(absolute_path)
+                stat_for_path[absolute_path] = (stat_result.st_size, stat_result.st_mtime)
+            except OSError:
+                pass
+
+        signal_info_for_path = {}
+        existing_paths = list(stat_for_path.keys())
+        for paths_chunk in _chunks(existing_paths):
+            for cached in AudioSignalInfo.objects.filter(path__in=paths_chunk):
+                if stat_for_path[cached.path] == (cached.size, cached.mtime):
+                    signal_info_for_path[cached.path] = cached.signal_info()
+
+        uncached_paths = [path for path in existing_paths if path not in signal_info_for_path]
+        if uncached_paths:
+            probed_signal_infos = audio.probe_signal_infos(uncached_paths, probe_workers)
+            cache_entries = []
+            for (path, signal_info) in zip(uncached_paths, probed_signal_infos):
+                if not signal_info:
+                    continue
+                signal_info_for_path[path] = signal_info
+                cache_entries.append(AudioSignalInfo(
+                    path=path,
+                    size=stat_for_path[path][0],
+                    mtime=stat_for_path[path][1],
+                    rate=signal_info['rate'],
+                    channels=signal_info['channels'],
+                    precision=signal_info['precision'],
+                    length=signal_info['length']))
+            with transaction.atomic():
+                for paths_chunk in _chunks(uncached_paths):
+                    AudioSignalInfo.objects.filter(path__in=paths_chunk).delete()
+                AudioSignalInfo.objects.bulk_create(cache_entries, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+
+        return [signal_info_for_path.get(absolute_path) for absolute_path in absolute_paths]
+
+    def signal_info(self):
+        return {
+            'rate': self.rate,
+            'channels': self.channels,
+            'precision': self.precision,
+            'length': self.length,
+        }
+
+class BackgroundJobError(Exception):
+    """Raised when the result of a background job is needed, but the job recently failed
+    """
+
 class Corpus(models.Model):
     """
     """
@@ -37,14 +161,99 @@ class Corpus(models.Model):
 
     protected_corpus = models.BooleanField(default=False)
 
-    OBJECTS_PER_BULK_OPERATION = 1000
+    # Incremented whenever data shown in the wordclouds changes, so that
+    # cached responses for the Corpus are no longer used.  Only changed
+    # by bump_cache_version(), and never written by save().
+    cache_version = models.IntegerField(default=0, editable=False)
+
+    OBJECTS_PER_BULK_OPERATION = 10000
 
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Saving a Corpus instance that was loaded before the last call to
+        # bump_cache_version() must not move cache_version backwards
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'cache_version']
+        super(Corpus, self).save(*args, **kwargs)
+
+    def add_document_topics(self, document_topic_labels, document_topic_term_infos=()):
+        """Assign Documents to DocumentTopics, and add DocumentTopicTermInfo for the DocumentTopics
+
+        document_topic_labels is an iterable of (audio_identifier, label)
+        tuples, and document_topic_term_infos is an iterable of (label,
+        category, zr_term_index, score) tuples.  DocumentTopics are
+        created as needed.
+
+        The Documents, Terms and DocumentTopics of the Corpus are looked
+        up using dictionaries that are populated once, and all of the new
+        rows are inserted using bulk inserts in a single transaction.
+        Returns a Counter with the number of rows added and skipped.
+        """
+        stats = collections.Counter()
+        DocumentTopicDocument = DocumentTopic.documents.through
+
+        with transaction.atomic():
+            document_id_for_audio_identifier = dict(self.document_set.values_list('audio_identifier', 'id'))
+            term_id_for_zr_term_index = dict(self.term_set.values_list('zr_term_index', 'id'))
+            document_topic_id_for_label = dict(self.documenttopic_set.values_list('label', 'id'))
+
+            def document_topic_id(label):
+                if label not in document_topic_id_for_label:
+                    document_topic_id_for_label[label] = DocumentTopic.objects.create(corpus=self, label=label).id
+                    stats['document_topics'] += 1
+                return document_topic_id_for_label[label]
+
+            # Like DocumentTopic.documents.add(), skip Documents that are already assigned to a DocumentTopic
+            existing_pairs = set(DocumentTopicDocument.objects.filter(documenttopic__corpus=self)
+                                 .values_list('documenttopic_id', 'document_id'))
+            document_topic_documents = []
+            for (audio_identifier, label) in document_topic_labels:
+                document_id = document_id_for_audio_identifier.get(audio_identifier)
+                if document_id is None:
+                    logging.warning("Unable to find document with audio identifier '%s'" % audio_identifier)
+                    stats['unknown_documents'] += 1
+                    continue
+                pair = (document_topic_id(label), document_id)
+                if pair not in existing_pairs:
+                    existing_pairs.add(pair)
+                    document_topic_documents.append(
+                        DocumentTopicDocument(documenttopic_id=pair[0], document_id=pair[1]))
+            DocumentTopicDocument.objects.bulk_create(document_topic_documents,
+                                                      batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+            stats['document_topic_documents'] = len(document_topic_documents)
+
+            document_topic_term_infos_for_bulk_commit = []
+            for (label, category, zr_term_index, score) in document_topic_term_infos:
+                term_id = term_id_for_zr_term_index.get(zr_term_index)
+                if term_id is None:
+                    logging.warning("Unable to find term with zr_term_index %d" % zr_term_index)
+                    stats['unknown_terms'] += 1
+                    continue
+                document_topic_term_infos_for_bulk_commit.append(
+                    DocumentTopicTermInfo(document_topic_id=document_topic_id(label), term_id=term_id,
+                                          category=category, score=score))
+            DocumentTopicTermInfo.objects.bulk_create(document_topic_term_infos_for_bulk_commit,
+                                                      batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+            stats['document_topic_term_infos'] = len(document_topic_term_infos_for_bulk_commit)
+
+        Corpus.bump_cache_version(self.id)
+        return stats
+
+    @staticmethod
+    def bump_cache_version(corpus_id):
+        Corpus.objects.filter(id=corpus_id).update(cache_version=F('cache_version') + 1)
+
     def create_from_ctm_file(self, corpus_name, ctm_file_path, audio_directory, audio_extension,
-                             protect_corpus=False):
+                             protect_corpus=False, probe_workers=1):
         """Create a corpus from a CTM file and associated audio files
+
+        The CTM file is read twice.  The first pass collects the audio
+        identifiers and keywords, so that all Documents and Terms can
+        be created using bulk operations.  The second pass creates the
+        AudioFragments.
         """
         # When using SQLite on a hard disk, disabling synchronous writes
         # on corpus creation increases ingest speed by up to x50.
@@ -56,95 +265,83 @@ class Corpus(models.Model):
 
         self.protected_corpus = protect_corpus
 
-        ctm_file = open(ctm_file_path, "r")
-
-        document_for_audio_identifier = {}
-        term_for_keyword = {}
-        zr_fragment_index = 0
+        audio_identifiers = []
+        keywords = []
+        seen_audio_identifiers = set()
+        seen_keywords = set()
+        for (audio_identifier, start_offset, duration, keyword) in _read_ctm_file(ctm_file_path):
+            if audio_identifier not in seen_audio_identifiers:
+                seen_audio_identifiers.add(audio_identifier)
+                audio_identifiers.append(audio_identifier)
+            if keyword not in seen_keywords:
+                seen_keywords.add(keyword)
+                keywords.append(keyword)
+
+        # Set Corpus audio signal info from the first audio document
+        if audio_identifiers:
+            first_audio_path = os.path.join(audio_directory, audio_identifiers[0] + "." + audio_extension)
+            signal_info = AudioSignalInfo.lookup([first_audio_path])[0]
+            if not signal_info:
+                raise IOError("No such file: '%s'" % first_audio_path)
+            self.audio_rate = signal_info['rate']
+            self.audio_channels = signal_info['channels']
+            self.audio_precision = signal_info['precision']
+            self.save()
+
+        documents = []
+        for (document_index, audio_identifier) in enumerate(audio_identifiers):
+            document = Document()
+            document.corpus = self
+            document.document_index = document_index
+            document.audio_path = os.path.join(audio_directory, audio_identifier + "." + audio_extension)
+            document.audio_identifier = audio_identifier
+            documents.append(document)
 
-        audio_fragments_for_bulk_commit = []
+        self._probe_document_durations(documents, probe_workers)
+        Document.objects.bulk_create(documents, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
 
-        for line in ctm_file:
-            if not line.strip():
-                # Ignore blank lines
-                continue
-            if line.strip()[0:2] == ';;':
-                # Ignore comments
-                continue
-            fields = line.split()
-            if len(fields) != 5 and len(fields) != 6:
-                logging.warning("Expected line of CTM file to have 5 or 6 fields, but found %d fields. Line: '%s'" % \
-                                (len(fields), line.split()))
-            audio_identifier = fields[0]
-            start_offset = int(float(fields[2]) * 100)
-            duration = int(float(fields[3]) * 100)
-            keyword = fields[4]
-            audio_path = os.path.join(audio_directory, audio_identifier + "." + audio_extension)
-            if not os.path.isfile(audio_path):
-                logging.warning("Unable to find audio file with path '%s'" % audio_path)
-
-            if not audio_identifier in document_for_audio_identifier:
-                # Set Corpus audio signal info from the first audio document
-                if len(document_for_audio_identifier) == 0:
-                    audio = pysox.CSoxStream(audio_path)
-                    signal_info = audio.get_signal().get_signalinfo()
-                    self.audio_rate = signal_info['rate']
-                    self.audio_channels = signal_info['channels']
-                    self.audio_precision = signal_info['precision']
-                    self.save()
-
-                document = Document()
-                document.corpus = self
-                document.document_index = len(document_for_audio_identifier)
-                document.audio_path = audio_path
-                document.audio_identifier = audio_identifier
-
-                if os.path.isfile(document.audio_path):
-                    si = pysox.CSoxStream(document.audio_path).get_signal().get_signalinfo()
-                    length_in_seconds = si['length'] / float(self.audio_rate * self.audio_channels)
-                    document.duration = int(length_in_seconds * 100)
-                else:
-                    document.duration = 0
-                    logging.warning("Unable to find audio file with path '%s'" % document.audio_path)
+        terms = []
+        for (term_index, keyword) in enumerate(keywords):
+            term = Term()
+            term.corpus = self
+            term.label = keyword
+            term.zr_term_index = term_index
+            terms.append(term)
+        Term.objects.bulk_create(terms, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
 
-                document.save()
-                document_for_audio_identifier[document.audio_identifier] = document
-            else:
-                document = document_for_audio_identifier[audio_identifier]
-
-            if not keyword in term_for_keyword:
-                term = Term()
-                term.corpus = self
-                term.label = keyword
-                term.zr_term_index = len(term_for_keyword)
-                term.save()
-                term_for_keyword[keyword] = term
-            else:
-                term = term_for_keyword[keyword]
+        # bulk_create() does not set the primary keys of the new instances
+        # when using SQLite, so we read the IDs back using a single query.
+        document_id_for_audio_identifier = dict(self.document_set.values_list('audio_identifier', 'id'))
+        term_id_for_term_index = dict(self.term_set.values_list('zr_term_index', 'id'))
+        term_id_for_keyword = {}
+        for (term_index, keyword) in enumerate(keywords):
+            term_id_for_keyword[keyword] = term_id_for_term_index[term_index]
 
+        audio_fragments_for_bulk_commit = []
+        for (zr_fragment_index, (audio_identifier, start_offset, duration, keyword)) in \
+                enumerate(_read_ctm_file(ctm_file_path)):
             audio_fragment = AudioFragment()
-            audio_fragment.document = document
-            audio_fragment.term = term
+            audio_fragment.corpus = self
+            audio_fragment.document_id = document_id_for_audio_identifier[audio_identifier]
+            audio_fragment.term_id = term_id_for_keyword[keyword]
             audio_fragment.zr_fragment_index = zr_fragment_index
             audio_fragment.start_offset = start_offset
             audio_fragment.end_offset = start_offset + duration
             audio_fragment.duration = duration
             audio_fragment.score = 0
 
-            zr_fragment_index += 1
-
             audio_fragments_for_bulk_commit.append(audio_fragment)
-            if len(audio_fragments_for_bulk_commit) % Corpus.OBJECTS_PER_BULK_OPERATION == 0:
+            if len(audio_fragments_for_bulk_commit) == Corpus.OBJECTS_PER_BULK_OPERATION:
                 AudioFragment.objects.bulk_create(audio_fragments_for_bulk_commit)
                 audio_fragments_for_bulk_commit = []
-
         AudioFragment.objects.bulk_create(audio_fragments_for_bulk_commit)
-        ctm_file.close()
+
+        self.update_term_stats()
 
     def create_from_zr_output(self, corpus_name, audiofragments, clusters, filenames,
                               audio_rate, audio_channels, audio_precision,
                               audio_directory=None, audio_extension=None,
-                              protect_corpus=False):
+                              protect_corpus=False, probe_workers=1):
         """
         """
         # "Documentation" from Aren via Glen
@@ -181,72 +378,261 @@ class Corpus(models.Model):
         # The 'filenames' file is a text file listing the paths the audio Documents:
         #   /Users/charman/zr_datasets/BUCKEYE/s38/s3802a.wav
         #   /Users/charman/zr_datasets/BUCKEYE/s38/s3802b.wav
-        document_for_audio_identifier = {}
-        full_filenames = _slurp(filenames)
-        for (document_index, full_filename) in enumerate(full_filenames):
-            basename = os.path.splitext(os.path.basename(full_filename))[0].strip()
-
+        documents = []
+        for (document_index, audio_identifier, audio_path) in \
+                zrtools.read_filenames(filenames, audio_directory, audio_extension):
             document = Document()
             document.corpus = self
             document.document_index = document_index
-            document.audio_identifier = basename
-            if audio_directory:
-                document.audio_path = os.path.join(audio_directory, os.path.basename(full_filename)).strip()
-            else:
-                document.audio_path = full_filename.strip()
-            if audio_extension:
-                document.audio_path += "." + audio_extension
-
-            if os.path.isfile(document.audio_path):
-                si = pysox.CSoxStream(document.audio_path).get_signal().get_signalinfo()
-                length_in_seconds = si['length'] / float(audio_rate * audio_channels)
-                document.duration = int(length_in_seconds * 100)
-                if document.duration == 0:
-                    logging.warning("Audio file '%s' has length 0" % document.audio_path)
-            else:
-                document.duration = 0
-                logging.warning("Unable to find audio file with path '%s'" % document.audio_path)
-
-            document.save()
-
-            document_for_audio_identifier[document.audio_identifier] = document
-
-        # The 'clusters' file is a text file, where each line of the file
-        # specifies the AudioFragments for a Term.  AudioFragments are
-        # identified by the line number in the audiofragments file, where
-        # the first line of the file is 0 and *not* 1:
-        #   13 14
-        #   15 16 51 52
-        #   17 18 30855 30856 68607 68608 130351 130352 164607 164608 164611 164612
-        cluster_lines = _slurp(clusters)
-        term_for_audio_fragment_index = {}
-        for (term_index, cluster_line) in enumerate(cluster_lines):
+            document.audio_identifier = audio_identifier
+            document.audio_path = audio_path
+            documents.append(document)
+        self._probe_document_durations(documents, probe_workers)
+        Document.objects.bulk_create(documents, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+
+        # bulk_create() does not set the primary keys of the new instances
+        # when using SQLite, so we read the IDs back using a single query.
+        document_id_for_audio_identifier = dict(self.document_set.values_list('audio_identifier', 'id'))
+
+        # Each line of the 'clusters' file specifies the AudioFragments for
+        # a Term.  The mapping from AudioFragment (node) index to Term index
+        # is stored in a compact array instead of a dict, because a corpus
+        # can have millions of AudioFragments.
+        term_index_for_audio_fragment_index = zrtools.read_term_index_for_nodes(clusters)
+        terms_for_bulk_commit = []
+        for (term_index, _) in zrtools.read_clusters(clusters):
             term = Term()
             term.corpus = self
             term.label = ''
             term.zr_term_index = term_index
-            term.save()
-            for audio_fragment_index in cluster_line.split():
-                # TODO: Verify that audio_fragment_index hasn't been associated with another term
-                term_for_audio_fragment_index[int(audio_fragment_index)] = term
-
-        # The 'audiofragments' file is a TSV file with six fields:
-        #   s3802b  55028   55087   0.911181        23.175030       896
-        #   s3802b  55085   55144   0.911181        23.175030       896
-        fragment_lines = _slurp(audiofragments)
-        for (audio_fragment_index, line) in enumerate(fragment_lines, start=1):
+            terms_for_bulk_commit.append(term)
+            if len(terms_for_bulk_commit) == Corpus.OBJECTS_PER_BULK_OPERATION:
+                Term.objects.bulk_create(terms_for_bulk_commit)
+                terms_for_bulk_commit = []
+        Term.objects.bulk_create(terms_for_bulk_commit)
+
+        term_id_for_term_index = dict(self.term_set.values_list('zr_term_index', 'id'))
+
+        # The 'audiofragments' file can have millions of lines, so it is
+        # read one line at a time, and the AudioFragments are written in
+        # batches.  Each call to bulk_create() writes a batch using a
+        # single transaction.
+        audio_fragments_for_bulk_commit = []
+        for (audio_fragment_index, audio_identifier, start, end, score) in zrtools.read_nodes(audiofragments):
             # Only create AudioFragment instance for fragments associated with a Term
-            if audio_fragment_index in term_for_audio_fragment_index:
-                (audio_identifier, start, end, score, ignore1, ignore2) = line.split();
+            if audio_fragment_index >= len(term_index_for_audio_fragment_index):
+                continue
+            term_index = term_index_for_audio_fragment_index[audio_fragment_index]
+            if term_index == zrtools.NO_TERM:
+                continue
+
+            audio_fragment = AudioFragment()
+            audio_fragment.corpus = self
+            audio_fragment.document_id = document_id_for_audio_identifier[audio_identifier]
+            audio_fragment.term_id = term_id_for_term_index[term_index]
+            audio_fragment.zr_fragment_index = audio_fragment_index
+            audio_fragment.start_offset = start
+            audio_fragment.end_offset = end
+            audio_fragment.duration = audio_fragment.end_offset - audio_fragment.start_offset
+            audio_fragment.score = score
+
+            audio_fragments_for_bulk_commit.append(audio_fragment)
+            if len(audio_fragments_for_bulk_commit) == Corpus.OBJECTS_PER_BULK_OPERATION:
+                AudioFragment.objects.bulk_create(audio_fragments_for_bulk_commit)
+                audio_fragments_for_bulk_commit = []
+        AudioFragment.objects.bulk_create(audio_fragments_for_bulk_commit)
+
+        self.update_term_stats()
+
+    def update_from_zr_output(self, audiofragments, clusters, filenames,
+                              audio_directory=None, audio_extension=None, probe_workers=1):
+        """Update an existing corpus with the output of a new ZRTools run
+
+        AudioFragments are identified by their (Document, start, end)
+        offsets.  Only AudioFragments and Terms that are new, changed or
+        missing from the new ZRTools output are written to the database.
+        Documents are never deleted, since they may be referenced by
+        DocumentTopics.
+
+        Each cluster in the new output is matched with the existing Term
+        that shares the most AudioFragments with it, so that Term labels
+        entered by users carry over to the updated corpus.  Existing
+        Terms that are not matched with a cluster are deleted.
+
+        Returns a dict with the number of rows that were created,
+        updated and deleted.
+        """
+        stats = collections.Counter()
+
+        with transaction.atomic():
+            # Add Documents for audio files that are not already part of the corpus
+            document_id_for_audio_identifier = dict(self.document_set.values_list('audio_identifier', 'id'))
+            next_document_index = (self.document_set.aggregate(Max('document_index'))['document_index__max'] or -1) + 1
+            documents = []
+            for (_, audio_identifier, audio_path) in \
+                    zrtools.read_filenames(filenames, audio_directory, audio_extension):
+                if audio_identifier not in document_id_for_audio_identifier:
+                    document = Document()
+                    document.corpus = self
+                    document.document_index = next_document_index + len(documents)
+                    document.audio_identifier = audio_identifier
+                    document.audio_path = audio_path
+                    documents.append(document)
+            if documents:
+                self._probe_document_durations(documents, probe_workers)
+                Document.objects.bulk_create(documents, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+                document_id_for_audio_identifier = dict(self.document_set.values_list('audio_identifier', 'id'))
+                stats['documents_created'] = len(documents)
+
+            # Several nodes can share the same (Document, start, end) offsets,
+            # so each key maps to a list of existing AudioFragments
+            existing_fragments_for_key = collections.defaultdict(list)
+            for (fragment_id, document_id, start_offset, end_offset, term_id, zr_fragment_index) in \
+                    AudioFragment.objects.filter(corpus=self).values_list(
+                        'id', 'document_id', 'start_offset', 'end_offset', 'term_id', 'zr_fragment_index').iterator():
+                existing_fragments_for_key[(document_id, start_offset, end_offset)].append(
+                    (fragment_id, term_id, zr_fragment_index))
+
+            # Match the AudioFragments in the new output against the existing
+            # AudioFragments.  Matched AudioFragments are stored in parallel
+            # arrays, since most AudioFragments usually do not change.
+            term_index_for_audio_fragment_index = zrtools.read_term_index_for_nodes(clusters)
+            matched_fragment_ids = array(str('l'))
+            matched_old_term_ids = array(str('l'))
+            matched_old_zr_fragment_indices = array(str('l'))
+            matched_new_term_indices = array(str('l'))
+            matched_new_zr_fragment_indices = array(str('l'))
+            new_fragments = []
+            overlap_for_new_and_old_term = collections.Counter()
+            for (audio_fragment_index, audio_identifier, start, end, score) in zrtools.read_nodes(audiofragments):
+                if audio_fragment_index >= len(term_index_for_audio_fragment_index):
+                    continue
+                term_index = term_index_for_audio_fragment_index[audio_fragment_index]
+                if term_index == zrtools.NO_TERM:
+                    continue
+
+                key = (document_id_for_audio_identifier[audio_identifier], start, end)
+                existing_fragment = _pop_existing_fragment(existing_fragments_for_key, key)
+                if existing_fragment:
+                    (fragment_id, old_term_id, old_zr_fragment_index) = existing_fragment
+                    matched_fragment_ids.append(fragment_id)
+                    matched_old_term_ids.append(old_term_id)
+                    matched_old_zr_fragment_indices.append(old_zr_fragment_index)
+                    matched_new_term_indices.append(term_index)
+                    matched_new_zr_fragment_indices.append(audio_fragment_index)
+                    overlap_for_new_and_old_term[(term_index, old_term_id)] += 1
+                else:
+                    new_fragments.append((audio_fragment_index, key, score, term_index))
+            vanished_fragment_ids = []
+            changed_term_ids = set()
+            for existing_fragments in existing_fragments_for_key.values():
+                for (fragment_id, old_term_id, _) in existing_fragments:
+                    vanished_fragment_ids.append(fragment_id)
+                    changed_term_ids.add(old_term_id)
+            del existing_fragments_for_key
+
+            # Greedily pair each new cluster with the existing Term it
+            # overlaps the most, using each existing Term at most once
+            term_id_for_term_index = {}
+            matched_old_term_id_set = set()
+            for ((term_index, old_term_id), overlap) in overlap_for_new_and_old_term.most_common():
+                if term_index not in term_id_for_term_index and old_term_id not in matched_old_term_id_set:
+                    term_id_for_term_index[term_index] = old_term_id
+                    matched_old_term_id_set.add(old_term_id)
+
+            old_zr_term_index_for_term_id = dict(self.term_set.values_list('id', 'zr_term_index'))
+            new_zr_term_index_for_term_id = {}
+            terms_for_bulk_commit = []
+            for (term_index, _) in zrtools.read_clusters(clusters):
+                if term_index in term_id_for_term_index:
+                    term_id = term_id_for_term_index[term_index]
+                    if old_zr_term_index_for_term_id[term_id] != term_index:
+                        new_zr_term_index_for_term_id[term_id] = term_index
+                else:
+                    term = Term()
+                    term.corpus = self
+                    term.label = ''
+                    term.zr_term_index = term_index
+                    terms_for_bulk_commit.append(term)
+            _bulk_update_field(Term, 'zr_term_index', new_zr_term_index_for_term_id)
+            stats['terms_updated'] = len(new_zr_term_index_for_term_id)
+            if terms_for_bulk_commit:
+                # New rows are assigned IDs larger than the IDs of all existing rows
+                max_term_id = Term.objects.aggregate(Max('id'))['id__max'] or 0
+                Term.objects.bulk_create(terms_for_bulk_commit, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+                term_id_for_term_index.update(
+                    self.term_set.filter(id__gt=max_term_id).values_list('zr_term_index', 'id'))
+                stats['terms_created'] = len(terms_for_bulk_commit)
+
+            # Update the matched AudioFragments that moved to a different
+            # Term, or whose line number in the nodes file changed
+            fragment_ids_for_new_term_id = collections.defaultdict(list)
+            new_zr_fragment_index_for_fragment_id = {}
+            for i in range(len(matched_fragment_ids)):
+                new_term_id = term_id_for_term_index[matched_new_term_indices[i]]
+                if new_term_id != matched_old_term_ids[i]:
+                    fragment_ids_for_new_term_id[new_term_id].append(matched_fragment_ids[i])
+                    changed_term_ids.add(matched_old_term_ids[i])
+                    changed_term_ids.add(new_term_id)
+                    stats['audio_fragments_updated'] += 1
+                if matched_new_zr_fragment_indices[i] != matched_old_zr_fragment_indices[i]:
+                    new_zr_fragment_index_for_fragment_id[matched_fragment_ids[i]] = matched_new_zr_fragment_indices[i]
+                    stats['audio_fragments_updated'] += 1
+            for (new_term_id, fragment_ids) in fragment_ids_for_new_term_id.items():
+                for fragment_ids_chunk in _chunks(fragment_ids):
+                    AudioFragment.objects.filter(id__in=fragment_ids_chunk).update(term_id=new_term_id)
+            _bulk_update_field(AudioFragment, 'zr_fragment_index', new_zr_fragment_index_for_fragment_id)
+            del new_zr_fragment_index_for_fragment_id
+
+            audio_fragments_for_bulk_commit = []
+            for (audio_fragment_index, (document_id, start, end), score, term_index) in new_fragments:
                 audio_fragment = AudioFragment()
-                audio_fragment.document = document_for_audio_identifier[audio_identifier]
-                audio_fragment.term = term_for_audio_fragment_index[audio_fragment_index]
+                audio_fragment.corpus = self
+                audio_fragment.document_id = document_id
+                audio_fragment.term_id = term_id_for_term_index[term_index]
                 audio_fragment.zr_fragment_index = audio_fragment_index
-                audio_fragment.start_offset = int(start)
-                audio_fragment.end_offset = int(end)
-                audio_fragment.duration = audio_fragment.end_offset - audio_fragment.start_offset
+                audio_fragment.start_offset = start
+                audio_fragment.end_offset = end
+                audio_fragment.duration = end - start
                 audio_fragment.score = score
-                audio_fragment.save()
+                audio_fragments_for_bulk_commit.append(audio_fragment)
+                changed_term_ids.add(audio_fragment.term_id)
+            AudioFragment.objects.bulk_create(audio_fragments_for_bulk_commit,
+                                              batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+            stats['audio_fragments_created'] = len(audio_fragments_for_bulk_commit)
+
+            for fragment_ids_chunk in _chunks(vanished_fragment_ids):
+                AudioFragment.objects.filter(id__in=fragment_ids_chunk).delete()
+            stats['audio_fragments_deleted'] = len(vanished_fragment_ids)
+
+            vanished_term_ids = [term_id for term_id in old_zr_term_index_for_term_id
+                                 if term_id not in matched_old_term_id_set]
+            for term_ids_chunk in _chunks(vanished_term_ids):
+                Term.objects.filter(id__in=term_ids_chunk).delete()
+            stats['terms_deleted'] = len(vanished_term_ids)
+
+            if documents:
+                # The IDF of every Term depends on the number of Documents in the corpus
+                self.update_term_stats()
+            else:
+                self.update_term_stats(changed_term_ids.difference(vanished_term_ids))
+
+        return stats
+
+    def _probe_document_durations(self, documents, probe_workers=1):
+        """Set the duration of each Document instance from the header of its audio file
+
+        The Document instances are updated but not saved.
+        """
+        signal_infos = AudioSignalInfo.lookup([document.audio_path for document in documents], probe_workers)
+        for (document, signal_info) in zip(documents, signal_infos):
+            if signal_info:
+                document.duration = audio.duration_in_hundredths(signal_info, self.audio_rate, self.audio_channels)
+                if document.duration == 0:
+                    logging.warning("Audio file '%s' has length 0" % document.audio_path)
+            else:
+                document.duration = 0
+                logging.warning("Unable to find audio file with path '%s'" % document.audio_path)
 
     def duration_as_hh_mm_ss(self):
         m, s = divmod(self.duration_in_seconds(), 60)
@@ -254,18 +640,113 @@ class Corpus(models.Model):
         return "%d:%02d:%02d" % (h, m, s)
 
     def duration_in_seconds(self):
-        h = Corpus.objects.filter(id=self.id).aggregate(Sum('document__duration'))
-        return h['document__duration__sum'] / 100.0
+        # summary_duration is only set for the Corpora read using with_summary_statistics()
+        duration = getattr(self, 'summary_duration', None)
+        if duration is None:
+            duration = self.total_duration()
+        return duration / 100.0
 
     def terms(self):
         return self.term_set.all()
 
     def total_audio_fragments(self):
-        return AudioFragment.objects.filter(document__corpus=self).distinct().count()
+        return AudioFragment.objects.filter(corpus=self).count()
+
+    def total_duration(self):
+        """Return the total duration of the Documents in the Corpus, in hundredths of a second
+        """
+        return self.document_set.aggregate(total_duration=Coalesce(Sum('duration'), 0))['total_duration']
 
     def total_terms(self):
         return self.term_set.count()
 
+    @staticmethod
+    def with_summary_statistics(corpora):
+        """Add the statistics shown on the index page to each Corpus in a QuerySet
+
+        The statistics are computed using correlated subqueries, so that
+        they are read in the same query as the Corpus rows:
+          summary_documents, summary_document_topics, summary_terms, summary_duration
+        where summary_duration is measured in hundredths of a second.
+        """
+        def summary_statistic(model, aggregate):
+            # Each subquery groups the rows for the outer Corpus, and returns a single value
+            rows = model.objects.filter(corpus=OuterRef('pk')).order_by().values('corpus')
+            return Coalesce(Subquery(rows.annotate(value=aggregate).values('value'),
+                                     output_field=models.IntegerField()), 0)
+
+        return corpora.annotate(
+            summary_documents=summary_statistic(Document, Count('id')),
+            summary_document_topics=summary_statistic(DocumentTopic, Count('id')),
+            summary_terms=summary_statistic(Term, Count('id')),
+            summary_duration=summary_statistic(Document, Sum('duration')))
+
+    def update_term_stats(self, term_ids=None):
+        """Recompute the TermStats and DocumentTermStats for all Terms in the corpus, or only for the Terms in term_ids
+        """
+        total_documents = self.document_set.count()
+        if term_ids is None:
+            self._update_term_stats(self.term_set.all(), total_documents)
+        else:
+            for term_ids_chunk in _chunks(list(term_ids)):
+                self._update_term_stats(self.term_set.filter(id__in=term_ids_chunk), total_documents)
+        Corpus.bump_cache_version(self.id)
+
+    def _update_term_stats(self, terms, total_documents):
+        """Recompute the TermStats and DocumentTermStats for the Terms in a QuerySet
+
+        The statistics are computed and stored in batches of
+        OBJECTS_PER_BULK_OPERATION Terms (selected by ranges of Term IDs),
+        inside a single transaction, so that only one batch of statistics
+        and AudioFragment IDs is held in memory at a time.
+        """
+        term_ids = list(terms.order_by('id').values_list('id', flat=True))
+        with transaction.atomic():
+            TermStats.objects.filter(term__in=terms).delete()
+            DocumentTermStats.objects.filter(term__in=terms).delete()
+            for term_ids_chunk in _chunks(term_ids, Corpus.OBJECTS_PER_BULK_OPERATION):
+                self._update_term_stats_batch(terms.filter(id__range=(term_ids_chunk[0], term_ids_chunk[-1])),
+                                              total_documents)
+
+    def _update_term_stats_batch(self, terms, total_documents):
+        # Use a single SQL query to compute the AudioFragment IDs for all of the Terms
+        audio_fragment_ids_for_term_id = collections.defaultdict(list)
+        for (term_id, audio_fragment_id) in \
+                AudioFragment.objects.filter(term__in=terms).order_by('id').values_list('term_id', 'id').iterator():
+            audio_fragment_ids_for_term_id[term_id].append(audio_fragment_id)
+
+        term_counts = terms.annotate(Count('audiofragment'), Count('audiofragment__document', distinct=True)) \
+                           .values_list('id', 'audiofragment__count', 'audiofragment__document__count')
+
+        term_stats_for_bulk_commit = []
+        for (term_id, total_audio_fragments, total_documents_for_term) in term_counts:
+            term_stats = TermStats()
+            term_stats.corpus = self
+            term_stats.term_id = term_id
+            term_stats.total_audio_fragments = total_audio_fragments
+            term_stats.total_documents = total_documents_for_term
+            term_stats.idf = math.log(total_documents / (1.0 + total_documents_for_term))
+            term_stats.audio_fragment_ids = json.dumps(audio_fragment_ids_for_term_id.pop(term_id, []))
+            term_stats_for_bulk_commit.append(term_stats)
+        TermStats.objects.bulk_create(term_stats_for_bulk_commit, batch_size=Corpus.OBJECTS_PER_BULK_OPERATION)
+
+        # Use a single SQL query to compute the per-Document statistics for all of the Terms
+        document_term_counts = AudioFragment.objects.filter(term__in=terms).values('document_id', 'term_id') \
+            .annotate(Count('id'), Min('start_offset')).values_list('document_id', 'term_id', 'id__count', 'start_offset__min')
+
+        document_term_stats_for_bulk_commit = []
+        for (document_id, term_id, total_audio_fragments_in_document, first_start_offset) in document_term_counts.iterator():
+            document_term_stats = DocumentTermStats()
+            document_term_stats.document_id = document_id
+            document_term_stats.term_id = term_id
+            document_term_stats.total_audio_fragments_in_document = total_audio_fragments_in_document
+            document_term_stats.first_start_offset = first_start_offset
+            document_term_stats_for_bulk_commit.append(document_term_stats)
+            if len(document_term_stats_for_bulk_commit) == Corpus.OBJECTS_PER_BULK_OPERATION:
+                DocumentTermStats.objects.bulk_create(document_term_stats_for_bulk_commit)
+                document_term_stats_for_bulk_commit = []
+        DocumentTermStats.objects.bulk_create(document_term_stats_for_bulk_commit)
+
 
 class Document(models.Model):
     """An audio Document associated with an audio file
@@ -287,9 +768,170 @@ class Document(models.Model):
     def duration_in_seconds(self):
         return self.duration / 100.0
 
+    def is_wav(self):
+        return os.path.splitext(self.audio_path)[1] == '.wav'
+
+    def open_wav_file(self):
+        """Return a file object (opened for binary reading) for a WAV version of the Document audio
+
+        Returns None if a non-WAV audio file is still being converted to
+        a WAV file, and raises BackgroundJobError if the conversion failed.
+        """
+        wav_path = self.wav_path()
+        if wav_path is None:
+            return None
+        try:
+            return open(wav_path, 'rb')
+        except IOError:
+            if self.is_wav():
+                raise
+            # The cached file was evicted by another process, so convert the audio file again
+            wav_path = self.wav_path()
+            return open(wav_path, 'rb') if wav_path else None
+
     def total_terms(self):
         return Term.objects.filter(audiofragment__document=self).distinct().count()
 
+    def waveform_peaks(self):
+        """Return a list of DocumentPeaks for this Document, ordered from the finest to coarsest zoom level
+
+        The peaks are computed (and stored) by a background thread the
+        first time this function is called for a Document, and this
+        function returns None until the peaks have been stored.  Raises
+        BackgroundJobError if computing the peaks failed.
+        """
+        document_peaks = list(self.documentpeaks_set.order_by('samples_per_peak'))
+        if document_peaks:
+            return document_peaks
+        _start_background_job(('compute_waveform_peaks', self.id), self.compute_waveform_peaks)
+        return None
+
+    def compute_waveform_peaks(self):
+        """Compute and store the DocumentPeaks for this Document, and return them ordered from the finest to coarsest zoom level
+        """
+        wav_path = self.audio_path
+        wav_layout = audio.read_wav_layout(wav_path) if self.is_wav() else None
+        if not wav_layout:
+            # Compressed or non-WAV audio files are converted to PCM WAV files using SoX
+            wav_path = Document.transcode_audio(self.audio_path)
+            wav_layout = audio.read_wav_layout(wav_path)
+
+        rate = wav_layout['rate']
+        finest_samples_per_peak = max(rate // DocumentPeaks.MAX_PEAKS_PER_SECOND, 1)
+        samples_per_peak_levels = [finest_samples_per_peak * DocumentPeaks.ZOOM_FACTOR**level
+                                   for level in range(DocumentPeaks.TOTAL_ZOOM_LEVELS)]
+        peaks_for_levels = audio.read_wav_peaks(wav_path, samples_per_peak_levels)
+
+        document_peaks = []
+        for (samples_per_peak, peaks) in zip(samples_per_peak_levels, peaks_for_levels):
+            # Peaks are stored as little-endian 16-bit integers
+            if sys.byteorder == 'big':
+                peaks.byteswap()
+            document_peaks.append(DocumentPeaks(document=self, rate=rate, samples_per_peak=samples_per_peak,
+                                                peaks=peaks.tostring()))
+        try:
+            with transaction.atomic():
+                DocumentPeaks.objects.bulk_create(document_peaks)
+        except IntegrityError:
+            # The peaks were stored by another process
+            pass
+        return document_peaks
+
+    @staticmethod
+    def transcode_audio(audio_path):
+        """Return the path of a cached WAV version of a (non-WAV) audio file
+
+        The audio file is only converted if it is not already in the
+        document audio cache.  The cache key includes the size and
+        modification time of the audio file, so the file is converted
+        again if it changes.
+        """
+        cache_key = _transcode_cache_key(audio_path)
+        cached_path = document_audio_cache.get(cache_key)
+        if cached_path:
+            return cached_path
+
+        (fd, tmp_path) = document_audio_cache.mkstemp()
+        os.close(fd)
+        try:
+            audio.transcode_to_wav(audio_path, tmp_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return document_audio_cache.put_file(cache_key, tmp_path)
+
+    def wav_path(self):
+        """Return the path of a WAV version of the Document audio, or None if the audio is still being converted
+
+        Converting a long non-WAV audio file can take longer than a
+        request should, so the file is converted by a background thread,
+        and this function returns None until the converted file is in
+        the document audio cache.  Raises BackgroundJobError if the
+        conversion failed.
+        """
+        if self.is_wav():
+            return self.audio_path
+        cache_key = _transcode_cache_key(self.audio_path)
+        cached_path = document_audio_cache.get(cache_key)
+        if cached_path:
+            return cached_path
+        # The job key includes the size and modification time of the audio
+        # file, so a failed conversion is retried as soon as the file changes
+        _start_background_job(('transcode_audio', cache_key), Document.transcode_audio, self.audio_path)
+        return None
+
+
+class DocumentPeaks(models.Model):
+    """The waveform envelope of the audio for a Document, at one zoom level
+
+    The envelope is stored as the minimum and maximum sample values
+    (scaled to 16-bit integers) for each consecutive block of
+    samples_per_peak frames, so the waveform for a long Document can be
+    drawn without downloading and decoding the whole audio file.
+    """
+    # Zoom levels have roughly MAX_PEAKS_PER_SECOND, MAX_PEAKS_PER_SECOND / ZOOM_FACTOR, ...
+    # peaks per second of audio
+    MAX_PEAKS_PER_SECOND = 200
+    TOTAL_ZOOM_LEVELS = 3
+    ZOOM_FACTOR = 4
+
+    document = models.ForeignKey(Document)
+
+    rate = models.IntegerField()
+    samples_per_peak = models.IntegerField()
+    # Interleaved minimum and maximum values, as little-endian 16-bit integers:
+    #   min_0, max_0, min_1, max_1, ...
+    peaks = models.BinaryField()
+
+    class Meta:
+        unique_together = ('document', 'samples_per_peak')
+
+    def peak_values(self):
+        """Return an array of the (interleaved minimum and maximum) peak values
+        """
+        peak_values = array(str('h'), bytes(self.peaks))
+        if sys.byteorder == 'big':
+            peak_values.byteswap()
+        return peak_values
+
+    def peaks_per_second(self):
+        return self.rate / float(self.samples_per_peak)
+
+
+class DocumentTermStats(models.Model):
+    """Precomputed statistics for a Term that appears in a particular Document
+
+    There is one DocumentTermStats row for each (Document, Term) pair
+    that has at least one AudioFragment, so the Terms for a Document
+    can be read without touching the AudioFragment table.
+    """
+    document = models.ForeignKey(Document)
+    term = models.ForeignKey('Term')
+
+    total_audio_fragments_in_document = models.IntegerField()
+    # first_start_offset is measured in hundredths of a second
+    first_start_offset = models.IntegerField()
+
 
 class DocumentTopic(models.Model):
     """
@@ -351,16 +993,150 @@ class Term(models.Model):
     def total_documents(self):
         return Document.objects.filter(audiofragment__term=self).distinct().count()
 
+    class Meta:
+        index_together = [
+            # Reading the Terms of a Corpus in label order, for the wordclouds
+            ('corpus', 'label', 'zr_term_index'),
+        ]
+
+def _read_ctm_file(ctm_file_path):
+    """Yield an (audio_identifier, start_offset, duration, keyword) tuple for each line of a CTM file
+
+    Offsets and durations are converted from seconds to hundredths of a second.
+    """
+    ctm_file = open(ctm_file_path, "r")
+    try:
+        for line in ctm_file:
+            if not line.strip():
+                # Ignore blank lines
+                continue
+            if line.strip()[0:2] == ';;':
+                # Ignore comments
+                continue
+            fields = line.split()
+            if len(fields) != 5 and len(fields) != 6:
+                logging.warning("Expected line of CTM file to have 5 or 6 fields, but found %d fields. Line: '%s'" % \
+                                (len(fields), line.split()))
+            audio_identifier = fields[0]
+            start_offset = int(float(fields[2]) * 100)
+            duration = int(float(fields[3]) * 100)
+            keyword = fields[4]
+            yield (audio_identifier, start_offset, duration, keyword)
+    finally:
+        ctm_file.close()
+
+
+class TermStats(models.Model):
+    """Precomputed statistics for a Term, used by the wordclouds
+
+    TermStats are created when a corpus is imported, and updated when
+    the AudioFragments for a Term change.  Computing these statistics
+    on the fly requires a join over every AudioFragment in the corpus.
+    """
+    term = models.OneToOneField(Term)
+    corpus = models.ForeignKey(Corpus)
+
+    total_audio_fragments = models.IntegerField()
+    total_documents = models.IntegerField()
+    # Inverse document frequency, computed as log(D / (1 + total_documents)),
+    # where D is the number of Documents in the corpus
+    idf = models.FloatField(default=0.0)
+
+    # JSON-encoded list of the IDs of the Term's AudioFragments
+    audio_fragment_ids = models.TextField()
 
-def _slurp(fname, encoding='utf-8'):
-    # Some of the source files have the unicode characters \u2028
-    # (line separator) and \u2029 (paragraph separator)
-    ## NB: io.open ignores \u2028 and \u2029 (thankfully), while codecs.open() does not
-    f = io.open(fname, 'r', encoding=encoding, newline='\n')
+    class Meta:
+        index_together = [
+            # Reading the top Terms of a Corpus for the wordclouds
+            ('corpus', 'total_documents'),
+            ('corpus', 'total_audio_fragments'),
+        ]
 
-    lines = []
+
+# SQLite limits the number of parameters in a single query to 999
+PARAMETERS_PER_QUERY = 500
+
+
+def _bulk_update_field(model, field_name, value_for_id):
+    """Set a field to a different value for each row, using one UPDATE per chunk of rows
+
+    value_for_id maps the IDs of the rows to their new values.  Each
+    UPDATE uses a CASE expression with a WHEN clause for each row, which
+    (with the 'id IN' filter) takes three query parameters per row.
+    """
+    ids = sorted(value_for_id)
+    for ids_chunk in _chunks(ids, PARAMETERS_PER_QUERY // 3):
+        model.objects.filter(id__in=ids_chunk).update(**{
+            field_name: Case(*[When(id=row_id, then=Value(value_for_id[row_id])) for row_id in ids_chunk],
+                             output_field=model._meta.get_field(field_name))
+        })
+
+
+def _chunks(items, chunk_size=PARAMETERS_PER_QUERY):
+    """Yield successive chunks of a list, e.g. for use with 'id__in' filters
+    """
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i+chunk_size]
+
+
+def _pop_existing_fragment(existing_fragments_for_key, key):
+    """Remove and return an existing AudioFragment with the given offsets, or None if there are none left
+
+    When several existing AudioFragments have the same offsets, they are
+    matched in the order of their (old) line numbers in the nodes file,
+    so duplicates are matched in the same order after lines are added to
+    or removed from the file.
+    """
+    existing_fragments = existing_fragments_for_key.get(key)
+    if not existing_fragments:
+        return None
+    existing_fragment = min(existing_fragments, key=lambda existing_fragment: existing_fragment[2])
+    existing_fragments.remove(existing_fragment)
+    if not existing_fragments:
+        del existing_fragments_for_key[key]
+    return existing_fragment
+
+
+def _background_job_failure_cache_key(job_key):
+    return 'background_job_failure:%s' % hashlib.md5(repr(job_key).encode('utf-8')).hexdigest()
+
+
+def _run_background_job(job_key, function, args):
     try:
-        lines = f.readlines()
+        function(*args)
+    except Exception as e:
+        logging.exception('Background job %r failed' % (job_key,))
+        # The failure is stored in the (shared) Django cache, so requests
+        # handled by any server process can report it
+        cache.set(_background_job_failure_cache_key(job_key), '%s: %s' % (type(e).__name__, e),
+                  BACKGROUND_JOB_FAILURE_TIMEOUT)
     finally:
-        f.close()
-    return lines
+        with _background_jobs_lock:
+            _background_jobs.discard(job_key)
+        # Each thread has its own database connection
+        connection.close()
+
+
+def _start_background_job(job_key, function, *args):
+    """Call function(*args) in a background thread, unless a job with the same key is already running
+
+    Returns True if a new job was started.  Raises BackgroundJobError if
+    a job with the same key failed in the last BACKGROUND_JOB_FAILURE_TIMEOUT
+    seconds.
+    """
+    failure = cache.get(_background_job_failure_cache_key(job_key))
+    if failure is not None:
+        raise BackgroundJobError(failure)
+    with _background_jobs_lock:
+        if job_key in _background_jobs:
+            return False
+        _background_jobs.add(job_key)
+    thread = threading.Thread(target=_run_background_job, args=(job_key, function, args))
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def _transcode_cache_key(audio_path):
+    stat_result = os.stat(audio_path)
+    return '%s:%d:%d' % (audio_path, stat_result.st_size, int(stat_result.st_mtime))
@@ -0,0 +1,136 @@
+"""Search for Terms by label and Documents by audio identifier
+
+On SQLite with the FTS5 extension, the searches use the full-text index
+tables created by migration 0010_search_index.  The index tables are
+kept in sync with the Term and Document tables by triggers, so Terms
+and Documents added by the import commands, and labels changed through
+the term_update view, are searchable immediately.  SQLite drops the
+triggers of a table when a migration rebuilds the table, so the
+triggers are recreated after every migrate by create_search_index_triggers().
+
+With the 'trigram' tokenizer (SQLite 3.34+) the index supports substring
+searches.  Otherwise the index only supports searches for words that
+start with the query.  On other databases, or for queries that are too
+short for the trigram index, the searches fall back to a (slower)
+case-insensitive LIKE over the whole table.
+"""
+from __future__ import unicode_literals
+
+import collections
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from visualizer.models import Document, Term
+
+
+# The FTS5 index table, indexed table and indexed field for each searchable model
+SEARCH_INDEX_TABLES = {
+    'document': ('visualizer_document_search', 'visualizer_document', 'audio_identifier'),
+    'term': ('visualizer_term_search', 'visualizer_term', 'label'),
+}
+
+# The triggers that keep each index table in sync with its indexed table
+SEARCH_INDEX_TRIGGERS = collections.OrderedDict([
+    ('insert', """
+        CREATE TRIGGER %(search_table)s_insert AFTER INSERT ON %(table)s BEGIN
+          INSERT INTO %(search_table)s(rowid, %(field)s) VALUES (new.id, new.%(field)s);
+        END
+    """),
+    ('delete', """
+        CREATE TRIGGER %(search_table)s_delete AFTER DELETE ON %(table)s BEGIN
+          INSERT INTO %(search_table)s(%(search_table)s, rowid, %(field)s) VALUES ('delete', old.id, old.%(field)s);
+        END
+    """),
+    ('update', """
+        CREATE TRIGGER %(search_table)s_update AFTER UPDATE OF %(field)s ON %(table)s BEGIN
+          INSERT INTO %(search_table)s(%(search_table)s, rowid, %(field)s) VALUES ('delete', old.id, old.%(field)s);
+          INSERT INTO %(search_table)s(rowid, %(field)s) VALUES (new.id, new.%(field)s);
+        END
+    """),
+])
+
+# The trigram tokenizer can only match queries of at least three characters
+MIN_TRIGRAM_QUERY_LENGTH = 3
+
+
+def create_search_index_triggers(using=DEFAULT_DB_ALIAS, **kwargs):
+    """Recreate any missing triggers of the (SQLite) search index tables, and rebuild their indexes
+
+    This is a post_migrate signal handler.  Migrations that rebuild the
+    Term or Document tables (which SQLite does for most ALTER TABLE
+    operations) drop the triggers, and the indexed tables may have
+    changed while the triggers were missing.
+    """
+    db_connection = connections[using]
+    if db_connection.vendor != 'sqlite':
+        return
+    cursor = db_connection.cursor()
+    cursor.execute("SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+    names = dict(cursor.fetchall())
+    for (search_table, table, field) in SEARCH_INDEX_TABLES.values():
+        if search_table not in names:
+            # SQLite was built without FTS5, so the searches do not use an index
+            continue
+        missing_triggers = [trigger for trigger in SEARCH_INDEX_TRIGGERS
+                            if names.get('%s_%s' % (search_table, trigger)) != table]
+        if not missing_triggers:
+            continue
+        sql_names = {'search_table': search_table, 'table': table, 'field': field}
+        for trigger in missing_triggers:
+            cursor.execute("DROP TRIGGER IF EXISTS %s_%s" % (search_table, trigger))
+            cursor.execute(SEARCH_INDEX_TRIGGERS[trigger] % sql_names)
+        cursor.execute("INSERT INTO %(search_table)s(%(search_table)s) VALUES ('rebuild')" % sql_names)
+
+
+def search_documents(query, corpus_ids=None):
+    """Return a QuerySet with the Documents whose audio identifier contains (or has a word that starts with) query
+    """
+    documents = _search(Document.objects.all(), 'document', query, 'audio_identifier')
+    if corpus_ids is not None:
+        documents = documents.filter(corpus_id__in=corpus_ids)
+    return documents.order_by('audio_identifier', 'id')
+
+
+def search_index_tokenizer():
+    """Return the tokenizer of the (SQLite) search index tables, or None if the tables do not exist
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s",
+                   [SEARCH_INDEX_TABLES['term'][0]])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return 'trigram' if 'trigram' in row[0] else 'unicode61'
+
+
+def search_terms(query, corpus_ids=None):
+    """Return a QuerySet with the Terms whose label contains (or has a word that starts with) query
+    """
+    terms = _search(Term.objects.all(), 'term', query, 'label')
+    if corpus_ids is not None:
+        terms = terms.filter(corpus_id__in=corpus_ids)
+    return terms.order_by('label', 'id')
+
+
+def _fts5_match_expression(query, tokenizer):
+    # A quoted FTS5 string matches the query as a phrase, without
+    # interpreting FTS5 operators in the query
+    phrase = '"%s"' % query.replace('"', '""')
+    if tokenizer == 'trigram':
+        return phrase
+    return phrase + ' *'
+
+
+def _search(queryset, table_key, query, field_name):
+    query = query.strip()
+    if connection.vendor == 'sqlite':
+        tokenizer = search_index_tokenizer()
+        if tokenizer and (tokenizer != 'trigram' or len(query) >= MIN_TRIGRAM_QUERY_LENGTH):
+            (search_table, table, _) = SEARCH_INDEX_TABLES[table_key]
+            return queryset.extra(
+                where=['%s.id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                    connection.ops.quote_name(table),
+                    connection.ops.quote_name(search_table),
+                    connection.ops.quote_name(search_table))],
+                params=[_fts5_match_expression(query, tokenizer)])
+    return queryset.filter(**{field_name + '__icontains': query})
@@ -15,11 +15,12 @@
  *
  * Dependencies:
  *   Backbone.js
+ *   Underscore.js
  *   jQuery
  *   Bootstrap    - TermCloud.render() uses Bootstrap tooltips
  */
 
-/* globals Backbone */
+/* globals Backbone, _ */
 
 
 var TermCloudItemModel = Backbone.Model.extend({
@@ -27,7 +28,16 @@ var TermCloudItemModel = Backbone.Model.extend({
 
 var TermCloudCollection = Backbone.Collection.extend({
   model: TermCloudItemModel,
+  /** Fetches the Terms using the (much smaller) columnar terms.json format
+   */
+  fetch: function(options) {
+    options = _.extend({data: {format: 'columns'}}, options);
+    return Backbone.Collection.prototype.fetch.call(this, options);
+  },
   parse: function(data) {
+    if (data.columns) {
+      return parseTermColumns(data);
+    }
     return data.terms;
   },
   url: function() {
@@ -42,12 +52,14 @@ var TermCloudItemView = Backbone.View.extend({
   render: function() {
     this.$el.attr('id', 'termcloud_item_' + this.model.attributes.term_id);
 
-    // Add CSS classes for each audio_fragment_id
-    var span_classes = [];
-    for (var i = 0; i < this.model.attributes.audio_fragment_ids.length; i++) {
-      span_classes.push('audio_fragment_span_' + this.model.attributes.audio_fragment_ids[i]);
+    // Add CSS classes for each audio_fragment_id, if the AudioFragment IDs were included in terms.json
+    if (this.model.attributes.audio_fragment_ids) {
+      var span_classes = [];
+      for (var i = 0; i < this.model.attributes.audio_fragment_ids.length; i++) {
+        span_classes.push('audio_fragment_span_' + this.model.attributes.audio_fragment_ids[i]);
+      }
+      this.$el.addClass(span_classes.join(' '));
     }
-    this.$el.addClass(span_classes.join(' '));
 
     if (this.model.attributes.css_class) {
       this.$el.addClass(this.model.attributes.css_class);
@@ -183,6 +195,32 @@ var TermCloud = Backbone.View.extend({
 });
 
 
+/** Converts the columnar terms.json format to a list of Term objects
+ *
+ * The columnar format has a list of values for each Term attribute.  The
+ * 'term_id' and 'corpus_id' attributes are not included, and attributes
+ * that only some Terms have are null for the other Terms.
+ */
+function parseTermColumns(data) {
+  var keys = _.keys(data.columns);
+  var ids = data.columns.id || [];
+  var terms = new Array(ids.length);
+  for (var i = 0; i < ids.length; i++) {
+    var term = {
+      term_id: ids[i],
+      corpus_id: data.corpus_id
+    };
+    for (var k = 0; k < keys.length; k++) {
+      var value = data.columns[keys[k]][i];
+      if (value !== null) {
+        term[keys[k]] = value;
+      }
+    }
+    terms[i] = term;
+  }
+  return terms;
+}
+
 function termLabelText(term) {
   if (term.label) {
     return term.label;
@@ -16,6 +16,8 @@ function WaveformVisualizer(visualizerID, customWavesurferSettings, customSettin
 
   // Public member variables
   this.audio_fragments = [];
+  // Object URLs for the prefetched WAV clips of individual AudioFragments, by AudioFragment ID
+  this.audioFragmentClipURLs = {};
   this.visualizerID = visualizerID;
   this.wavesurfer = Object.create(WaveSurfer);
 
@@ -32,6 +34,13 @@ function WaveformVisualizer(visualizerID, customWavesurferSettings, customSettin
   this.wavesurfer.on('region-in', function(marker) {
     updateActiveDocumentForAudioFragment(marker);
   });
+  // Clicking on an AudioFragment of a term audio clip plays just that AudioFragment
+  this.wavesurfer.on('region-click', function(region, event) {
+    if (self.audio_fragments[region.id]) {
+      event.stopPropagation();
+      self.playAudioFragment(self.audio_fragments[region.id].audio_fragment_id);
+    }
+  });
 
   defaultSettings = {
     controlsResizeCallback: undefined
@@ -114,23 +123,105 @@ function WaveformVisualizer(visualizerID, customWavesurferSettings, customSettin
    * @param {String} audioSourceURL
    */
   this.loadURL = function(audioSourceURL) {
-    var corpus_id, i, term_id;
+    var corpus_id, i, query_string, term_id;
 
     this.wavesurfer.load(audioSourceURL);
 
     // If audio clip is a term audio clip composed of multiple audio events,
     // add markers to waveform at audio event boundaries
-    var matches = /(\d+)\/term\/(\d+).wav/g.exec(audioSourceURL);
+    var matches = /(\d+)\/term\/(\d+).wav(\?.*)?$/g.exec(audioSourceURL);
     if (matches) {
       corpus_id = matches[1];
       term_id = matches[2];
+      // Any 'count', 'offset' and 'order' parameters for the audio clip
+      // select the same audio fragments from the JSON view.  Without any
+      // parameters the JSON view returns all of the audio fragments, so
+      // an explicit offset selects the audio fragments of the default clip.
+      query_string = matches[3] || '?offset=0';
 
-      $.getJSON('/visualizer/' + corpus_id + '/term/' + term_id + "_audio_fragments.json", function(audio_fragments) {
+      $.getJSON('/visualizer/' + corpus_id + '/term/' + term_id + "_audio_fragments.json" + query_string, function(audio_fragments) {
         updateAudioFragments(corpus_id, audio_fragments);
+        // Prefetch the AudioFragments of the term, so that each one can be played on its own
+        if (audio_fragments.length > 0) {
+          self.prefetchAudioFragmentClips(corpus_id, audio_fragments.map(function(af) { return af.audio_fragment_id; }));
+        }
       });
     }
   };
 
+  /** Draw the waveform using peaks computed by the server, and stream the
+   *  audio from a URL as it plays, instead of downloading and decoding the
+   *  whole audio file before drawing the waveform
+   * @param {String} audioSourceURL
+   * @param {String} peaksURL - URL for the 'document_peaks_json' view
+   */
+  this.loadURLWithPeaks = function(audioSourceURL, peaksURL) {
+    // Non-WAV audio files are converted by the server in the background,
+    // and the server responds with '202 Accepted' until the WAV file is ready
+    $.ajax({ type: 'HEAD', url: audioSourceURL }).done(function(data, textStatus, jqXHR) {
+      if (jqXHR.status === 202) {
+        var retryAfter = parseInt(jqXHR.getResponseHeader('Retry-After'), 10) || 2;
+        setTimeout(function() {
+          self.loadURLWithPeaks(audioSourceURL, peaksURL);
+        }, retryAfter * 1000);
+      }
+      else {
+        loadMediaWithPeaks(audioSourceURL, peaksURL);
+      }
+    }).fail(function(jqXHR) {
+      // The server responds with '500 Internal Server Error' if the conversion failed
+      if (jqXHR.status >= 500) {
+        self.wavesurfer.fireEvent('error', 'Unable to load audio: ' + jqXHR.status + ' ' + jqXHR.statusText);
+      }
+      else {
+        loadMediaWithPeaks(audioSourceURL, peaksURL);
+      }
+    });
+  };
+
+  /** Play the (prefetched) WAV clip for a single AudioFragment
+   * @param {Number} audioFragmentID
+   */
+  this.playAudioFragment = function(audioFragmentID) {
+    if (self.audioFragmentClipURLs[audioFragmentID]) {
+      self.wavesurfer.pause();
+      new Audio(self.audioFragmentClipURLs[audioFragmentID]).play();
+    }
+  };
+
+  /** Download the WAV clips for a list of AudioFragments using a single request
+   *
+   * The 'audio_fragment_wav_files' view returns a record for each
+   * AudioFragment, with the AudioFragment ID and the size of the WAV
+   * file (as little-endian 32-bit unsigned integers), followed by the
+   * contents of the WAV file.
+   * @param {String} corpus_id
+   * @param {Array} audioFragmentIDs - at most 200 IDs
+   */
+  this.prefetchAudioFragmentClips = function(corpus_id, audioFragmentIDs) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/visualizer/' + corpus_id + '/audio_fragments.bin?ids=' + audioFragmentIDs.join(','));
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+      var audioFragmentID, dataView, offset = 0, size;
+      if (xhr.status !== 200) {
+        return;
+      }
+      dataView = new DataView(xhr.response);
+      while (offset + 8 <= xhr.response.byteLength) {
+        audioFragmentID = dataView.getUint32(offset, true);
+        size = dataView.getUint32(offset + 4, true);
+        if (self.audioFragmentClipURLs[audioFragmentID]) {
+          URL.revokeObjectURL(self.audioFragmentClipURLs[audioFragmentID]);
+        }
+        self.audioFragmentClipURLs[audioFragmentID] = URL.createObjectURL(
+          new Blob([xhr.response.slice(offset + 8, offset + 8 + size)], { type: 'audio/wav' }));
+        offset += 8 + size;
+      }
+    };
+    xhr.send();
+  };
+
   this.play = function() {
     rewindIfNecessary();
     self.wavesurfer.play();
@@ -162,6 +253,54 @@ function WaveformVisualizer(visualizerID, customWavesurferSettings, customSettin
     return s;
   };
 
+  var loadMediaWithPeaks = function(audioSourceURL, peaksURL) {
+    var media;
+
+    self.wavesurfer.empty();
+    media = self.wavesurfer.createMedia(audioSourceURL);
+    media.preload = 'metadata';
+    self.wavesurfer.media = media;
+    self.wavesurfer.backend.loadMedia(media);
+
+    // The width of the waveform depends on the duration of the audio
+    var drawPeaks = function() {
+      var duration = self.wavesurfer.getDuration();
+      var length;
+      if (self.wavesurfer.params.fillParent && !self.wavesurfer.params.scrollParent) {
+        length = self.wavesurfer.drawer.getWidth();
+      } else {
+        length = Math.round(duration * self.wavesurfer.minPxPerSec * self.wavesurfer.params.pixelRatio);
+      }
+
+      $.getJSON(peaksURL, { peaks_per_second: length / duration }, function(peaksJSON, textStatus, jqXHR) {
+        // The server responds with '202 Accepted' until it has computed the peaks
+        if (jqXHR.status === 202) {
+          setTimeout(drawPeaks, (parseInt(jqXHR.getResponseHeader('Retry-After'), 10) || 2) * 1000);
+          return;
+        }
+
+        // The server returns interleaved minimum and maximum 16-bit sample
+        // values, but WaveSurfer draws waveforms using absolute values
+        var i, peaks = new Float32Array(peaksJSON.peaks.length / 2);
+        for (i = 0; i < peaks.length; i++) {
+          peaks[i] = Math.max(-peaksJSON.peaks[2*i], peaksJSON.peaks[2*i + 1]) / 32768.0;
+        }
+        self.wavesurfer.drawer.drawPeaks(peaks, length);
+        self.wavesurfer.redrawMarks();
+        self.wavesurfer.fireEvent('ready');
+      }).fail(function() {
+        // Fall back to decoding the audio in the browser
+        self.loadURL(audioSourceURL);
+      });
+    };
+    if (media.readyState >= media.HAVE_METADATA) {
+      drawPeaks();
+    }
+    else {
+      media.addEventListener('loadedmetadata', drawPeaks);
+    }
+  };
+
   var resetActiveDocumentButtons = function() {
     var
       i,
@@ -1,3 +1,1174 @@
-from django.test import TestCase
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from visualizer import audio, models, views, zrtools
+from visualizer.file_cache import FileCache
+from visualizer.management.commands.ctm_export import _audio_fragments
+from visualizer.models import AudioFragment, AudioSignalInfo, Corpus, Document, DocumentTermStats, DocumentTopicTermInfo, Term, TermStats
+from visualizer.search import SEARCH_INDEX_TABLES, search_terms
+
+
+def create_corpus(name, total_documents, total_terms, audio_fragments_per_term):
+    """Create a Corpus where each Term has AudioFragments spread across all of the Documents
+    """
+    corpus = Corpus.objects.create(name=name, audio_rate=8000, audio_channels=1, audio_precision=16)
+    documents = []
+    for document_index in range(total_documents):
+        documents.append(Document.objects.create(
+            corpus=corpus, document_index=document_index, duration=6000,
+            audio_identifier='%s_%d' % (name, document_index),
+            audio_path='/nonexistent/%s_%d.wav' % (name, document_index)))
+    for term_index in range(total_terms):
+        # Only label some of the Terms
+        term = Term.objects.create(corpus=corpus, zr_term_index=term_index,
+                                   label='term%d' % term_index if term_index % 2 else '')
+        audio_fragments = []
+        for i in range(audio_fragments_per_term):
+            start_offset = (term_index * audio_fragments_per_term + i) * 10
+            audio_fragments.append(AudioFragment(
+                corpus=corpus, document=documents[i % total_documents], term=term,
+                zr_fragment_index=term_index * audio_fragments_per_term + i,
+                start_offset=start_offset, end_offset=start_offset + 10, duration=10, score=0.5))
+        AudioFragment.objects.bulk_create(audio_fragments)
+    corpus.update_term_stats()
+    return corpus
+
+
+def write_wav_file(path, rate, channels, total_frames):
+    """Write an integer PCM WAV file with 16-bit samples
+    """
+    sample_data = b''.join(struct.pack(str('<h'), i % 1000) for i in range(total_frames * channels))
+    with open(path, 'wb') as wav_file:
+        wav_file.write(audio.wav_header(rate, channels, 16, len(sample_data)) + sample_data)
+
+
+class AudioHeaderTests(TestCase):
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_directory)
+
+    def write_riff_file(self, name, chunks):
+        """Write a RIFF/WAVE file containing the (chunk_id, chunk_data) chunks, padded to even sizes
+        """
+        riff_data = b'WAVE'
+        for (chunk_id, chunk_data) in chunks:
+            riff_data += struct.pack(str('<4sI'), chunk_id, len(chunk_data)) + chunk_data
+            if len(chunk_data) % 2:
+                riff_data += b'\0'
+        path = os.path.join(self.tmp_directory, name)
+        with open(path, 'wb') as riff_file:
+            riff_file.write(struct.pack(str('<4sI'), b'RIFF', len(riff_data)) + riff_data)
+        return path
+
+    def fmt_chunk(self, format_tag, channels, rate, bits_per_sample, extension=b''):
+        block_align = channels * bits_per_sample // 8
+        return (b'fmt ', struct.pack(str('<HHIIHH'), format_tag, channels, rate, rate * block_align,
+                                     block_align, bits_per_sample) + extension)
+
+    def test_read_wav_layout(self):
+        wav_path = os.path.join(self.tmp_directory, 'stereo.wav')
+        write_wav_file(wav_path, 16000, 2, 100)
+        self.assertEqual(audio.read_wav_layout(wav_path), {
+            'format_tag': audio.WAVE_FORMAT_PCM, 'rate': 16000, 'channels': 2, 'precision': 16,
+            'block_align': 4, 'data_offset': 44, 'data_size': 400})
+
+    def test_read_wav_layout_odd_chunk_sizes(self):
+        wav_path = self.write_riff_file('odd.wav', [
+            (b'LIST', b'abc'),
+            self.fmt_chunk(audio.WAVE_FORMAT_PCM, 1, 8000, 8),
+            (b'junk', b'x'),
+            (b'data', b'\x80' * 11)])
+        wav_layout = audio.read_wav_layout(wav_path)
+        # RIFF header (12) + LIST (8 + 3 + 1 pad) + fmt (8 + 16) + junk (8 + 1 + 1 pad) + data header (8)
+        self.assertEqual((wav_layout['data_offset'], wav_layout['data_size']), (66, 11))
+        self.assertEqual((wav_layout['rate'], wav_layout['channels'], wav_layout['precision']), (8000, 1, 8))
+
+    def test_read_wav_layout_placeholder_data_size(self):
+        wav_path = os.path.join(self.tmp_directory, 'streamed.wav')
+        with open(wav_path, 'wb') as wav_file:
+            wav_file.write(audio.wav_header(8000, 1, 16, 0)[:-4] + struct.pack(str('<I'), 0xFFFFFFFF) + b'\0' * 100)
+        self.assertEqual(audio.read_wav_layout(wav_path)['data_size'], 100)
+
+    def test_read_wav_layout_extensible(self):
+        # 24 valid bits per sample, stored in 32-bit containers, with a PCM SubFormat GUID
+        extension = struct.pack(str('<HHI'), 22, 24, 0x4) + struct.pack(str('<H'), audio.WAVE_FORMAT_PCM) + b'\0' * 14
+        wav_path = self.write_riff_file('extensible.wav', [
+            self.fmt_chunk(audio.WAVE_FORMAT_EXTENSIBLE, 1, 48000, 32, extension),
+            (b'data', b'\0' * 40)])
+        wav_layout = audio.read_wav_layout(wav_path)
+        self.assertEqual((wav_layout['format_tag'], wav_layout['precision'], wav_layout['block_align']),
+                         (audio.WAVE_FORMAT_PCM, 24, 4))
+
+    def test_read_wav_layout_unsupported(self):
+        WAVE_FORMAT_ADPCM = 0x0002
+        extension = struct.pack(str('<HHI'), 22, 4, 0x4) + struct.pack(str('<H'), WAVE_FORMAT_ADPCM) + b'\0' * 14
+        wav_paths = [
+            self.write_riff_file('adpcm.wav', [self.fmt_chunk(WAVE_FORMAT_ADPCM, 1, 8000, 4), (b'data', b'\0' * 10)]),
+            self.write_riff_file('adpcm_extensible.wav', [
+                self.fmt_chunk(audio.WAVE_FORMAT_EXTENSIBLE, 1, 8000, 4, extension), (b'data', b'\0' * 10)]),
+            self.write_riff_file('data_before_fmt.wav', [
+                (b'data', b'\0' * 10), self.fmt_chunk(audio.WAVE_FORMAT_PCM, 1, 8000, 16)]),
+            self.write_riff_file('no_data.wav', [self.fmt_chunk(audio.WAVE_FORMAT_PCM, 1, 8000, 16)]),
+        ]
+        not_riff_path = os.path.join(self.tmp_directory, 'audio.flac')
+        with open(not_riff_path, 'wb') as not_riff_file:
+            not_riff_file.write(b'fLaC' + b'\0' * 100)
+        for wav_path in wav_paths + [not_riff_path]:
+            self.assertIsNone(audio.read_wav_layout(wav_path), wav_path)
+
+    def test_probe_signal_infos(self):
+        audio_paths = [os.path.join(self.tmp_directory, name) for name in ('mono.wav', 'missing.wav', 'stereo.wav')]
+        write_wav_file(audio_paths[0], 8000, 1, 12345)
+        write_wav_file(audio_paths[2], 16000, 2, 500)
+        # The 'length' is summed across all channels
+        expected_signal_infos = [{'rate': 8000, 'channels': 1, 'precision': 16, 'length': 12345},
+                                 None,
+                                 {'rate': 16000, 'channels': 2, 'precision': 16, 'length': 1000}]
+        self.assertEqual([audio.probe_signal_info(audio_path) for audio_path in audio_paths], expected_signal_infos)
+        self.assertEqual(audio.probe_signal_infos(audio_paths), expected_signal_infos)
+        self.assertEqual(audio.probe_signal_infos(audio_paths, workers=2), expected_signal_infos)
+        self.assertEqual(audio.duration_in_hundredths(expected_signal_infos[0], 8000, 1), 154)
+
+
+class AudioSignalInfoTests(TestCase):
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+        self.audio_paths = [os.path.join(self.tmp_directory, name) for name in ('a.wav', 'missing.wav', 'b.wav')]
+        write_wav_file(self.audio_paths[0], 8000, 1, 1000)
+        write_wav_file(self.audio_paths[2], 16000, 2, 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_directory)
+
+    def test_lookup_miss(self):
+        signal_infos = AudioSignalInfo.lookup(self.audio_paths)
+        self.assertEqual(signal_infos, [{'rate': 8000, 'channels': 1, 'precision': 16, 'length': 1000},
+                                        None,
+                                        {'rate': 16000, 'channels': 2, 'precision': 16, 'length': 1000}])
+        # Missing files are not cached
+        self.assertEqual(sorted(AudioSignalInfo.objects.values_list('path', 'size')),
+                         sorted([(self.audio_paths[0], 2044), (self.audio_paths[2], 2044)]))
+
+    def test_lookup_hit(self):
+        AudioSignalInfo.lookup(self.audio_paths)
+        # Cache entries for unchanged files are used without reading the files again
+        AudioSignalInfo.objects.filter(path=self.audio_paths[0]).update(rate=11025)
+        with self.assertNumQueries(1):
+            signal_infos = AudioSignalInfo.lookup(self.audio_paths)
+        self.assertEqual(signal_infos[0]['rate'], 11025)
+        self.assertEqual(signal_infos[2]['rate'], 16000)
+
+    def test_lookup_changed_file(self):
+        AudioSignalInfo.lookup(self.audio_paths)
+        AudioSignalInfo.objects.filter(path=self.audio_paths[0]).update(rate=11025)
+        # Changing the size of a file invalidates its cache entry
+        write_wav_file(self.audio_paths[0], 8000, 1, 2000)
+        signal_infos = AudioSignalInfo.lookup(self.audio_paths)
+        self.assertEqual((signal_infos[0]['rate'], signal_infos[0]['length']), (8000, 2000))
+        self.assertEqual(AudioSignalInfo.objects.get(path=self.audio_paths[0]).size, 4044)
+        self.assertEqual(AudioSignalInfo.objects.count(), 2)
+
+    def test_lookup_relative_path(self):
+        AudioSignalInfo.lookup(self.audio_paths)
+        relative_path = os.path.relpath(self.audio_paths[2])
+        with self.assertNumQueries(1):
+            self.assertEqual(AudioSignalInfo.lookup([relative_path])[0]['rate'], 16000)
+
+
+class CacheVersionTests(TestCase):
+    def test_save_keeps_cache_version(self):
+        corpus = create_corpus('corpus', total_documents=2, total_terms=2, audio_fragments_per_term=2)
+        stale_corpus = Corpus.objects.get(id=corpus.id)
+        cache_version = stale_corpus.cache_version
+        self.assertGreater(cache_version, 0)
+        corpus.update_term_stats()
+        stale_corpus.name = 'renamed'
+        stale_corpus.save()
+        corpus.refresh_from_db()
+        self.assertEqual(corpus.name, 'renamed')
+        self.assertEqual(corpus.cache_version, cache_version + 1)
+
+    def test_cache_version_not_editable(self):
+        self.assertFalse(Corpus._meta.get_field('cache_version').editable)
+
+
+class CorpusImportTests(TransactionTestCase):
+    """The bulk corpus imports should create the same rows as the original per-row imports
+    """
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+        write_wav_file(os.path.join(self.tmp_directory, 'a.wav'), 8000, 1, 12345)
+        write_wav_file(os.path.join(self.tmp_directory, 'c.wav'), 8000, 1, 4000)
+        # The audio file for Document 'b' is missing
+        logging.disable(logging.WARNING)
+        self.objects_per_bulk_operation = Corpus.OBJECTS_PER_BULK_OPERATION
+        Corpus.OBJECTS_PER_BULK_OPERATION = 2
+
+    def tearDown(self):
+        Corpus.OBJECTS_PER_BULK_OPERATION = self.objects_per_bulk_operation
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmp_directory)
+
+    def write_file(self, name, lines):
+        path = os.path.join(self.tmp_directory, name)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+        return path
+
+    def corpus_rows(self, corpus):
+        return ((corpus.name, corpus.audio_rate, corpus.audio_channels, corpus.audio_precision),
+                list(corpus.document_set.order_by('document_index').values_list(
+                    'document_index', 'audio_identifier', 'audio_path', 'duration')),
+                list(corpus.term_set.order_by('zr_term_index').values_list('zr_term_index', 'label')),
+                list(AudioFragment.objects.filter(corpus=corpus).order_by('zr_fragment_index').values_list(
+                    'document__audio_identifier', 'term__zr_term_index', 'zr_fragment_index',
+                    'start_offset', 'end_offset', 'duration', 'score')))
+
+    def create_from_zr_output_per_row(self, corpus_name, audiofragments, clusters, filenames,
+                                      audio_rate, audio_channels, audio_precision, audio_directory):
+        """Create a Corpus one row at a time, the way create_from_zr_output() originally did
+        """
+        corpus = Corpus.objects.create(name=corpus_name, audio_rate=audio_rate, audio_channels=audio_channels,
+                                       audio_precision=audio_precision)
+        document_for_audio_identifier = {}
+        with open(filenames) as f:
+            for (document_index, full_filename) in enumerate(f.readlines()):
+                document = Document(corpus=corpus, document_index=document_index,
+                                    audio_identifier=os.path.splitext(os.path.basename(full_filename))[0].strip(),
+                                    audio_path=os.path.join(audio_directory, os.path.basename(full_filename)).strip())
+                signal_info = audio.probe_signal_info(document.audio_path)
+                if signal_info:
+                    length_in_seconds = signal_info['length'] / float(audio_rate * audio_channels)
+                    document.duration = int(length_in_seconds * 100)
+                else:
+                    document.duration = 0
+                document.save()
+                document_for_audio_identifier[document.audio_identifier] = document
+
+        term_for_audio_fragment_index = {}
+        with open(clusters) as f:
+            for (term_index, cluster_line) in enumerate(f.readlines()):
+                term = Term.objects.create(corpus=corpus, label='', zr_term_index=term_index)
+                for audio_fragment_index in cluster_line.split():
+                    term_for_audio_fragment_index[int(audio_fragment_index)] = term
+
+        with open(audiofragments) as f:
+            for (audio_fragment_index, line) in enumerate(f.readlines(), start=1):
+                if audio_fragment_index in term_for_audio_fragment_index:
+                    (audio_identifier, start, end, score, ignore1, ignore2) = line.split()
+                    AudioFragment.objects.create(
+                        corpus=corpus, document=document_for_audio_identifier[audio_identifier],
+                        term=term_for_audio_fragment_index[audio_fragment_index],
+                        zr_fragment_index=audio_fragment_index, start_offset=int(start), end_offset=int(end),
+                        duration=int(end) - int(start), score=score)
+        return corpus
+
+    def create_from_ctm_file_per_row(self, corpus_name, ctm_file_path, audio_directory, audio_extension):
+        """Create a Corpus one row at a time, the way create_from_ctm_file() originally did
+        """
+        corpus = Corpus(name=corpus_name)
+        document_for_audio_identifier = {}
+        term_for_keyword = {}
+        with open(ctm_file_path) as f:
+            lines = [line for line in f if line.strip() and line.strip()[0:2] != ';;']
+        for (zr_fragment_index, line) in enumerate(lines):
+            fields = line.split()
+            (audio_identifier, start_offset, duration, keyword) = \
+                (fields[0], int(float(fields[2]) * 100), int(float(fields[3]) * 100), fields[4])
+            if audio_identifier not in document_for_audio_identifier:
+                audio_path = os.path.join(audio_directory, audio_identifier + "." + audio_extension)
+                if not document_for_audio_identifier:
+                    signal_info = audio.probe_signal_info(audio_path)
+                    corpus.audio_rate = signal_info['rate']
+                    corpus.audio_channels = signal_info['channels']
+                    corpus.audio_precision = signal_info['precision']
+                    corpus.save()
+                signal_info = audio.probe_signal_info(audio_path)
+                if signal_info:
+                    length_in_seconds = signal_info['length'] / float(corpus.audio_rate * corpus.audio_channels)
+                    duration_in_hundredths = int(length_in_seconds * 100)
+                else:
+                    duration_in_hundredths = 0
+                document_for_audio_identifier[audio_identifier] = Document.objects.create(
+                    corpus=corpus, document_index=len(document_for_audio_identifier), audio_path=audio_path,
+                    audio_identifier=audio_identifier, duration=duration_in_hundredths)
+            if keyword not in term_for_keyword:
+                term_for_keyword[keyword] = Term.objects.create(corpus=corpus, label=keyword,
+                                                                zr_term_index=len(term_for_keyword))
+            AudioFragment.objects.create(
+                corpus=corpus, document=document_for_audio_identifier[audio_identifier],
+                term=term_for_keyword[keyword], zr_fragment_index=zr_fragment_index, start_offset=start_offset,
+                end_offset=start_offset + duration, duration=duration, score=0)
+        return corpus
+
+    def test_create_from_ctm_file(self):
+        # The Documents and Terms are interleaved, and their order is the order of first appearance
+        ctm_file_path = self.write_file('corpus.ctm', [
+            ';; A comment\n',
+            'a 1 0.50 0.25 hello\n',
+            'b 1 1.00 0.30 world\n',
+            '\n',
+            'a 1 2.00 0.10 world\n',
+            'c 1 0.20 0.40 again\n',
+            'b 1 3.00 0.55 hello\n',
+            'c 1 0.90 0.15 goodbye\n',
+            'a 1 1.25 0.05 again 0.9\n',
+        ])
+        corpus = Corpus()
+        corpus.create_from_ctm_file('ctm', ctm_file_path, self.tmp_directory, 'wav')
+        expected_corpus = self.create_from_ctm_file_per_row('ctm', ctm_file_path, self.tmp_directory, 'wav')
+
+        rows = self.corpus_rows(corpus)
+        self.assertEqual(rows, self.corpus_rows(expected_corpus))
+        self.assertEqual([document[1] for document in rows[1]], ['a', 'b', 'c'])
+        self.assertEqual(rows[2], [(0, 'hello'), (1, 'world'), (2, 'again'), (3, 'goodbye')])
+        self.assertEqual(len(rows[3]), 7)
+
+    def test_create_from_zr_output(self):
+        zr_output_paths = (
+            # Nodes 3 and 7 are not part of any cluster, and the last node is part of a cluster
+            self.write_file('master_graph.nodes', [
+                'a\t100\t150\t0.9\t0\t0\n',
+                'b\t200\t260\t0.8\t0\t0\n',
+                'a\t300\t340\t0.7\t0\t0\n',
+                'c\t100\t170\t0.6\t0\t0\n',
+                'a\t500\t550\t0.5\t0\t0\n',
+                'b\t600\t680\t0.4\t0\t0\n',
+                'c\t700\t710\t0.3\t0\t0\n',
+                'a\t800\t890\t0.2\t0\t0\n',
+            ]),
+            # The third (empty) cluster is a Term without any AudioFragments
+            self.write_file('master_graph.dedups', ['1 2 8\n', '4 5 6\n', '\n']),
+            self.write_file('files.lst', ['/audio/a.wav\n', '/audio/b.wav\n', '/audio/c.wav\n']),
+        )
+        corpus = Corpus()
+        corpus.create_from_zr_output('zr', *zr_output_paths, audio_rate=8000, audio_channels=1,
+                                     audio_precision=16, audio_directory=self.tmp_directory)
+        expected_corpus = self.create_from_zr_output_per_row('zr', *zr_output_paths, audio_rate=8000,
+                                                             audio_channels=1, audio_precision=16,
+                                                             audio_directory=self.tmp_directory)
+
+        rows = self.corpus_rows(corpus)
+        self.assertEqual(rows, self.corpus_rows(expected_corpus))
+        self.assertEqual([document[3] for document in rows[1]], [154, 0, 50])
+        self.assertEqual([audio_fragment[2] for audio_fragment in rows[3]], [1, 2, 4, 5, 6, 8])
+
+
+# Failed background jobs are recorded in the cache
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DocumentAudioTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tmp_directory = tempfile.mkdtemp()
+        # Keep the converted audio files for the tests out of the real cache directory
+        self.cache_directory = models.document_audio_cache.directory
+        models.document_audio_cache.directory = os.path.join(self.tmp_directory, 'cache')
+        self.corpus = Corpus.objects.create(name='corpus', audio_rate=8000, audio_channels=1, audio_precision=16)
+        self.sample_data = b''.join(struct.pack(str('<h'), (i * 37) % 2000 - 1000) for i in range(8000))
+        self.wav_data = audio.wav_header(8000, 1, 16, len(self.sample_data)) + self.sample_data
+        self.wav_document = self.create_document('document.wav', self.wav_data)
+        self.flac_document = self.create_document('document.flac', b'not really FLAC')
+
+    def tearDown(self):
+        models.document_audio_cache.directory = self.cache_directory
+        shutil.rmtree(self.tmp_directory)
+
+    def create_document(self, filename, data):
+        audio_path = os.path.join(self.tmp_directory, filename)
+        with open(audio_path, 'wb') as f:
+            f.write(data)
+        return Document.objects.create(corpus=self.corpus, document_index=Document.objects.count(),
+                                       audio_identifier=filename, audio_path=audio_path, duration=100)
+
+    def get_peaks_json(self, document, params):
+        return self.client.get('/visualizer/%d/document/%d/peaks.json' % (self.corpus.id, document.id), params)
+
+    def get_wav_file(self, document, **extra):
+        return self.client.get('/visualizer/%d/document/%d.wav' % (self.corpus.id, document.id), **extra)
+
+    def wait_for_background_jobs(self):
+        for _ in range(100):
+            if not models._background_jobs:
+                return
+            time.sleep(0.05)
+        self.fail('Background jobs did not finish')
+
+    def test_audio_fragment_wav_file(self):
+        term = Term.objects.create(corpus=self.corpus, zr_term_index=0, label='')
+        audio_fragment = AudioFragment.objects.create(
+            corpus=self.corpus, document=self.wav_document, term=term, zr_fragment_index=0,
+            start_offset=10, end_offset=30, duration=20, score=0.5)
+        response = self.client.get('/visualizer/%d/audio_fragment/%d.wav' % (self.corpus.id, audio_fragment.id))
+        self.assertEqual(response.status_code, 200)
+        # 0.1 to 0.3 seconds of 8kHz 16-bit audio
+        self.assertEqual(response.content, audio.wav_header(8000, 1, 16, 3200) + self.sample_data[1600:4800])
+
+    def test_audio_fragment_wav_files(self):
+        term = Term.objects.create(corpus=self.corpus, zr_term_index=0, label='')
+        audio_fragments = [AudioFragment.objects.create(
+            corpus=self.corpus, document=self.wav_document, term=term, zr_fragment_index=i,
+            start_offset=start_offset, end_offset=start_offset + 20, duration=20, score=0.5)
+            for (i, start_offset) in enumerate((50, 10))]
+        other_corpus = create_corpus('other', total_documents=1, total_terms=1, audio_fragments_per_term=1)
+        ids = [audio_fragments[0].id, 999999, other_corpus.audiofragment_set.get().id, audio_fragments[1].id]
+        url = '/visualizer/%d/audio_fragments.bin' % self.corpus.id
+        response = self.client.get(url, {'ids': ','.join(str(af_id) for af_id in ids)})
+        self.assertEqual(response.status_code, 200)
+
+        # Unknown AudioFragments, and AudioFragments of other Corpora, are skipped
+        records = []
+        content = response.content
+        while content:
+            (audio_fragment_id, size) = struct.unpack(str('<II'), content[:8])
+            records.append((audio_fragment_id, content[8:8 + size]))
+            content = content[8 + size:]
+        self.assertEqual(records, [
+            (audio_fragments[0].id, audio.wav_header(8000, 1, 16, 3200) + self.sample_data[8000:11200]),
+            (audio_fragments[1].id, audio.wav_header(8000, 1, 16, 3200) + self.sample_data[1600:4800]),
+        ])
+
+        self.assertEqual(self.client.get(url, {'ids': '1,x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'ids': ','.join(['1'] * 200)}).status_code, 200)
+        self.assertEqual(self.client.get(url, {'ids': ','.join(['1'] * 201)}).status_code, 400)
+
+    def test_document_peaks_json(self):
+        # Under Python 2 the background thread cannot open the in-memory test
+        # database, so the peaks are computed by the test instead
+        logging.disable(logging.ERROR)
+        try:
+            response = self.get_peaks_json(self.wav_document, {'peaks_per_second': 50})
+            self.assertEqual(response.status_code, 202)
+            self.assertIn('Retry-After', response)
+            self.wait_for_background_jobs()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.wav_document.compute_waveform_peaks()
+
+        # The coarsest zoom level with at least 50 peaks per second
+        response = self.get_peaks_json(self.wav_document, {'peaks_per_second': 50})
+        self.assertEqual(response.status_code, 200)
+        peaks_json = json.loads(response.content)
+        self.assertEqual(peaks_json['samples_per_peak'], 160)
+        self.assertEqual(peaks_json['peaks_per_second'], 50.0)
+        self.assertEqual(len(peaks_json['peaks']), 2 * 50)
+
+        response = self.get_peaks_json(self.wav_document, {'peaks_per_second': 1000})
+        self.assertEqual(json.loads(response.content)['samples_per_peak'], 40)
+
+    def test_document_peaks_json_failed(self):
+        broken_document = self.create_document('broken.wav', b'not really WAV')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual(self.get_peaks_json(broken_document, {}).status_code, 202)
+            self.wait_for_background_jobs()
+            # The failure is reported, instead of asking the client to retry forever
+            response = self.get_peaks_json(broken_document, {})
+            self.assertEqual(response.status_code, 500)
+            self.assertFalse(response.has_header('Retry-After'))
+            self.assertFalse(models._background_jobs)
+
+            # The job is started again once the failure has expired
+            cache.clear()
+            self.assertEqual(self.get_peaks_json(broken_document, {}).status_code, 202)
+            self.wait_for_background_jobs()
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_document_peaks_json_invalid_peaks_per_second(self):
+        response = self.get_peaks_json(self.wav_document, {'peaks_per_second': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_document_wav_file(self):
+        response = self.get_wav_file(self.wav_document)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.wav_data)
+
+    def test_document_wav_file_byte_ranges(self):
+        size = len(self.wav_data)
+        for (byte_range, first, last) in (('bytes=0-99', 0, 99),
+                                          ('bytes=100-', 100, size - 1),
+                                          ('bytes=100-1000000', 100, size - 1),
+                                          ('bytes=-500', size - 500, size - 1),
+                                          ('bytes=-1000000', 0, size - 1)):
+            response = self.get_wav_file(self.wav_document, HTTP_RANGE=byte_range, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 206, byte_range)
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (first, last, size))
+            self.assertEqual(response['Content-Length'], str(last - first + 1))
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content), self.wav_data[first:last + 1])
+
+    def test_document_wav_file_if_range(self):
+        last_modified = self.get_wav_file(self.wav_document)['Last-Modified']
+        response = self.get_wav_file(self.wav_document, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE=last_modified)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.wav_data[100:200])
+
+        # The file has changed since the client's first request
+        response = self.get_wav_file(self.wav_document, HTTP_RANGE='bytes=100-199',
+                                     HTTP_IF_RANGE='Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.wav_data)
+
+    def test_document_wav_file_invalid_byte_ranges(self):
+        # Invalid or multiple ranges are ignored
+        for byte_range in ('bytes=500-100', 'bytes=0-99,200-299', 'lines=1-2'):
+            response = self.get_wav_file(self.wav_document, HTTP_RANGE=byte_range, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 200, byte_range)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content), self.wav_data)
+
+        # Ranges that start after the end of the file cannot be satisfied
+        for byte_range in ('bytes=%d-' % len(self.wav_data), 'bytes=1000000-1000100', 'bytes=-0'):
+            response = self.get_wav_file(self.wav_document, HTTP_RANGE=byte_range)
+            self.assertEqual(response.status_code, 416, byte_range)
+            self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.wav_data))
+
+    def test_document_wav_file_being_converted(self):
+        # The fake FLAC file cannot be converted, so the background job fails
+        logging.disable(logging.ERROR)
+        try:
+            response = self.get_wav_file(self.flac_document)
+            self.assertEqual(response.status_code, 202)
+            self.assertIn('Retry-After', response)
+            self.wait_for_background_jobs()
+
+            # The failure is reported, instead of asking the client to retry forever
+            response = self.get_wav_file(self.flac_document)
+            self.assertEqual(response.status_code, 500)
+            self.assertFalse(response.has_header('Retry-After'))
+
+            # The conversion is retried when the audio file changes
+            with open(self.flac_document.audio_path, 'ab') as f:
+                f.write(b'!')
+            self.assertEqual(self.get_wav_file(self.flac_document).status_code, 202)
+            self.wait_for_background_jobs()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        models.document_audio_cache.put(models._transcode_cache_key(self.flac_document.audio_path), self.wav_data)
+        response = self.get_wav_file(self.flac_document)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.wav_data)
+
+    def test_waveform_peaks(self):
+        samples = struct.unpack(str('<%dh' % (len(self.sample_data) // 2)), self.sample_data)
+        document_peaks = self.wav_document.compute_waveform_peaks()
+        self.assertEqual([dp.samples_per_peak for dp in document_peaks], [40, 160, 640])
+        for dp in document_peaks:
+            peak_values = dp.peak_values()
+            self.assertEqual(len(peak_values), 2 * -(-len(samples) // dp.samples_per_peak))
+            self.assertEqual(list(peak_values[:2]), [min(samples[:dp.samples_per_peak]),
+                                                     max(samples[:dp.samples_per_peak])])
+        self.assertEqual([dp.peak_values() for dp in self.wav_document.waveform_peaks()],
+                         [dp.peak_values() for dp in document_peaks])
+
+
+class FileCacheTests(TestCase):
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.tmp_directory, 100)
+        self.term_clip_cache = views.term_clip_cache
+
+    def tearDown(self):
+        views.term_clip_cache = self.term_clip_cache
+        shutil.rmtree(self.tmp_directory)
+
+    def put(self, key, size, mtime=None):
+        path = self.cache.put(key, b'x' * size)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def use_term_clip_cache(self, max_bytes):
+        views.term_clip_cache = FileCache(os.path.join(self.tmp_directory, 'term_clips'), max_bytes, suffix='.wav')
+        os.mkdir(views.term_clip_cache.directory)
+
+    def create_term(self):
+        """Create a Term with AudioFragments of 0.4, 0.2 and 0.3 seconds (in ID order) in a WAV file
+        """
+        audio_path = os.path.join(self.tmp_directory, 'document.wav')
+        write_wav_file(audio_path, 8000, 1, 16000)
+        corpus = Corpus.objects.create(name='corpus', audio_rate=8000, audio_channels=1, audio_precision=16)
+        document = Document.objects.create(corpus=corpus, document_index=0, audio_identifier='document',
+                                           audio_path=audio_path, duration=200)
+        term = Term.objects.create(corpus=corpus, zr_term_index=0, label='')
+        for (i, duration) in enumerate((40, 20, 30)):
+            AudioFragment.objects.create(corpus=corpus, document=document, term=term, zr_fragment_index=i,
+                                         start_offset=i * 50, end_offset=i * 50 + duration, duration=duration,
+                                         score=0.5 + i * 0.1)
+        return term
+
+    def get_term_wav_file(self, term, params):
+        response = self.client.get('/visualizer/%d/term/%d.wav' % (term.corpus_id, term.id), params)
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def cached_term_clips(self):
+        return sorted(name for name in os.listdir(views.term_clip_cache.directory) if name.endswith('.wav'))
+
+    def test_evict_least_recently_used(self):
+        self.put('a', 40)
+        self.put('b', 40)
+        # A file added by another process is not counted until the directory is scanned
+        with open(self.cache.path_for('other'), 'wb') as f:
+            f.write(b'x' * 50)
+        self.put('c', 10)
+        self.assertTrue(all(self.cache.get(key) for key in ('a', 'b', 'other', 'c')))
+
+        # The running total exceeds max_bytes, so the directory is scanned
+        for (mtime, key) in enumerate(('a', 'b', 'other', 'c')):
+            os.utime(self.cache.path_for(key), (1000 + mtime, 1000 + mtime))
+        self.put('d', 20)
+        self.assertEqual([key for key in ('a', 'b', 'other', 'c', 'd') if os.path.exists(self.cache.path_for(key))],
+                         ['other', 'c', 'd'])
+
+    def test_scan_interval(self):
+        self.cache.SCAN_INTERVAL = -1
+        self.put('a', 40, mtime=1000)
+        with open(self.cache.path_for('other'), 'wb') as f:
+            f.write(b'x' * 50)
+        os.utime(self.cache.path_for('other'), (2000, 2000))
+        self.put('b', 40)
+        self.assertFalse(os.path.exists(self.cache.path_for('a')))
+        self.assertTrue(os.path.exists(self.cache.path_for('other')))
+
+    def test_term_wav_file_cached(self):
+        self.use_term_clip_cache(1000000)
+        term = self.create_term()
+        wav_data = self.get_term_wav_file(term, {})
+        self.assertEqual(len(wav_data), 44 + 2 * (3200 + 1600 + 2400))
+        self.assertEqual(len(self.cached_term_clips()), 1)
+
+        # The cached clip is served without reading the audio file again
+        os.remove(term.audiofragment_set.first().document.audio_path)
+        self.assertEqual(self.get_term_wav_file(term, {}), wav_data)
+
+    def test_term_wav_file_cache_key(self):
+        self.use_term_clip_cache(1000000)
+        term = self.create_term()
+        clips = [self.get_term_wav_file(term, params)
+                 for params in ({}, {'count': 2}, {'order': 'score'}, {'order': 'duration', 'count': 2})]
+        # Each order and count selects different AudioFragments, so each clip is cached separately
+        self.assertEqual(len(self.cached_term_clips()), 4)
+        self.assertEqual(len(set(clips)), 4)
+        self.assertEqual(self.get_term_wav_file(term, {'count': 2}), clips[1])
+        self.assertEqual(len(self.cached_term_clips()), 4)
+
+    def test_term_wav_file_eviction(self):
+        # Room for the 0.4 and 0.2 second clips, but not for the 0.3 second clip as well
+        self.use_term_clip_cache((44 + 6400) + (44 + 3200))
+        term = self.create_term()
+        clip_names = []
+        for offset in range(3):
+            cached_term_clips = self.cached_term_clips()
+            self.get_term_wav_file(term, {'count': 1, 'offset': offset})
+            (clip_name,) = set(self.cached_term_clips()) - set(cached_term_clips)
+            clip_names.append(clip_name)
+            # Each clip is used more recently than the clip for the previous offset
+            clip_path = os.path.join(views.term_clip_cache.directory, clip_name)
+            os.utime(clip_path, (1000 + offset, 1000 + offset))
+            if offset < 2:
+                self.assertEqual(self.cached_term_clips(), sorted(clip_names))
+
+        # The running total exceeds max_bytes, so the least recently used clip was evicted
+        self.assertEqual(self.cached_term_clips(), sorted(clip_names[1:]))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class QueryCountTests(TestCase):
+    """The number of SQL queries used by each view or command should not depend on the size of the corpus
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.small_corpus = create_corpus('small', total_documents=2, total_terms=2, audio_fragments_per_term=2)
+        cls.large_corpus = create_corpus('large', total_documents=8, total_terms=20, audio_fragments_per_term=10)
+
+    def assertConstantNumQueries(self, func):
+        """Assert that func(corpus) uses the same number of queries for the small and large corpora
+        """
+        num_queries = []
+        for corpus in (self.small_corpus, self.large_corpus):
+            with CaptureQueriesContext(connection) as context:
+                func(corpus)
+            num_queries.append(len(context))
+        self.assertEqual(num_queries[0], num_queries[1],
+                         'Small corpus used %d queries, large corpus used %d queries' % tuple(num_queries))
+
+    def assertColumnsMatchTerms(self, url):
+        """Assert that the columnar format of a terms.json URL has the same Terms as the default format
+        """
+        terms = self.get(url).json()['terms']
+        data = self.get(url + '?format=columns').json()
+        self.assertNotIn('audio_fragment_ids', data['columns'])
+        for (i, term) in enumerate(terms):
+            for (key, value) in term.items():
+                if key == 'term_id':
+                    self.assertEqual(data['columns']['id'][i], value)
+                elif key == 'corpus_id':
+                    self.assertEqual(data['corpus_id'], int(value))
+                elif key != 'audio_fragment_ids':
+                    self.assertEqual(data['columns'][key][i], value)
+
+    def assertQueryUsesIndex(self, sql, index_name_prefix):
+        """Assert that a query reads a table using an index, and does not sort the rows it reads
+        """
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        query_plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn(index_name_prefix, query_plan)
+        self.assertNotIn('TEMP B-TREE', query_plan)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_ctm_export(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            ctm_file_path = os.path.join(tmp_directory, 'export.ctm')
+            self.assertConstantNumQueries(
+                lambda corpus: call_command('ctm_export', corpus.name, ctm_file_path, stdout=StringIO()))
+            with open(ctm_file_path) as ctm_file:
+                self.assertEqual(len(ctm_file.readlines()), self.large_corpus.total_audio_fragments())
+        finally:
+            shutil.rmtree(tmp_directory)
+
+    def test_ctm_export_audio_fragments_order(self):
+        # The AudioFragments are streamed in index order, without sorting the whole corpus
+        documents = list(self.large_corpus.document_set.order_by('id'))
+        for args in ((False,), (True,), (False, documents[1].id, documents[2].id)):
+            with CaptureQueriesContext(connection) as queries:
+                list(_audio_fragments(self.large_corpus.id, *args))
+            self.assertQueryUsesIndex(queries[-1]['sql'], 'visualizer_audiofragment_corpus_id_document_id_start_offset')
+
+    def test_document_audio_fragments_as_json(self):
+        self.assertConstantNumQueries(lambda corpus: self.get('/visualizer/%d/document/%d/audio_fragments.json' %
+                                                              (corpus.id, corpus.document_set.first().id)))
+
+    def test_import_topics(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            for corpus in (self.small_corpus, self.large_corpus):
+                with open(os.path.join(tmp_directory, '%s.outputs' % corpus.name), 'w') as cluster_outputs_file:
+                    for document in corpus.document_set.all():
+                        cluster_outputs_file.write('%s %d\n' % (document.audio_identifier, document.document_index % 2))
+                with open(os.path.join(tmp_directory, '%s.nfeatures.log' % corpus.name), 'w') as nfeatures_file:
+                    for cluster_index in range(2):
+                        nfeatures_file.write('Cluster   %d, Size:    4, ISim: 0.028, ESim: 0.003\n' % cluster_index)
+                        nfeatures_file.write('      Descriptive:  col00001  1.8%, col00002  0.0%\n')
+                        nfeatures_file.write('   Discriminating:  col00002  1.1%, col00001  0.9%\n\n')
+            self.assertConstantNumQueries(
+                lambda corpus: call_command('import_topics', corpus.name,
+                                            os.path.join(tmp_directory, '%s.outputs' % corpus.name),
+                                            nfeatures_path=os.path.join(tmp_directory, '%s.nfeatures.log' % corpus.name),
+                                            topic_labels=['first'], stdout=StringIO()))
+        finally:
+            shutil.rmtree(tmp_directory)
+
+        document_topic = self.large_corpus.documenttopic_set.get(label='first')
+        self.assertEqual(document_topic.documents.count(), 4)
+        self.assertEqual(document_topic.documenttopicterminfo_set.count(), 3)
+        self.assertEqual(self.large_corpus.documenttopic_set.get(label='topic1').documents.count(), 4)
+
+    def test_index(self):
+        with self.assertNumQueries(1):
+            response = self.get('/')
+        self.assertContains(response, '20 Terms')
+        self.assertContains(response, '0:08:00 duration')
+
+    def test_with_summary_statistics(self):
+        empty_corpus = Corpus.objects.create(name='empty', audio_rate=8000, audio_channels=1, audio_precision=16)
+        corpora = Corpus.with_summary_statistics(Corpus.objects.order_by('id'))
+        self.assertEqual([(corpus.summary_documents, corpus.summary_document_topics, corpus.summary_terms,
+                           corpus.summary_duration) for corpus in corpora],
+                         [(2, 0, 2, 12000), (8, 0, 20, 48000), (0, 0, 0, 0)])
+        # Without the summary statistics, the duration is read using another query
+        for (corpus, summary_corpus) in zip(Corpus.objects.order_by('id'), corpora):
+            with self.assertNumQueries(1):
+                self.assertEqual(corpus.duration_in_seconds(), summary_corpus.duration_in_seconds())
+        self.assertEqual(empty_corpus.duration_as_hh_mm_ss(), '0:00:00')
+
+    def test_lorelei_situation_frames_json(self):
+        for corpus in (self.small_corpus, self.large_corpus):
+            corpus.add_document_topics((document.audio_identifier, 'topic%d' % (document.document_index % 3))
+                                       for document in corpus.document_set.all())
+        self.assertConstantNumQueries(lambda corpus: b''.join(
+            self.get('/visualizer/%d/lorelei_situation_frames.json' % corpus.id).streaming_content))
+        response = self.get('/visualizer/%d/lorelei_situation_frames.json' % self.large_corpus.id)
+        situation_frames = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(situation_frames), 8)
+        self.assertEqual(situation_frames[0], {'DocumentID': 'large_0', 'Type': 'topic0', 'TypeConfidence': 1.0})
+
+        # The gzip file is not compressed again by the GZip middleware
+        response = self.client.get('/visualizer/%d/lorelei_situation_frames.json?gzip=1' % self.large_corpus.id,
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        gzip_content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(zlib.decompress(gzip_content, 16 + zlib.MAX_WBITS).decode('utf-8')),
+                         situation_frames)
+
+    def test_term_audio_fragments_as_json(self):
+        term = self.large_corpus.term_set.first()
+        with self.assertNumQueries(2):
+            response = self.get('/visualizer/%d/term/%d_audio_fragments.json?count=10' % (self.large_corpus.id, term.id))
+        self.assertEqual(len(response.json()), 10)
+        self.assertEqual(response.json()[0]['audio_identifier'], 'large_0')
+        self.assertConstantNumQueries(lambda corpus: self.get('/visualizer/%d/term/%d_audio_fragments.json' %
+                                                              (corpus.id, corpus.term_set.first().id)))
+
+    def test_term_audio_fragments_orders(self):
+        # Each order reads the AudioFragments of the Term from an index, without sorting them
+        term = self.large_corpus.term_set.first()
+        for (order, index_name_prefix) in (('', 'visualizer_audiofragment_term_id_id'),
+                                           ('document', 'visualizer_audiofragment_term_id_document_id_start_offset'),
+                                           ('duration', 'visualizer_audiofragment_term_id_duration'),
+                                           ('score', 'visualizer_audiofragment_term_id_score')):
+            with CaptureQueriesContext(connection) as queries:
+                self.get('/visualizer/%d/term/%d_audio_fragments.json?order=%s' % (self.large_corpus.id, term.id, order))
+            self.assertQueryUsesIndex(queries[-1]['sql'], index_name_prefix)
+
+    def test_wordcloud_json_for_corpus(self):
+        self.assertConstantNumQueries(lambda corpus: self.get('/visualizer/%d/terms.json' % corpus.id))
+        self.assertConstantNumQueries(lambda corpus: self.get('/visualizer/%d/terms.json?format=columns' % corpus.id))
+        self.assertColumnsMatchTerms('/visualizer/%d/terms.json' % self.large_corpus.id)
+
+    def test_wordcloud_json_for_corpus_page(self):
+        url = '/visualizer/%d/terms.json' % self.large_corpus.id
+        with self.assertNumQueries(2):
+            terms = self.get(url + '?sort=total_audio_fragments&limit=5').json()['terms']
+        self.assertEqual(len(terms), 5)
+        self.assertEqual(len(self.get(url + '?sort=label&offset=15').json()['terms']), 5)
+        self.assertEqual([term['label'] for term in self.get(url + '?sort=label&offset=10&limit=2').json()['terms']],
+                         ['term1', 'term11'])
+        self.assertEqual(len(self.get(url + '?min_documents=9').json()['terms']), 0)
+        for params in ('?limit=0', '?offset=-1', '?sort=id', '?min_documents=x'):
+            self.assertEqual(self.client.get(url + params).status_code, 400)
+
+    def test_wordcloud_json_for_corpus_label_order(self):
+        # The Terms are read in label order using an index, without sorting the whole corpus
+        with CaptureQueriesContext(connection) as queries:
+            self.get('/visualizer/%d/terms.json?sort=label&limit=5' % self.large_corpus.id)
+        self.assertQueryUsesIndex(queries[-1]['sql'], 'visualizer_term_corpus_id_label')
+
+    def test_wordcloud_json_for_document(self):
+        self.assertConstantNumQueries(lambda corpus: self.get('/visualizer/%d/document/%d/terms.json' %
+                                                              (corpus.id, corpus.document_set.first().id)))
+        self.assertColumnsMatchTerms('/visualizer/%d/document/%d/terms.json' %
+                                     (self.large_corpus.id, self.large_corpus.document_set.first().id))
+
+    def test_wordcloud_json_for_document_topic(self):
+        for corpus in (self.small_corpus, self.large_corpus):
+            corpus.add_document_topics(
+                ((document.audio_identifier, 'topic') for document in corpus.document_set.all()),
+                (('topic', 'Descriptive', zr_term_index, zr_term_index + 0.5) for zr_term_index in range(2)))
+        url = '/visualizer/%d/document_topic/%d/terms.json'
+        self.assertConstantNumQueries(lambda corpus: self.get(url % (corpus.id, corpus.documenttopic_set.get().id)))
+        document_topic = self.large_corpus.documenttopic_set.get()
+        terms = self.get(url % (self.large_corpus.id, document_topic.id) + '?sort=term_info_Descriptive').json()['terms']
+        self.assertEqual([term['zr_term_index'] for term in terms], [1, 0])
+        self.assertEqual(terms[0]['total_audio_fragments'], 10)
+        self.assertEqual(len(terms[0]['audio_fragment_ids']), 10)
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.corpus = create_corpus('search', total_documents=4, total_terms=20, audio_fragments_per_term=2)
+        cls.protected_corpus = create_corpus('protected', total_documents=2, total_terms=4, audio_fragments_per_term=2)
+        cls.protected_corpus.protected_corpus = True
+        cls.protected_corpus.save()
+
+    def search(self, params):
+        response = self.client.get('/visualizer/search.json?' + params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_documents(self):
+        documents = self.search('q=search_3')['documents']
+        self.assertEqual([document['audio_identifier'] for document in documents], ['search_3'])
+        self.assertEqual(len(self.search('q=EARCH')['documents']), 4)
+
+    def test_search_terms(self):
+        terms = self.search('q=rm1')['terms']
+        self.assertEqual([term['label'] for term in terms], ['term1', 'term11', 'term13', 'term15', 'term17', 'term19'])
+        self.assertEqual(terms[0]['corpus_name'], 'search')
+        # Queries that are shorter than a trigram
+        self.assertEqual(len(self.search('q=m1&corpus_id=%d' % self.corpus.id)['terms']), 6)
+        self.assertEqual(len(self.search('q=rm1&limit=2')['terms']), 2)
+        self.assertEqual(self.client.get('/visualizer/search.json?q=rm1&limit=0').status_code, 400)
+
+    def test_search_protected_corpus(self):
+        self.assertEqual(len(self.search('q=protected')['documents']), 0)
+        User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        self.assertEqual(len(self.search('q=protected')['documents']), 2)
+
+    def test_search_updated_term_label(self):
+        term = self.corpus.term_set.get(zr_term_index=0)
+        self.client.post('/visualizer/term/%d/update' % term.id, json.dumps({'label': 'unusual'}),
+                         content_type='application/json')
+        self.assertEqual([t['id'] for t in self.search('q=nusu')['terms']], [term.id])
+        term.label = 'ordinary'
+        term.save()
+        self.assertEqual(self.search('q=nusu')['terms'], [])
+
+    def assertSearchIndexTriggers(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        triggers = set(row[0] for row in cursor.fetchall())
+        for (search_table, _, _) in SEARCH_INDEX_TABLES.values():
+            for trigger in ('insert', 'delete', 'update'):
+                self.assertIn('%s_%s' % (search_table, trigger), triggers)
+
+    def test_search_index_triggers(self):
+        self.assertSearchIndexTriggers()
+
+    def test_search_index_triggers_recreated_by_migrate(self):
+        # Rebuilding a table in a migration drops its triggers
+        cursor = connection.cursor()
+        cursor.execute("DROP TRIGGER visualizer_term_search_update")
+        term = self.corpus.term_set.get(zr_term_index=4)
+        term.label = 'untriggered'
+        term.save()
+        self.assertEqual(list(search_terms('trigger')), [])
+
+        call_command('migrate', verbosity=0)
+        self.assertSearchIndexTriggers()
+        # The index was rebuilt, so it includes the changes made while the trigger was missing
+        self.assertEqual(list(search_terms('trigger')), [term])
+
+    def test_search_index_relabeled_term(self):
+        term = self.corpus.term_set.get(zr_term_index=2)
+        term.label = 'relabeled'
+        term.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(list(search_terms('labele')), [term])
+        # The search used the index, rather than falling back to LIKE
+        self.assertTrue(any('MATCH' in query['sql'] for query in queries))
+        term.delete()
+        self.assertEqual(list(search_terms('labele')), [])
+
+    def test_search_page(self):
+        response = self.client.get('/visualizer/search/?q=term13')
+        term = self.corpus.term_set.get(label='term13')
+        # Terms link to the Term in the corpus wordcloud, rather than to the audio clip of the Term
+        self.assertContains(response, '<a href="/visualizer/%d/wordcloud/#term_%d">term13</a>' %
+                            (self.corpus.id, term.id), html=True)
+        self.assertNotContains(response, '.wav')
+
+
+class TermAudioFragmentsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.corpus = create_corpus('corpus', total_documents=3, total_terms=1, audio_fragments_per_term=25)
+        cls.term = cls.corpus.term_set.get()
+
+    def get_audio_fragment_ids(self, params):
+        response = self.client.get('/visualizer/%d/term/%d_audio_fragments.json' % (self.corpus.id, self.term.id),
+                                   params)
+        self.assertEqual(response.status_code, 200)
+        return [audio_fragment['audio_fragment_id'] for audio_fragment in response.json()]
+
+    def test_default(self):
+        # Without any parameters, all of the AudioFragments are returned
+        ids = list(self.term.audiofragment_set.order_by('id').values_list('id', flat=True))
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(self.get_audio_fragment_ids({}), ids)
+        # With any parameter, the default count is used
+        self.assertEqual(self.get_audio_fragment_ids({'offset': 0}), ids[:10])
+        self.assertEqual(self.get_audio_fragment_ids({'order': ''}), ids[:10])
+
+    def test_count_and_offset(self):
+        ids = list(self.term.audiofragment_set.order_by('id').values_list('id', flat=True))
+        self.assertEqual(self.get_audio_fragment_ids({'count': 5}), ids[:5])
+        self.assertEqual(self.get_audio_fragment_ids({'offset': 3}), ids[3:13])
+        self.assertEqual(self.get_audio_fragment_ids({'count': 10, 'offset': 20}), ids[20:])
+        self.assertEqual(self.get_audio_fragment_ids({'offset': 100}), [])
+        self.assertEqual(self.get_audio_fragment_ids({'count': 200}), ids)
+
+    def test_order(self):
+        audio_fragments = self.term.audiofragment_set.all()
+        for (order, order_by) in (('document', ('document_id', 'start_offset')),
+                                  ('duration', ('duration', 'id')),
+                                  ('score', ('-score', '-id'))):
+            self.assertEqual(self.get_audio_fragment_ids({'order': order, 'count': 200}),
+                             list(audio_fragments.order_by(*order_by).values_list('id', flat=True)), order)
+
+    def test_invalid_parameters(self):
+        url = '/visualizer/%d/term/%d_audio_fragments.json' % (self.corpus.id, self.term.id)
+        for params in ({'count': 0}, {'count': 201}, {'count': 'x'}, {'offset': -1}, {'offset': '1.5'},
+                       {'order': 'label'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+
+
+class TermStatsTests(TestCase):
+    def term_stats(self, corpus):
+        return (list(TermStats.objects.filter(corpus=corpus).order_by('term_id').values_list(
+                    'term_id', 'total_audio_fragments', 'total_documents', 'idf', 'audio_fragment_ids')),
+                list(DocumentTermStats.objects.filter(term__corpus=corpus).order_by('term_id', 'document_id').values_list(
+                    'term_id', 'document_id', 'total_audio_fragments_in_document', 'first_start_offset')))
+
+    def test_update_term_stats_in_batches(self):
+        corpus = create_corpus('corpus', total_documents=3, total_terms=10, audio_fragments_per_term=4)
+        term_stats = self.term_stats(corpus)
+        self.assertEqual(len(term_stats[0]), 10)
+        self.assertEqual(len(term_stats[1]), 30)
+
+        objects_per_bulk_operation = Corpus.OBJECTS_PER_BULK_OPERATION
+        Corpus.OBJECTS_PER_BULK_OPERATION = 3
+        try:
+            corpus.update_term_stats()
+            self.assertEqual(self.term_stats(corpus), term_stats)
+            corpus.update_term_stats(term_ids=corpus.term_set.values_list('id', flat=True)[2:7])
+            self.assertEqual(self.term_stats(corpus), term_stats)
+        finally:
+            Corpus.OBJECTS_PER_BULK_OPERATION = objects_per_bulk_operation
+
+
+class ZRToolsReaderTests(TestCase):
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_directory)
+
+    def write_file(self, name, lines):
+        path = os.path.join(self.tmp_directory, name)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+        return path
+
+    def test_read_clusters(self):
+        clusters_path = self.write_file('master_graph.dedups', ['13 14\n', '\n', '15 16 51 52\n'])
+        self.assertEqual(list(zrtools.read_clusters(clusters_path)), [(0, [13, 14]), (1, []), (2, [15, 16, 51, 52])])
+
+    def test_read_filenames(self):
+        filenames_path = self.write_file('files.lst', ['/audio/s3802a.wav\n', '/audio/s3802b.wav\n'])
+        self.assertEqual(list(zrtools.read_filenames(filenames_path)),
+                         [(0, 's3802a', '/audio/s3802a.wav'), (1, 's3802b', '/audio/s3802b.wav')])
+        self.assertEqual(list(zrtools.read_filenames(filenames_path, '/converted', 'flac')),
+                         [(0, 's3802a', '/converted/s3802a.wav.flac'), (1, 's3802b', '/converted/s3802b.wav.flac')])
+
+    def test_read_nodes(self):
+        # Node indices are line numbers in the .nodes file, starting at 1
+        nodes_path = self.write_file('master_graph.nodes', ['s3802b\t55028\t55087\t0.911181\t23.175030\t896\n',
+                                                            's3802a\t85\t144\t0.5\t23.175030\t896\n'])
+        self.assertEqual(list(zrtools.read_nodes(nodes_path)),
+                         [(1, 's3802b', 55028, 55087, 0.911181), (2, 's3802a', 85, 144, 0.5)])
+
+    def test_read_term_index_for_nodes(self):
+        clusters_path = self.write_file('master_graph.dedups', ['2 3\n', '\n', '6 1\n'])
+        term_index_for_nodes = zrtools.read_term_index_for_nodes(clusters_path)
+        # There is no node 0, and nodes 4 and 5 are not part of any cluster
+        self.assertEqual(list(term_index_for_nodes), [zrtools.NO_TERM, 2, 0, 0, zrtools.NO_TERM, zrtools.NO_TERM, 2])
+
+
+class ZRToolsUpdateTests(TransactionTestCase):
+    """Updating a corpus with new ZRTools output should only write the rows that changed
+    """
+    def setUp(self):
+        self.tmp_directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_directory, 'matches'))
+        with open(os.path.join(self.tmp_directory, 'files.lst'), 'w') as filenames_file:
+            filenames_file.write('/audio/a.wav\n/audio/b.wav\n')
+        # Nodes 1 and 2 share the same interval, but belong to different Terms
+        self.nodes = ['a\t100\t150\t0.9\t0\t0\n',
+                      'a\t100\t150\t0.8\t0\t0\n'] + \
+                     ['%s\t%d\t%d\t0.5\t0\t0\n' % ('ab'[i % 2], 200 + i * 100, 250 + i * 100) for i in range(20)]
+        self.clusters = ['1 3 4 5 6 7 8 9 10 11 12\n',
+                         '2 13 14 15 16 17 18 19 20 21 22\n']
+        self.write_zr_output()
+        self.corpus = Corpus()
+        self.corpus.create_from_zr_output('zr', *self.zr_output_paths(), audio_rate=8000, audio_channels=1,
+                                          audio_precision=16, audio_directory=self.tmp_directory)
+        self.corpus.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_directory)
+
+    def write_zr_output(self):
+        (nodes_path, clusters_path, _) = self.zr_output_paths()
+        with open(nodes_path, 'w') as nodes_file:
+            nodes_file.write(''.join(self.nodes))
+        with open(clusters_path, 'w') as clusters_file:
+            clusters_file.write(''.join(self.clusters))
+
+    def zr_output_paths(self):
+        return (os.path.join(self.tmp_directory, 'matches/master_graph.nodes'),
+                os.path.join(self.tmp_directory, 'matches/master_graph.dedups'),
+                os.path.join(self.tmp_directory, 'files.lst'))
+
+    def update(self):
+        return self.corpus.update_from_zr_output(*self.zr_output_paths(), audio_directory=self.tmp_directory)
+
+    def audio_fragments(self):
+        return sorted(AudioFragment.objects.filter(corpus=self.corpus).values_list(
+            'id', 'term__zr_term_index', 'zr_fragment_index', 'start_offset', 'end_offset'))
+
+    def test_no_op_update(self):
+        term = self.corpus.term_set.get(zr_term_index=1)
+        term.label = 'labeled'
+        term.save()
+        self.corpus.add_document_topics([('a', 'topic')], [('topic', 'Descriptive', 1, 0.5)])
+        audio_fragments = self.audio_fragments()
+        self.assertEqual(len(audio_fragments), 22)
+
+        for _ in range(2):
+            stats = self.update()
+            self.assertEqual(sum(stats.values()), 0, stats)
+            self.assertEqual(self.audio_fragments(), audio_fragments)
+        self.assertEqual(self.corpus.term_set.get(zr_term_index=1).label, 'labeled')
+        self.assertEqual(DocumentTopicTermInfo.objects.filter(term=term).count(), 1)
+
+    def test_created_corpus_cache_version(self):
+        # setUp saves the Corpus after creating it, as the zrtools_import command does.  That
+        # save must not overwrite the cache_version bumped by update_term_stats() with a stale value.
+        self.assertGreater(Corpus.objects.get(id=self.corpus.id).cache_version, 0)
+
+    def test_duplicate_intervals(self):
+        # Remove the second of the two nodes that share an interval
+        self.nodes[1] = 'b\t5000\t5050\t0.8\t0\t0\n'
+        self.write_zr_output()
+        stats = self.update()
+        self.assertEqual((stats['audio_fragments_created'], stats['audio_fragments_deleted']), (1, 1))
+        self.assertEqual(AudioFragment.objects.filter(corpus=self.corpus, start_offset=100).get().zr_fragment_index, 1)
+        self.assertEqual(AudioFragment.objects.filter(corpus=self.corpus).count(), 22)
+
+    def test_inserted_node(self):
+        term_ids = dict(self.corpus.term_set.values_list('zr_term_index', 'id'))
+        # Inserting a node at the start of the nodes file renumbers every node
+        self.nodes.insert(0, 'b\t9000\t9050\t0.7\t0\t0\n')
+        self.clusters = ['2 4 5 6 7 8 9 10 11 12 13\n',
+                         '1 3 14 15 16 17 18 19 20 21 22 23\n']
+        self.write_zr_output()
+        with CaptureQueriesContext(connection) as context:
+            stats = self.update()
+        self.assertEqual(stats['audio_fragments_created'], 1)
+        self.assertEqual(stats['audio_fragments_deleted'], 0)
+        self.assertEqual(stats['terms_created'] + stats['terms_deleted'], 0)
+        update_queries = [query for query in context.captured_queries
+                          if query['sql'].startswith('UPDATE "visualizer_audiofragment"')]
+        self.assertEqual(len(update_queries), 1)
+
+        # The Terms keep their IDs, and the AudioFragments follow the new node indices
+        self.assertEqual(dict(self.corpus.term_set.values_list('zr_term_index', 'id')), term_ids)
+        for (_, zr_term_index, zr_fragment_index, start_offset, _) in self.audio_fragments():
+            node = self.nodes[zr_fragment_index - 1].split()
+            self.assertEqual(int(node[1]), start_offset)
+            self.assertIn(str(zr_fragment_index), self.clusters[zr_term_index].split())
@@ -4,6 +4,8 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.index, name='index'),
+    url(r'^search/$', views.search, name='search'),
+    url(r'^search.json$', views.search_json, name='search_json'),
 
     url(r'^corpus_wordcloud_params', views.wordcloud_params_for_corpus, name='wordcloud_params_for_corpus'),
     url(r'^document_wordcloud_params', views.wordcloud_params_for_document, name='wordcloud_params_for_document'),
@@ -16,6 +18,8 @@ urlpatterns = [
         name='lorelei_situation_frames_json'),
     url(r'^(?P<corpus_id>\d+)/document/(?P<document_id>\d+)/audio_fragments.json',
         views.document_audio_fragments_as_json, name='document_audio_fragments_as_json'),
+    url(r'^(?P<corpus_id>\d+)/document/(?P<document_id>\d+)/peaks.json',
+        views.document_peaks_json, name='document_peaks_json'),
 
     url(r'^\d+/document/\d+/terms.json/(?P<term_id>\d+)', views.term_update, name='term_update_document_termcloud'),
     url(r'^(?P<corpus_id>\d+)/document/(?P<document_id>\d+)/terms.json',
@@ -28,6 +32,10 @@ urlpatterns = [
     url(r'^(?P<corpus_id>\d+)/document/list/', views.corpus_document_list, name='corpus_document_list'),
     url(r'^(?P<corpus_id>\d+)/document/(?P<document_id>\d+).wav', views.document_wav_file, name='document_wav_file'),
 
+    url(r'^(?P<corpus_id>\d+)/audio_fragment/(?P<audio_fragment_id>\d+).wav', views.audio_fragment_wav_file,
+        name='audio_fragment_wav_file'),
+    url(r'^(?P<corpus_id>\d+)/audio_fragments.bin', views.audio_fragment_wav_files, name='audio_fragment_wav_files'),
+
     url(r'^(?P<corpus_id>\d+)/document_topic/(?P<document_topic_id>\d+)/terms.json',
         views.wordcloud_json_for_document_topic, name='wordcloud_json_for_document_topic'),
     url(r'^(?P<corpus_id>\d+)/document_topic/(?P<document_topic_id>\d+)/', views.document_topic, name='document_topic'),
@@ -1,17 +1,191 @@
 import collections
+import functools
+import hashlib
 import json
-import math
 import os
-import tempfile
-
-from django.db.models import Count, Min
-from django.http import HttpResponse, JsonResponse
+import re
+import struct
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import (FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+                         HttpResponseServerError, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import redirect, render
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
-import pysox
 
-from visualizer.models import AudioFragment, Corpus, Document, DocumentTopic, Term
+from visualizer import audio
+from visualizer.file_cache import FileCache
+from visualizer.models import AudioFragment, BackgroundJobError, Corpus, Document, DocumentTermStats, DocumentTopic, Term, TermStats
+from visualizer.search import search_documents, search_terms
+
+
+# Seconds a client should wait before requesting audio (or waveform peaks) that is being converted again
+AUDIO_CONVERSION_RETRY_AFTER = 2
+
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Maximum number of AudioFragments in a single audio_fragment_wav_files response
+MAX_AUDIO_FRAGMENT_WAV_FILES = 200
+
+# Parameters for selecting the AudioFragments of a Term that are combined
+# into a single audio clip.  Each order can be read using one of the
+# index_together indexes of the AudioFragment model.
+DEFAULT_TERM_AUDIO_FRAGMENTS = 10
+MAX_TERM_AUDIO_FRAGMENTS = 200
+TERM_AUDIO_FRAGMENT_ORDERS = {
+    'document': ('document_id', 'start_offset'),
+    'duration': ('duration', 'id'),
+    'score': ('-score', '-id'),
+}
+
+# Orders for the Terms of a wordcloud, matching the sort keys of the wordcloud
+# params views.  The counts can be read using the index_together indexes of
+# the TermStats model, and the labels using the index_together index of the
+# Term model.  The term_id (or zr_term_index) tie-breaker keeps pages stable.
+WORDCLOUD_TERM_ORDERS = {
+    'label': ('term__label', 'term__zr_term_index'),
+    'total_audio_fragments': ('-total_audio_fragments', 'term_id'),
+    'total_documents': ('-total_documents', 'term_id'),
+}
+
+# Maximum number of Terms, and of Documents, returned by a search
+DEFAULT_SEARCH_RESULTS = 50
+MAX_SEARCH_RESULTS = 500
+
+term_clip_cache = FileCache(os.path.join(settings.CACHE_DIR, 'term_clips'), settings.TERM_CLIP_CACHE_MAX_BYTES,
+                            suffix='.wav')
+
+
+def cached_by_corpus_version(view):
+    """Decorator that caches the responses of a view using the cache_version of a Corpus
+
+    The cache key and ETag are computed from the request path (including
+    any query parameters) and the Corpus cache_version, which is bumped
+    whenever a Term label or DocumentTopic changes.  Requests with a
+    matching If-None-Match header get a 304 (Not Modified) response.
+    """
+    @functools.wraps(view)
+    def wrapper(request, corpus_id, *args, **kwargs):
+        cache_version = Corpus.objects.values_list('cache_version', flat=True).get(id=corpus_id)
+        etag = hashlib.md5(('%s:%d' % (request.get_full_path(), cache_version)).encode('utf-8')).hexdigest()
+
+        # GZipMiddleware appends ';gzip' to the ETags of compressed responses
+        for if_none_match in request.META.get('HTTP_IF_NONE_MATCH', '').split(','):
+            if if_none_match.strip().replace('W/', '').strip('"').replace(';gzip', '') in (etag, '*'):
+                response = HttpResponseNotModified()
+                response['ETag'] = '"%s"' % etag
+                return response
+
+        cache_key = 'vaporengine:%s:%s' % (view.__name__, etag)
+        cached_response = cache.get(cache_key)
+        if cached_response is None:
+            response = view(request, corpus_id, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            cached_response = (response.content, response['Content-Type'])
+            cache.set(cache_key, cached_response)
+
+        (content, content_type) = cached_response
+        response = HttpResponse(content=content, content_type=content_type)
+        response['ETag'] = '"%s"' % etag
+        return response
+    return wrapper
+
+def range_file_response(request, f, content_type):
+    """Return a response that streams the contents of an open file, honoring HTTP Range requests
+
+    A request with a single byte range in its Range header, e.g.
+      Range: bytes=1000000-
+    gets a 206 (Partial Content) response with just those bytes, so that
+    audio players can start playing and seek without downloading the
+    whole file.  Requests without a (usable) Range header, or with an
+    If-Range header that does not match the Last-Modified date of the
+    file, get the whole file.  A range that starts after the end of the
+    file gets a 416 (Range Not Satisfiable) response.  The file is read
+    in blocks, and is closed by the response.
+    """
+    stat_result = os.fstat(f.fileno())
+    size = stat_result.st_size
+    last_modified = http_date(stat_result.st_mtime)
+
+    byte_range = None
+    range_match = BYTE_RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if_range = request.META.get('HTTP_IF_RANGE')
+    # Ranges are only valid if the file is unchanged since the client's first request
+    if range_match and (not if_range or if_range == last_modified):
+        (first, last) = range_match.groups()
+        if first:
+            # A range whose last byte is before its first byte is invalid, so the Range header is ignored
+            if not last or int(last) >= int(first):
+                byte_range = (int(first), min(int(last), size - 1) if last else size - 1)
+        elif last:
+            # A suffix range, e.g. 'bytes=-500' for the last 500 bytes of the file
+            byte_range = (max(size - int(last), 0), size - 1)
+
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+    elif byte_range[0] > byte_range[1]:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    else:
+        response = StreamingHttpResponse(_read_file_range(f, byte_range[0], byte_range[1]),
+                                         content_type=content_type, status=206)
+        response['Content-Length'] = byte_range[1] - byte_range[0] + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size)
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = last_modified
+    # Compressing the response would make the Content-Length and
+    # Content-Range headers refer to the wrong bytes
+    response.gzip_exempt = True
+    return response
+
+
+def audio_fragment_wav_file(request, corpus_id, audio_fragment_id):
+    corpus = Corpus.objects.get(id=corpus_id)
+    audio_fragment = AudioFragment.objects.select_related('document').get(id=audio_fragment_id, corpus_id=corpus_id)
+    wav_data = audio.concatenate_clips(
+        [(audio_fragment.document.audio_path, audio_fragment.start_offset, audio_fragment.duration)],
+        corpus.audio_rate, corpus.audio_channels, corpus.audio_precision)
+    response = HttpResponse(content=wav_data)
+    response['Content-Type'] = 'audio/wav'
+    return response
+
+def audio_fragment_wav_files(request, corpus_id):
+    """Return the audio clips for a list of AudioFragments in a single response
 
+    The 'ids' parameter is a comma-separated list of AudioFragment IDs.
+    The response contains one record for each AudioFragment, in the
+    order of the IDs, where each record is the AudioFragment ID and the
+    size of the WAV file (as little-endian 32-bit unsigned integers),
+    followed by the contents of the WAV file.
+    """
+    corpus = Corpus.objects.get(id=corpus_id)
+    try:
+        audio_fragment_ids = [int(af_id) for af_id in request.GET.get('ids', '').split(',') if af_id]
+    except ValueError:
+        return HttpResponseBadRequest('ids must be a comma-separated list of integers')
+    if len(audio_fragment_ids) > MAX_AUDIO_FRAGMENT_WAV_FILES:
+        return HttpResponseBadRequest('At most %d ids can be requested' % MAX_AUDIO_FRAGMENT_WAV_FILES)
+
+    audio_fragment_for_id = AudioFragment.objects.select_related('document') \
+        .filter(corpus_id=corpus_id).in_bulk(audio_fragment_ids)
+    records = []
+    for audio_fragment_id in audio_fragment_ids:
+        audio_fragment = audio_fragment_for_id.get(audio_fragment_id)
+        if not audio_fragment:
+            continue
+        wav_data = audio.concatenate_clips(
+            [(audio_fragment.document.audio_path, audio_fragment.start_offset, audio_fragment.duration)],
+            corpus.audio_rate, corpus.audio_channels, corpus.audio_precision)
+        records.append(struct.pack(str('<II'), audio_fragment_id, len(wav_data)))
+        records.append(wav_data)
+    response = HttpResponse(content=b''.join(records))
+    response['Content-Type'] = 'application/octet-stream'
+    return response
 
 def corpus_wordcloud(request, corpus_id):
     corpus = Corpus.objects.get(id=corpus_id)
@@ -47,11 +221,46 @@ def document_audio_fragments_as_json(request, corpus_id, document_id):
     for audio_fragment in document.audiofragment_set.all():
         audio_fragments_json.append({
             'audio_fragment_id': audio_fragment.id,
+            'term_id': audio_fragment.term_id,
             'start_offset': audio_fragment.start_offset,
             'end_offset': audio_fragment.end_offset
         })
     return JsonResponse(audio_fragments_json, safe=False)
 
+def document_peaks_json(request, corpus_id, document_id):
+    """Return the waveform envelope of a Document, at the coarsest zoom level with enough peaks
+
+    The optional 'peaks_per_second' parameter is the number of peaks
+    per second of audio needed to draw the waveform.  The peaks are
+    computed in the background the first time they are requested, and
+    until they are ready the response is a 202 (Accepted) with a
+    Retry-After header.  If computing the peaks failed, the response is
+    a 500 (Internal Server Error).
+    """
+    try:
+        peaks_per_second = float(request.GET.get('peaks_per_second', 0))
+    except ValueError:
+        return HttpResponseBadRequest('peaks_per_second must be a number')
+    document = Document.objects.get(id=document_id)
+    try:
+        document_peaks = document.waveform_peaks()
+    except BackgroundJobError as e:
+        return HttpResponseServerError('Unable to compute the waveform peaks: %s' % e)
+    if document_peaks is None:
+        response = JsonResponse({}, status=202)
+        response['Retry-After'] = AUDIO_CONVERSION_RETRY_AFTER
+        return response
+    level = document_peaks[0]
+    for dp in document_peaks:
+        if dp.peaks_per_second() >= peaks_per_second:
+            level = dp
+    return JsonResponse({
+        'rate': level.rate,
+        'samples_per_peak': level.samples_per_peak,
+        'peaks_per_second': level.peaks_per_second(),
+        'peaks': level.peak_values().tolist(),
+    })
+
 def document_topic(request, corpus_id, document_topic_id):
     corpus = Corpus.objects.get(id=corpus_id)
     document_topic = DocumentTopic.objects.get(id=document_topic_id)
@@ -82,63 +291,167 @@ def document_topic_for_document_update(request, corpus_id, document_id):
         document.documenttopic_set.add(dt)
     else:
         document.documenttopic_set.remove(dt)
+    Corpus.bump_cache_version(document.corpus_id)
     return JsonResponse({})
 
 def document_wav_file(request, corpus_id, document_id):
-    document = Document.objects.get(id=document_id)
-    if os.path.splitext(document.audio_path)[1] == '.wav':
-        audio_file = open(document.audio_path, 'rb')
-        response = HttpResponse(content=audio_file)
-    else:
-        # Convert non-WAV files to WAV files using pysox
-        tmp_directory = tempfile.mkdtemp()
-        tmp_filename = os.path.join(tmp_directory, 'converted.wav')
-
-        infile = pysox.CSoxStream(document.audio_path)
-        outfile = pysox.CSoxStream(tmp_filename, 'w', infile.get_signal())
-        chain = pysox.CEffectsChain(infile, outfile)
-        chain.flow_effects()
-        infile.close()
-        outfile.close()
-
-        # Read in audio data from temporary file
-        wav_data = open(tmp_filename, 'rb').read()
+    """Return the audio for a Document as a WAV file
 
-        # Clean up temporary files
-        os.remove(tmp_filename)
-        os.rmdir(tmp_directory)
-
-        response = HttpResponse(content=wav_data)
-    response['Content-Type'] = 'audio/wav'
-    return response
+    Non-WAV audio files are converted in the background.  Until the
+    converted file is ready, the response is a 202 (Accepted) with a
+    Retry-After header.  If the conversion failed, the response is a 500
+    (Internal Server Error).
+    """
+    document = Document.objects.get(id=document_id)
+    try:
+        f = document.open_wav_file()
+    except BackgroundJobError as e:
+        return HttpResponseServerError('Unable to convert the audio file: %s' % e)
+    if f is None:
+        response = HttpResponse(status=202)
+        response['Retry-After'] = AUDIO_CONVERSION_RETRY_AFTER
+        return response
+    return range_file_response(request, f, 'audio/wav')
 
 def index(request):
-    current_corpora = Corpus.objects.all()
+    current_corpora = Corpus.with_summary_statistics(Corpus.objects.all())
     context = {'current_corpora': current_corpora}
     return render(request, "index.html", context)
 
 def lorelei_situation_frames_json(request, corpus_id):
+    """Stream the DocumentTopic labels for a Corpus as LORELEI situation frames
+
+    The situation frames are read using a single query over the
+    Document-DocumentTopic table.  With the 'gzip' parameter, the JSON is
+    compressed and downloaded as a file.
+    """
     corpus = Corpus.objects.get(id=corpus_id)
-    situation_frames = []
-    for document in corpus.document_set.all():
-        dt_labels = document.documenttopic_set.values_list('label', flat=True)
-        for dt_label in dt_labels:
-            situation_frame = {}
-            situation_frame['DocumentID'] = document.audio_identifier
-            situation_frame['Type'] = dt_label
-            situation_frame['TypeConfidence'] = 1.0
-            situation_frames.append(situation_frame)
-    pretty_json = json.dumps(situation_frames, indent=2, ensure_ascii=False, sort_keys=True) + u'\n'
-    response = HttpResponse(content=pretty_json)
-    response['Content-Type'] = 'application/json'
+    document_topic_labels = DocumentTopic.documents.through.objects \
+        .filter(document__corpus=corpus) \
+        .order_by('document_id', 'id') \
+        .values_list('document__audio_identifier', 'documenttopic__label') \
+        .iterator()
+    content = (chunk.encode('utf-8') for chunk in _situation_frames_json_chunks(document_topic_labels))
+    if request.GET.get('gzip'):
+        response = StreamingHttpResponse(_gzip_chunks(content), content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="lorelei_situation_frames_%d.json.gz"' % corpus.id
+        # The response is already compressed
+        response.gzip_exempt = True
+    else:
+        response = StreamingHttpResponse(content, content_type='application/json')
     return response
 
+def search(request):
+    try:
+        (query, terms, documents) = search_results(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    context = {
+        'corpus_id': request.GET.get('corpus_id', ''),
+        'documents': documents,
+        'query': query,
+        'terms': terms,
+    }
+    return render(request, "search.html", context)
+
+def search_json(request):
+    try:
+        (query, terms, documents) = search_results(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse({
+        'terms': [{
+            'id': term.id,
+            'label': term.label,
+            'zr_term_index': term.zr_term_index,
+            'corpus_id': term.corpus_id,
+            'corpus_name': term.corpus.name,
+        } for term in terms],
+        'documents': [{
+            'id': document.id,
+            'audio_identifier': document.audio_identifier,
+            'corpus_id': document.corpus_id,
+            'corpus_name': document.corpus.name,
+        } for document in documents],
+    })
+
+def search_results(request):
+    """Return a (query, Terms, Documents) tuple with the search results selected by the request parameters
+
+    The parameters are:
+      q         - text to search for in Term labels and Document audio identifiers
+      corpus_id - only search a single Corpus (optional)
+      limit     - maximum number of Terms, and of Documents (default 50)
+    Protected Corpora are only searched for logged in users.
+    Raises a ValueError if a parameter is invalid.
+    """
+    query = request.GET.get('q', '').strip()
+    limit = int(request.GET.get('limit', DEFAULT_SEARCH_RESULTS))
+    if not 0 < limit <= MAX_SEARCH_RESULTS:
+        raise ValueError('limit must be between 1 and %d' % MAX_SEARCH_RESULTS)
+
+    corpora = Corpus.objects.all()
+    if request.GET.get('corpus_id'):
+        corpora = corpora.filter(id=int(request.GET['corpus_id']))
+    if not request.user.is_authenticated():
+        corpora = corpora.filter(protected_corpus=False)
+
+    if not query:
+        return (query, Term.objects.none(), Document.objects.none())
+    corpus_ids = corpora.values_list('id', flat=True)
+    terms = search_terms(query, corpus_ids).select_related('corpus')[:limit]
+    documents = search_documents(query, corpus_ids).select_related('corpus')[:limit]
+    return (query, terms, documents)
+
+def term_audio_fragments(request, term):
+    """Return a QuerySet with the AudioFragments for a Term selected by the request parameters
+
+    The optional parameters are:
+      count  - number of AudioFragments (default 10)
+      offset - number of AudioFragments to skip, for paging through the AudioFragments
+      order  - 'document', 'duration' (shortest first) or 'score' (highest first)
+    Raises a ValueError if a parameter is invalid.
+    """
+    count = int(request.GET.get('count', DEFAULT_TERM_AUDIO_FRAGMENTS))
+    offset = int(request.GET.get('offset', 0))
+    order = request.GET.get('order')
+    if not 0 < count <= MAX_TERM_AUDIO_FRAGMENTS:
+        raise ValueError('count must be between 1 and %d' % MAX_TERM_AUDIO_FRAGMENTS)
+    if offset < 0:
+        raise ValueError('offset must not be negative')
+    if order and order not in TERM_AUDIO_FRAGMENT_ORDERS:
+        raise ValueError('order must be one of: %s' % ', '.join(sorted(TERM_AUDIO_FRAGMENT_ORDERS)))
+
+    audio_fragments = term.audiofragment_set.all()
+    if order:
+        audio_fragments = audio_fragments.order_by(*TERM_AUDIO_FRAGMENT_ORDERS[order])
+    else:
+        audio_fragments = audio_fragments.order_by('id')
+    return audio_fragments[offset:offset + count]
+
 def term_audio_fragments_as_json(request, corpus_id, term_id):
+    """Return the AudioFragments for a Term
+
+    Without any 'count', 'offset' or 'order' parameters, all of the
+    AudioFragments for the Term are returned in ID order.  With any of
+    these parameters, the AudioFragments are selected in the same way
+    as for the audio clip returned by term_wav_file.
+    """
     term = Term.objects.get(id=term_id)
 
+    if any(parameter in request.GET for parameter in ('count', 'offset', 'order')):
+        try:
+            audio_fragments = term_audio_fragments(request, term)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    else:
+        audio_fragments = term.audiofragment_set.order_by('id')
+    audio_fragments = audio_fragments.select_related('document')
+
     audio_fragments_json = []
-    for audio_fragment in term.audiofragment_set.all():
+    for audio_fragment in audio_fragments:
         audio_fragments_json.append({
+            'audio_fragment_id': audio_fragment.id,
             'duration': audio_fragment.duration,
             'audio_identifier': audio_fragment.document.audio_identifier,
             'document_id': audio_fragment.document_id,
@@ -152,88 +465,78 @@ def term_update(request, term_id):
     term = Term.objects.get(id=term_id)
     term.label = request_data['label']
     term.save()
+    Corpus.bump_cache_version(term.corpus_id)
     return JsonResponse({})
 
 def term_wav_file(request, corpus_id, term_id):
     corpus = Corpus.objects.get(id=corpus_id)
     term = Term.objects.get(id=term_id)
-    sox_signal_info = pysox.CSignalInfo(corpus.audio_rate, corpus.audio_channels, corpus.audio_precision)
-
-    # TODO: Allow number of audio fragments to be specified as parameter, instead
-    #       of hard-coded to 10
-    audio_fragments = term.audiofragment_set.all()[:10]
 
-    # Create a temporary directory
-    tmp_directory = tempfile.mkdtemp()
-    tmp_filename = os.path.join(tmp_directory, 'combined_clips.wav')
-
-    # The first argument to CSoxStream must be a filename with a '.wav' extension.
-    #
-    # If the output file does not have a '.wav' extension, pysox will raise
-    # an "IOError: No such file" exception.
-    outfile = pysox.CSoxStream(tmp_filename, 'w', sox_signal_info)
-
-    for audio_fragment in audio_fragments:
-        START_OFFSET = bytes("%f" % (audio_fragment.start_offset / 100.0))
-        DURATION = bytes("%f" % (audio_fragment.duration / 100.0))
-        input_filename = audio_fragment.document.audio_path
-        infile = pysox.CSoxStream(input_filename)
-        chain = pysox.CEffectsChain(infile, outfile)
-        chain.add_effect(pysox.CEffect('trim', [START_OFFSET, DURATION]))
-        chain.flow_effects()
-        infile.close()
-
-    outfile.close()
-
-    # Read in audio data from temporary file
-    wav_data = open(tmp_filename, 'rb').read()
-
-    # Clean up temporary files
-    os.remove(tmp_filename)
-    os.rmdir(tmp_directory)
+    try:
+        audio_fragments = list(term_audio_fragments(request, term).select_related('document'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    # Rendered clips are cached using the IDs and offsets of the AudioFragments as the
+    # key.  Re-importing a corpus creates AudioFragments with new IDs, and updating a
+    # corpus changes the set of AudioFragments for a Term, so stale clips are never used.
+    cache_key = 'term:%d:%d:%d:%d:%s' % (
+        term.id, corpus.audio_rate, corpus.audio_channels, corpus.audio_precision,
+        ','.join('%d:%d:%d' % (af.id, af.start_offset, af.duration) for af in audio_fragments))
+    cached_path = term_clip_cache.get(cache_key)
+    if cached_path:
+        try:
+            with open(cached_path, 'rb') as f:
+                response = HttpResponse(content=f.read())
+            response['Content-Type'] = 'audio/wav'
+            return response
+        except IOError:
+            # The cached file was evicted by another process
+            pass
+
+    clips = [(af.document.audio_path, af.start_offset, af.duration) for af in audio_fragments]
+    wav_data = audio.concatenate_clips(clips, corpus.audio_rate, corpus.audio_channels, corpus.audio_precision)
+
+    term_clip_cache.put(cache_key, wav_data)
 
     response = HttpResponse(content=wav_data)
     response['Content-Type'] = 'audio/wav'
     return response
 
+@cached_by_corpus_version
 def wordcloud_json_for_corpus(request, corpus_id):
-    corpus = Corpus.objects.get(id=corpus_id)
-
-    # Use Django's annotate() to compute total # of Documents and AudioFragments associated with each Term.
-    #
-    # With annotate(), we can compute the # of AudioFragments associated with each Term in a Corpus using
-    # just a single SQL query for the entire Corpus.  This is an order-of-magnitude faster than making
-    # a separate SQL call for each Term in the Corpus by calling term.total_audio_fragments() in a for loop.
-    terms = corpus.terms().annotate(Count('audiofragment'), Count('audiofragment__document', distinct=True))
-
-    # Create a mapping from each Term ID to the corresponding list of AudioFragment IDs, using a single SQL query.
-    #
-    # This is an order of magnitude faster than using a separate SQL query for each Term by calling
-    # term.audio_fragment_ids() in a for loop.
-    term_audiofragment_id_pairs = AudioFragment.objects.filter(document__corpus_id=corpus_id).values_list('term_id', 'id')
-    term_id_to_audiofragment_ids = collections.defaultdict(list)
-    for (term_id, audiofragment_id) in term_audiofragment_id_pairs:
-        term_id_to_audiofragment_ids[term_id].append(audiofragment_id)
+    # The number of Documents and AudioFragments associated with each Term, and the list
+    # of AudioFragment IDs for each Term, are precomputed when the Corpus is imported.
+    # Reading the TermStats table requires a single SQL query that does not touch the
+    # (much larger) AudioFragment table.
+    columns = request.GET.get('format') == 'columns'
+    # The (redundant) filter on the corpus of the Term lets the 'label' order read the
+    # Terms using the (corpus, label, zr_term_index) index of the Term model
+    term_stats = TermStats.objects.filter(corpus_id=corpus_id, term__corpus_id=corpus_id).select_related('term')
+    if columns:
+        term_stats = term_stats.defer('audio_fragment_ids')
+    try:
+        term_stats = wordcloud_term_stats(request, term_stats)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
 
     terms_json = []
-    for term in terms:
-        terms_json.append({
-            'label': term.label,
-            'zr_term_index': term.zr_term_index,
+    for ts in term_stats:
+        term_json = {
+            'label': ts.term.label,
+            'zr_term_index': ts.term.zr_term_index,
 
-            'id': term.id,
-            'term_id': term.id,
+            'id': ts.term_id,
+            'term_id': ts.term_id,
             'corpus_id': corpus_id,
 
-            'audio_fragment_ids': term_id_to_audiofragment_ids[term.id],
-            'total_audio_fragments': term.audiofragment__count,
-            'total_documents': term.audiofragment__document__count,
-        })
-    response = HttpResponse(content=json.dumps({
-        'terms': terms_json
-    }))
-    response['Content-Type'] = 'application/json'
-    return response
+            'total_audio_fragments': ts.total_audio_fragments,
+            'total_documents': ts.total_documents,
+        }
+        if not columns:
+            term_json['audio_fragment_ids'] = json.loads(ts.audio_fragment_ids)
+        terms_json.append(term_json)
+    return _terms_json_response(corpus_id, terms_json, columns)
 
 def wordcloud_params_for_corpus(request):
     response = HttpResponse(content=json.dumps({
@@ -252,30 +555,22 @@ def wordcloud_params_for_corpus(request):
     response['Content-Type'] = 'application/json'
     return response
 
+@cached_by_corpus_version
 def wordcloud_json_for_document(request, corpus_id, document_id):
-    corpus = Corpus.objects.get(id=corpus_id)
-    document = Document.objects.get(id=document_id)
-    total_documents = corpus.document_set.count()
-
-    terms = document.associated_terms().annotate(audio_fragments_in_document=Count('audiofragment', distinct=True),
-                                                 first_audiofragment_start_offset=Min('audiofragment__start_offset'))
-
-    # Create a mapping from Term ID to # of Documents Term appears in, using a single SQL query
-    term_id_and_document_counts = corpus.terms().annotate(document_count=Count('audiofragment__document', distinct=True)).values_list('id', 'document_count')
-    term_id_to_document_count = {}
-    for (term_id, document_count) in term_id_and_document_counts:
-        term_id_to_document_count[term_id] = document_count
-
-    # Create a mapping from each Term ID to the corresponding list of AudioFragment IDs, using a single SQL query.
-    term_audiofragment_id_pairs = AudioFragment.objects.filter(document__corpus_id=corpus_id).values_list('term_id', 'id')
-    term_id_to_audiofragment_ids = collections.defaultdict(list)
-    for (term_id, audiofragment_id) in term_audiofragment_id_pairs:
-        term_id_to_audiofragment_ids[term_id].append(audiofragment_id)
+    # Document frequencies, IDF values and per-Document Term frequencies are precomputed
+    # when the Corpus is imported, so this view only reads the rows for the Terms that
+    # appear in this Document.
+    columns = request.GET.get('format') == 'columns'
+    document_term_stats = DocumentTermStats.objects.filter(document_id=document_id) \
+                                                   .select_related('term', 'term__termstats')
+    if columns:
+        document_term_stats = document_term_stats.defer('term__termstats__audio_fragment_ids')
 
     terms_json = []
-    for term in terms:
-        tf_idf = term.audio_fragments_in_document * math.log(total_documents / (1.0 + term_id_to_document_count[term.id]))
-        terms_json.append({
+    for dts in document_term_stats:
+        term = dts.term
+        ts = term.termstats
+        term_json = {
             'label': term.label,
             'zr_term_index': term.zr_term_index,
 
@@ -283,33 +578,16 @@ def wordcloud_json_for_document(request, corpus_id, document_id):
             'term_id': term.id,
             'corpus_id': corpus_id,
 
-            # Unoptimized code:
-            #   'audio_fragment_ids': list(term.audio_fragment_ids()),
-            'audio_fragment_ids': term_id_to_audiofragment_ids[term.id],
-
-            # Unoptimized code:
-            #   'first_start_offset_in_document': term.first_start_offset_in_document(document),
-            'first_start_offset_in_document': term.first_audiofragment_start_offset/100.0,
-
-            'tf_idf': tf_idf,
-
-            # Unoptimized code:
-            #   'total_audio_fragments': term.total_audio_fragments(),
-            'total_audio_fragments': len(term_id_to_audiofragment_ids[term.id]),
-
-            # Unoptimized code:
-            #   'total_audio_fragments_in_document': term.total_audio_fragments_in_document(document),
-            'total_audio_fragments_in_document': term.audio_fragments_in_document,
-
-            # Unoptimized code:
-            #   'total_documents': term.total_documents(),
-            'total_documents': term_id_to_document_count[term.id],
-        })
-    response = HttpResponse(content=json.dumps({
-        'terms': terms_json
-    }))
-    response['Content-Type'] = 'application/json'
-    return response
+            'first_start_offset_in_document': dts.first_start_offset/100.0,
+            'tf_idf': dts.total_audio_fragments_in_document * ts.idf,
+            'total_audio_fragments': ts.total_audio_fragments,
+            'total_audio_fragments_in_document': dts.total_audio_fragments_in_document,
+            'total_documents': ts.total_documents,
+        }
+        if not columns:
+            term_json['audio_fragment_ids'] = json.loads(ts.audio_fragment_ids)
+        terms_json.append(term_json)
+    return _terms_json_response(corpus_id, terms_json, columns)
 
 def wordcloud_params_for_document(request):
     response = HttpResponse(content=json.dumps({
@@ -333,30 +611,35 @@ def wordcloud_params_for_document(request):
     response['Content-Type'] = 'application/json'
     return response
 
+@cached_by_corpus_version
 def wordcloud_json_for_document_topic(request, corpus_id, document_topic_id):
-    corpus = Corpus.objects.get(id=corpus_id)
+    columns = request.GET.get('format') == 'columns'
     document_topic = DocumentTopic.objects.get(id=document_topic_id)
-    total_documents = corpus.document_set.count()
-
-#    terms = document_topic.terms().annotate(Count('audiofragment'), Count('audiofragment__document', distinct=True))
-    terms = document_topic.terms_with_document_topic_info().annotate(Count('audiofragment'), Count('audiofragment__document', distinct=True))
-
-    # Create a mapping from each Term ID to the corresponding list of AudioFragment IDs, using a single SQL query.
-    term_audiofragment_id_pairs = AudioFragment.objects.filter(document__corpus_id=corpus_id).values_list('term_id', 'id')
-    term_id_to_audiofragment_ids = collections.defaultdict(list)
-    for (term_id, audiofragment_id) in term_audiofragment_id_pairs:
-        term_id_to_audiofragment_ids[term_id].append(audiofragment_id)
 
     term_id_to_dttis = collections.defaultdict(list)
+    term_info_scores = collections.defaultdict(dict)
     for dtti in document_topic.documenttopicterminfo_set.all():
         term_id_to_dttis[dtti.term_id].append(dtti)
+        term_info_scores['term_info_' + dtti.category][dtti.term_id] = dtti.score
 
     category_name_to_index = {}
     for index, category in enumerate(document_topic.term_info_categories()):
         category_name_to_index[category] = index
 
+    # The number of Documents and AudioFragments for each Term, and the list of
+    # AudioFragment IDs for each Term, are read from the precomputed TermStats
+    term_stats = TermStats.objects.filter(term_id__in=document_topic.terms_with_document_topic_info()) \
+                                  .select_related('term')
+    if columns:
+        term_stats = term_stats.defer('audio_fragment_ids')
+    try:
+        term_stats = wordcloud_term_stats(request, term_stats, term_info_scores)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
     terms_json = []
-    for term in terms:
+    for ts in term_stats:
+        term = ts.term
         term_json = {
             'label': term.label,
             'zr_term_index': term.zr_term_index,
@@ -367,21 +650,17 @@ def wordcloud_json_for_document_topic(request, corpus_id, document_topic_id):
             'term_id': term.id,
             'corpus_id': corpus_id,
 
-            'audio_fragment_ids': term_id_to_audiofragment_ids[term.id],
-
-            'total_audio_fragments': term.audiofragment__count,
-            'total_documents': term.audiofragment__document__count,
+            'total_audio_fragments': ts.total_audio_fragments,
+            'total_documents': ts.total_documents,
         }
+        if not columns:
+            term_json['audio_fragment_ids'] = json.loads(ts.audio_fragment_ids)
         if term.id in term_id_to_dttis:
             for dtti in term_id_to_dttis[term.id]:
                 term_json['css_class'] += 'term_info_category_%d ' % category_name_to_index[dtti.category]
                 term_json['term_info_' + dtti.category] = dtti.score
         terms_json.append(term_json)
-    response = HttpResponse(content=json.dumps({
-        'terms': terms_json
-    }))
-    response['Content-Type'] = 'application/json'
-    return response
+    return _terms_json_response(corpus_id, terms_json, columns)
 
 def wordcloud_params_for_document_topic(request, document_topic_id):
     document_topic = DocumentTopic.objects.get(id=document_topic_id)
@@ -408,3 +687,130 @@ def wordcloud_params_for_document_topic(request, document_topic_id):
     response = HttpResponse(content=json.dumps(wordcloud_params))
     response['Content-Type'] = 'application/json'
     return response
+
+
+def wordcloud_term_stats(request, term_stats, term_info_scores=None):
+    """Return the TermStats for a wordcloud, selected and ordered by the request parameters
+
+    The optional parameters are:
+      limit         - maximum number of Terms (default all of the Terms)
+      offset        - number of Terms to skip, for paging through the Terms
+      sort          - 'label', 'total_audio_fragments' or 'total_documents'
+                      (largest first), or one of the keys of term_info_scores
+      min_documents - only include Terms that appear in at least this many Documents
+    term_info_scores maps 'term_info_<category>' sort keys to a dict of
+    DocumentTopicTermInfo scores by Term ID.  A DocumentTopic only has
+    scores for a small number of Terms, so those sort keys are applied in
+    Python; the other sort keys are applied by the database.
+    Raises a ValueError if a parameter is invalid.
+    """
+    term_info_scores = term_info_scores or {}
+    limit = int(request.GET['limit']) if request.GET.get('limit') else None
+    offset = int(request.GET.get('offset', 0))
+    min_documents = int(request.GET.get('min_documents', 0))
+    sort = request.GET.get('sort')
+    if limit is not None and limit <= 0:
+        raise ValueError('limit must be positive')
+    if offset < 0:
+        raise ValueError('offset must not be negative')
+    if sort and sort not in WORDCLOUD_TERM_ORDERS and sort not in term_info_scores:
+        raise ValueError('sort must be one of: %s' % ', '.join(sorted(list(WORDCLOUD_TERM_ORDERS) +
+                                                                       list(term_info_scores))))
+
+    if min_documents:
+        term_stats = term_stats.filter(total_documents__gte=min_documents)
+    if sort in term_info_scores:
+        # Terms without a score for the category come last
+        scores = term_info_scores[sort]
+        term_stats = sorted(term_stats, key=lambda ts: (ts.term_id not in scores, -scores.get(ts.term_id, 0),
+                                                        ts.term_id))
+    elif sort:
+        term_stats = term_stats.order_by(*WORDCLOUD_TERM_ORDERS[sort])
+    elif limit is not None or offset:
+        term_stats = term_stats.order_by('term_id')
+
+    if limit is not None:
+        return term_stats[offset:offset + limit]
+    elif offset:
+        return term_stats[offset:]
+    return term_stats
+
+def _gzip_chunks(chunks):
+    """Yield the gzip-compressed bytes of an iterable of byte strings
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _read_file_range(f, first, last, block_size=64 * 1024):
+    """Yield the bytes from position first to last (inclusive) of an open file, then close the file
+    """
+    try:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _situation_frames_json_chunks(document_topic_labels, frames_per_chunk=1000):
+    """Yield the JSON for a list of situation frames in chunks, given (audio_identifier, label) tuples
+
+    The JSON is identical to json.dumps(situation_frames, indent=2, sort_keys=True)
+    for the whole list.
+    """
+    encoder = json.JSONEncoder(indent=2, ensure_ascii=False, sort_keys=True)
+    item_separator = encoder.item_separator + '\n  '
+    prefix = '[\n  '
+    frames = []
+    for (audio_identifier, label) in document_topic_labels:
+        situation_frame = {
+            'DocumentID': audio_identifier,
+            'Type': label,
+            'TypeConfidence': 1.0,
+        }
+        # Indent each situation frame by one level, as a member of the list
+        frames.append(encoder.encode(situation_frame).replace('\n', '\n  '))
+        if len(frames) == frames_per_chunk:
+            yield prefix + item_separator.join(frames)
+            prefix = item_separator
+            frames = []
+    if frames:
+        yield prefix + item_separator.join(frames)
+        prefix = item_separator
+    yield '\n]\n' if prefix == item_separator else '[]\n'
+
+
+def _terms_json_response(corpus_id, terms_json, columns=False):
+    """Return the JSON response for a wordcloud, given a dict for each Term
+
+    The default format is a list of Term dicts.  The columnar format,
+    requested with the 'format=columns' parameter, has a list of values for
+    each Term attribute instead, leaving out the 'term_id' and 'corpus_id'
+    values that are the same as (or can be derived from) the 'id' values.
+    Attributes that only some Terms have are null for the other Terms.
+    """
+    if not columns:
+        response = HttpResponse(content=json.dumps({
+            'terms': terms_json
+        }))
+    else:
+        keys = set()
+        for term_json in terms_json:
+            keys.update(term_json)
+        keys.difference_update(['term_id', 'corpus_id'])
+        response = HttpResponse(content=json.dumps({
+            'corpus_id': int(corpus_id),
+            'columns': dict((key, [term_json.get(key) for term_json in terms_json]) for key in keys),
+        }, separators=(',', ':')))
+    response['Content-Type'] = 'application/json'
+    return response
@@ -0,0 +1,92 @@
+"""Streaming readers for the files generated by ZRTools
+
+All of the readers in this module are generators that read one line
+at a time, so that the memory used while importing a corpus does not
+depend on the size of the ZRTools output files.
+"""
+from __future__ import unicode_literals
+
+from array import array
+import io
+import os.path
+
+
+# Sentinel stored in the array returned by read_term_index_for_nodes()
+# for nodes that are not part of any cluster
+NO_TERM = -1
+
+
+def read_clusters(fname):
+    """Yield a (term_index, node_indices) tuple for each line of a .dedups file
+
+    Each line of the 'clusters' file lists the node indices (line
+    numbers in the .nodes file) for a single (Pseudo)Term:
+      13 14
+      15 16 51 52
+    """
+    for (term_index, line) in enumerate(_read_lines(fname)):
+        yield (term_index, [int(node_index) for node_index in line.split()])
+
+
+def read_filenames(fname, audio_directory=None, audio_extension=None):
+    """Yield a (document_index, audio_identifier, audio_path) tuple for each line of files.lst
+
+    The 'filenames' file is a text file listing the paths the audio Documents:
+      /Users/charman/zr_datasets/BUCKEYE/s38/s3802a.wav
+      /Users/charman/zr_datasets/BUCKEYE/s38/s3802b.wav
+    """
+    for (document_index, full_filename) in enumerate(_read_lines(fname)):
+        audio_identifier = os.path.splitext(os.path.basename(full_filename))[0].strip()
+        if audio_directory:
+            audio_path = os.path.join(audio_directory, os.path.basename(full_filename)).strip()
+        else:
+            audio_path = full_filename.strip()
+        if audio_extension:
+            audio_path += "." + audio_extension
+        yield (document_index, audio_identifier, audio_path)
+
+
+def read_nodes(fname):
+    """Yield a (node_index, audio_identifier, start, end, score) tuple for each line of a .nodes file
+
+    The 'audiofragments' file is a TSV file with six fields:
+      s3802b  55028   55087   0.911181        23.175030       896
+      s3802b  55085   55144   0.911181        23.175030       896
+
+    Node indices start at 1, which matches how the node indices in the
+    .dedups file have always been interpreted by VaporEngine.
+    """
+    for (node_index, line) in enumerate(_read_lines(fname), start=1):
+        (audio_identifier, start, end, score, ignore1, ignore2) = line.split()
+        yield (node_index, audio_identifier, int(start), int(end), float(score))
+
+
+def read_term_index_for_nodes(fname):
+    """Return an array mapping node indices to term indices for a .dedups file
+
+    The array is indexed by node index, and contains the index of the
+    cluster (Term) each node belongs to, or NO_TERM if the node is not
+    part of a cluster.  Storing the mapping as an array of C longs
+    takes a few bytes per node, instead of the ~100 bytes per node
+    needed by a dict.
+    """
+    term_index_for_node = array(str('l'))
+    for (term_index, node_indices) in read_clusters(fname):
+        for node_index in node_indices:
+            if node_index >= len(term_index_for_node):
+                term_index_for_node.extend([NO_TERM] * (node_index + 1 - len(term_index_for_node)))
+            # TODO: Verify that node_index hasn't been associated with another term
+            term_index_for_node[node_index] = term_index
+    return term_index_for_node
+
+
+def _read_lines(fname, encoding='utf-8'):
+    # Some of the source files have the unicode characters \u2028
+    # (line separator) and \u2029 (paragraph separator)
+    ## NB: io.open ignores \u2028 and \u2029 (thankfully), while codecs.open() does not
+    f = io.open(fname, 'r', encoding=encoding, newline='\n')
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()